@@ -1,42 +1,71 @@
 import os
 import json
 import io
+import csv
 import time
-from flask import Flask, request, jsonify, g
+import base64
+import hashlib
+from datetime import datetime
+from flask import Flask, Response, request, jsonify, g, stream_with_context
 from functools import wraps
-from PIL import Image
-import google.generativeai as genai
 import database as db
-from pypdf import PdfReader
-import firebase_admin
-from firebase_admin import credentials, auth
-import cloudinary
-import cloudinary.uploader
-import cloudinary.utils
+import identity
+import blobstore
+import batch_upload
+import processing
+import query_router
+import model_client
+import worker
+import job_events
+import metrics
 
 app = Flask(__name__)
 
-try:
-    firebase_sdk_json_str = os.environ.get("FIREBASE_ADMIN_SDK_JSON")
-    if not firebase_sdk_json_str: raise ValueError("FIREBASE_ADMIN_SDK_JSON no configurada.")
-    cred = credentials.Certificate(json.loads(firebase_sdk_json_str))
-    if not firebase_admin._apps: firebase_admin.initialize_app(cred)
-    print("Firebase Admin SDK inicializado.")
-except Exception as e:
-    print(f"ERROR CRÍTICO al inicializar Firebase: {e}")
+# Firebase, Gemini y Cloudinary se cargan en la primera petición que los necesita (ver identity y processing);
+# el arranque solo comprueba con una consulta que el esquema está al día (`python manage.py migrate`)
+db.check_schema()
 
-try:
-    api_key = os.environ.get("GOOGLE_API_KEY")
-    if not api_key: raise ValueError("No se encontró GOOGLE_API_KEY.")
-    genai.configure(api_key=api_key)
-    print("Google Gemini API configurada.")
-except Exception as e:
-    print(f"Error CRÍTICO al configurar Gemini: {e}")
+@app.before_request
+def start_request_metrics():
+    metrics.start_request()
 
-with app.app_context():
-    db.init_db()
+@app.after_request
+def finish_request_metrics(response):
+    elapsed, timings, queries = metrics.finish_request()
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    metrics.observe('app_http_request_duration_seconds', elapsed, route=route, method=request.method)
+    metrics.count('app_http_requests_total', route=route, method=request.method, status=response.status_code)
+    if queries: metrics.count('app_http_db_queries_total', queries, route=route)
+    response.headers['Server-Timing'] = metrics.server_timing_header(elapsed, timings, queries)
+    return response
 
-gemini_model = genai.GenerativeModel('gemini-3-flash-preview')
+_queue_metrics = {'at': 0.0, 'data': None}
+
+def queue_metrics():
+    # Varias métricas salen de la misma consulta: una sola vez por scrape
+    if _queue_metrics['data'] is None or time.monotonic() - _queue_metrics['at'] > 1.0:
+        _queue_metrics['data'], _queue_metrics['at'] = db.get_queue_metrics(), time.monotonic()
+    return _queue_metrics['data']
+
+def queue_gauges():
+    return [({'status': row['status'], 'type': row['type']}, row['jobs']) for row in queue_metrics()['queue']]
+
+def queue_age_gauges():
+    return [({'status': row['status'], 'type': row['type']}, float(row['oldest_age'])) for row in queue_metrics()['queue']]
+
+metrics.register_gauge('app_job_queue_depth', 'Trabajos sin terminar en job_queue por estado y tipo.', queue_gauges)
+metrics.register_gauge('app_job_queue_oldest_age_seconds', 'Antigüedad del trabajo sin terminar más antiguo por estado y tipo.', queue_age_gauges)
+metrics.register_gauge('app_job_queue_users_waiting', 'Usuarios distintos con trabajos pendientes.',
+                       lambda: [({}, queue_metrics()['users_waiting'])])
+metrics.register_gauge('app_archival_tasks_open', 'Tareas de archivado pendientes o en curso.',
+                       lambda: [({'status': status}, tasks) for status, tasks in queue_metrics()['archival'].items()])
+metrics.register_gauge('app_db_pool_connections', 'Conexiones del pool de este proceso.',
+                       lambda: [({'state': k}, v) for k, v in db.pool_stats().items() if isinstance(v, (int, float)) and not isinstance(v, bool)])
+metrics.register_gauge('app_model_client', 'Estado del cliente del modelo (contadores acumulados y llamadas activas).',
+                       lambda: [({'stat': k}, v) for k, v in processing.gemini_client.stats().items() if isinstance(v, (int, float))]
+                               + [({'stat': 'breaker_open'}, int(processing.gemini_client.breaker.is_open()))])
+metrics.register_gauge('app_job_event_subscribers', 'Peticiones esperando eventos de trabajos (long-poll y SSE).',
+                       lambda: [({}, job_events.get_hub().subscriber_count())])
 
 def check_token(f):
     @wraps(f)
@@ -45,9 +74,9 @@ def check_token(f):
         if not auth_header or not auth_header.startswith('Bearer '):
             return jsonify({'ok': False, 'error': 'Token Bearer no encontrado'}), 401
         try:
-            decoded_token = auth.verify_id_token(auth_header.split('Bearer ')[1])
+            decoded_token = identity.verify_token(auth_header.split('Bearer ')[1])
             g.user_id = decoded_token['uid']
-            g.user = db.get_or_create_user(decoded_token['uid'], decoded_token.get('email'))
+            g.user, g.user_status = identity.resolve_user(decoded_token['uid'], decoded_token.get('email'))
         except Exception as e:
             return jsonify({'ok': False, 'error': f'Error de autenticación: {e}'}), 403
         return f(*args, **kwargs)
@@ -56,7 +85,7 @@ def check_token(f):
 def feature_protected(f):
     @wraps(f)
     def wrap(*args,**kwargs):
-        status = db.get_user_status(g.user_id)
+        status = g.user_status
         if not status.get('is_active'):
             return jsonify({'ok': False, 'error': 'Acceso denegado. El período de prueba ha terminado.', 'user_status': status.get('status')}), 403
         return f(*args, **kwargs)
@@ -66,138 +95,251 @@ def feature_protected(f):
 @check_token
 def user_status():
     try:
-        status = db.get_user_status(g.user_id)
-        return jsonify({"ok": True, "status": status})
+        return jsonify({"ok": True, "status": g.user_status})
     except Exception as e:
         return jsonify({"ok": False, "error": f"Error interno: {str(e)}"}), 500
 
-# --- MODIFICADO: Prompt para IA global (Moneda dinámica) ---
-prompt_plantilla_factura = """
-Actúa como un experto contable internacional. Analiza el documento y extrae los datos en formato JSON estricto.
-INSTRUCCIONES CLAVE:
-1. EXTRACCIÓN: Extrae `emisor`, `cif`, `fecha`, `total`, `base_imponible`.
-2. MONEDA (NUEVO): Identifica el símbolo de la divisa utilizada (ej: €, $, £, MXN, COP, etc.) y guárdalo en el campo `"moneda"`. Si no lo encuentras, usa "€".
-3. ESTADO (OBLIGATORIO): Examina evidencias de pago (PAGADO, PAID, PAID IN FULL, balance 0). Si está pagada, pon `"estado": "Pagada"`. Si hay dudas o está pendiente, pon `"estado": "Pendiente"`.
-4. CONCEPTOS (OBLIGATORIO): Extrae CADA concepto con `descripcion`, `cantidad` y `precio_unitario`. NUNCA dejes la lista vacía.
-FORMATO JSON ESTRICTO:
-{ "emisor": "Nombre", "cif": "B123", "fecha": "DD/MM/AAAA", "total": 121.00, "base_imponible": 100.00, "estado": "Pagada", "moneda": "$", "conceptos":[ {"descripcion": "Producto", "cantidad": 2.0, "precio_unitario": 50.0} ] }
-"""
-prompt_multipagina_pdf = prompt_plantilla_factura 
+def enqueue_upload(job_type: str, empty_error: str):
+    if request.content_length is not None and request.content_length > blobstore.MAX_UPLOAD_BYTES:
+        return jsonify({"ok": False, "error": "El fichero supera el tamaño máximo permitido."}), 413
+    try:
+        # El cuerpo se vuelca por trozos al almacén de blobs sin cargarlo entero en memoria
+        blob_ref = blobstore.get_store().put_stream(request.stream)
+        if not blob_ref.size:
+            blobstore.get_store().delete(blob_ref.key)
+            return jsonify({"ok": False, "error": empty_error}), 400
+        try:
+            cached = processing.lookup_cached_extraction(g.user_id, blob_ref.content_hash)
+            if cached:
+                blobstore.get_store().delete(blob_ref.key)
+                job_id = processing.complete_duplicate_upload(blob_ref, g.user_id, job_type, cached)
+                return jsonify({"ok": True, "job_id": job_id, "duplicate": True})
+            # Los PDF grandes se encolan ya fragmentados por rangos de páginas (ver processing.plan_pdf_shards)
+            page_ranges = processing.plan_pdf_shards(blob_ref) if job_type == 'pdf' else None
+            job_id = db.create_job(blob_ref, g.user_id, job_type, page_ranges)
+        except Exception:
+            blobstore.get_store().delete(blob_ref.key); raise
+        if job_id: return jsonify({"ok": True, "job_id": job_id, "shards": len(page_ranges) if page_ranges else None})
+        else: return jsonify({"ok": False, "error": "No se pudo crear el trabajo."}), 500
+    except blobstore.BlobTooLarge as e:
+        return jsonify({"ok": False, "error": str(e)}), 413
+    except Exception as e:
+        return jsonify({"ok": False, "error": f"Error interno: {str(e)}"}), 500
 
 @app.route('/api/process_invoice', methods=['POST'])
 @check_token
 @feature_protected
 def process_invoice():
-    if not request.data: return jsonify({"ok": False, "error": "No se ha enviado ninguna imagen"}), 400
-    try:
-        job_id = db.create_image_job(request.data, g.user_id)
-        if job_id: return jsonify({"ok": True, "job_id": job_id})
-        else: return jsonify({"ok": False, "error": "No se pudo crear el trabajo."}), 500
-    except Exception as e:
-        return jsonify({"ok": False, "error": f"Error interno: {str(e)}"}), 500
+    return enqueue_upload('image', "No se ha enviado ninguna imagen")
 
 @app.route('/api/upload_pdf', methods=['POST'])
 @check_token
 @feature_protected
 def upload_pdf():
-    if not request.data: return jsonify({"ok": False, "error": "No se ha enviado ningún fichero PDF"}), 400
+    return enqueue_upload('pdf', "No se ha enviado ningún fichero PDF")
+
+@app.route('/api/upload_batch', methods=['POST'])
+@check_token
+@feature_protected
+def upload_batch():
+    """Varios PDF/imágenes en multipart, o un ZIP (como cuerpo o como parte del multipart)."""
+    if request.content_length is not None and request.content_length > batch_upload.BATCH_MAX_BYTES:
+        return jsonify({"ok": False, "error": "El lote supera el tamaño máximo permitido."}), 413
+    spooled = None
     try:
-        job_id = db.create_pdf_job(request.data, g.user_id)
-        if job_id: return jsonify({"ok": True, "job_id": job_id})
-        else: return jsonify({"ok": False, "error": "No se pudo crear el trabajo."}), 500
+        if request.mimetype.startswith('multipart/'):
+            # Werkzeug ya vuelca a disco las partes grandes del multipart
+            sources = [(f.filename or field, f.stream) for field, f in request.files.items(multi=True)]
+        else:
+            spooled = blobstore.spool_stream(request.stream, batch_upload.BATCH_MAX_BYTES)
+            sources = [('upload', spooled)]
+        if not sources: return jsonify({"ok": False, "error": "No se ha enviado ningún fichero"}), 400
+        batch_id, jobs, rejected = batch_upload.enqueue_batch(g.user_id, sources)
+        return jsonify({"ok": True, "batch_id": batch_id, "jobs": jobs, "rejected": rejected})
+    except batch_upload.BatchError as e:
+        return jsonify({"ok": False, "error": str(e), "rejected": e.rejected}), 400
+    except blobstore.BlobTooLarge as e:
+        return jsonify({"ok": False, "error": str(e)}), 413
     except Exception as e:
         return jsonify({"ok": False, "error": f"Error interno: {str(e)}"}), 500
+    finally:
+        if spooled: spooled.close()
+
+@app.route('/api/batch_status/<batch_id>', methods=['GET'])
+@check_token
+def batch_status(batch_id):
+    try:
+        status = db.get_batch_status(batch_id, g.user_id, with_jobs=request.args.get('jobs') in ('1', 'true'))
+        if status: return jsonify({"ok": True, "status": status})
+        else: return jsonify({"ok": False, "error": "Lote no encontrado."}), 404
+    except Exception as e:
+        return jsonify({"ok": False, "error": f"Error interno: {str(e)}"}), 500
+
+@app.route('/api/extraction_cache/stats', methods=['GET'])
+@check_token
+def extraction_cache_stats():
+    try:
+        stats = db.get_extraction_cache_stats(g.user_id)
+        return jsonify({"ok": True, "stats": stats, "process": processing.cache_counters(),
+                        "prompt_version": processing.PROMPT_VERSION, "model": processing.GEMINI_MODEL_NAME})
+    except Exception as e:
+        return jsonify({"ok": False, "error": f"Error interno: {str(e)}"}), 500
+
+JOB_STATUS_MAX_WAIT = 30
+JOB_EVENTS_HEARTBEAT = 15
+# Las plataformas serverless cortan las respuestas largas: el stream se cierra solo y EventSource reconecta
+JOB_EVENTS_MAX_SECONDS = int(os.environ.get('JOB_EVENTS_MAX_SECONDS', '300'))
+JOB_FINAL_STATES = ('completed', 'failed')
+
+def wait_for_job(job_id, user_id: str, wait: float):
+    """Estado del trabajo, esperando hasta `wait` segundos a que termine. La suscripción se abre antes
+    de la primera consulta para no perder una notificación que llegue entre medias."""
+    with job_events.subscribe(user_id) as subscription:
+        status = db.get_job_status(job_id, user_id)
+        deadline = time.monotonic() + wait
+        while status and status['status'] not in JOB_FINAL_STATES:
+            event = subscription.get(deadline - time.monotonic())
+            if event is None: break
+            if event['type'] == 'resync' or event.get('job_id') == str(job_id).lower():
+                status = db.get_job_status(job_id, user_id)
+    return status
 
 @app.route('/api/job_status/<job_id>', methods=['GET'])
 @check_token
 def job_status(job_id):
+    """Con ?wait=N (máx. 30) hace long-poll: responde en cuanto el trabajo termina o al agotar la espera."""
     try:
-        status = db.get_job_status(job_id, g.user_id)
+        wait = max(0, min(request.args.get('wait', default=0, type=float), JOB_STATUS_MAX_WAIT))
+        status = wait_for_job(job_id, g.user_id, wait) if wait else db.get_job_status(job_id, g.user_id)
         if status: return jsonify({"ok": True, "status": status})
         else: return jsonify({"ok": False, "error": "Job ID no encontrado."}), 404
     except Exception as e:
         return jsonify({"ok": False, "error": f"Error interno: {str(e)}"}), 500
 
+def sse_message(event: str, data: dict):
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False, default=str)}\n\n"
+
+@app.route('/api/job/<job_id>/retry', methods=['POST'])
+@check_token
+@feature_protected
+def retry_job(job_id):
+    """Reintenta un PDF fragmentado que falló: solo vuelven a la cola sus fragmentos fallidos."""
+    try:
+        retried = db.retry_failed_shards(job_id, g.user_id)
+        if retried is None: return jsonify({"ok": False, "error": "Job ID no encontrado."}), 404
+        if not retried: return jsonify({"ok": False, "error": "El trabajo no tiene fragmentos fallidos que reintentar."}), 409
+        return jsonify({"ok": True, "job_id": job_id, "shards_retried": retried})
+    except Exception as e:
+        return jsonify({"ok": False, "error": f"Error interno: {str(e)}"}), 500
+
+@app.route('/api/job_events', methods=['GET'])
+@check_token
+def job_events_stream():
+    """Server-sent events con los cambios de estado de los trabajos del usuario (opcionalmente de un lote con
+    ?batch_id=). Empieza con un 'snapshot' de los trabajos sin terminar; cada 'job' terminado incluye su estado
+    completo para no tener que pedir job_status después."""
+    user_id, batch_id = g.user_id, request.args.get('batch_id')
+
+    def active_jobs():
+        return [job for job in db.get_active_jobs(user_id) if not batch_id or job['batch_id'] == batch_id]
+
+    def stream():
+        deadline = time.monotonic() + JOB_EVENTS_MAX_SECONDS
+        with job_events.subscribe(user_id) as subscription:
+            yield "retry: 3000\n" + sse_message('snapshot', {'jobs': active_jobs()})
+            while time.monotonic() < deadline:
+                event = subscription.get(min(JOB_EVENTS_HEARTBEAT, deadline - time.monotonic()))
+                if event is None: yield ": ping\n\n"; continue
+                if event['type'] == 'resync':
+                    yield sse_message('snapshot', {'jobs': active_jobs()}); continue
+                if batch_id and event.get('batch_id') != batch_id: continue
+                data = {k: event.get(k) for k in ('job_id', 'status', 'batch_id')}
+                if event['status'] in JOB_FINAL_STATES: data['job'] = db.get_job_status(event['job_id'], user_id)
+                elif event['status'] == 'waiting': data['shards'] = (db.get_job_status(event['job_id'], user_id) or {}).get('shards')
+                yield sse_message('job', data)
+            yield sse_message('end', {'reconnect': True})
+
+    return Response(stream_with_context(stream()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    auth_header = request.headers.get('Authorization')
+    cron_secret = os.environ.get('CRON_SECRET')
+    if not cron_secret or auth_header != f"Bearer {cron_secret}": return "Unauthorized", 401
+    return Response(metrics.render_prometheus(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/api/queue_stats', methods=['GET'])
+def queue_stats():
+    """Reparto de la cola por usuario (equidad del planificador). Protegido como el cron."""
+    auth_header = request.headers.get('Authorization')
+    cron_secret = os.environ.get('CRON_SECRET')
+    if not cron_secret or auth_header != f"Bearer {cron_secret}": return "Unauthorized", 401
+    try:
+        window = max(1, min(request.args.get('minutes', default=60, type=int), 24 * 60))
+        limit = max(1, min(request.args.get('limit', default=50, type=int), 500))
+        return jsonify({"ok": True, "window_minutes": window, "users": db.get_queue_user_stats(window, limit)})
+    except Exception as e:
+        return jsonify({"ok": False, "error": f"Error interno: {str(e)}"}), 500
+
 @app.route('/api/process_queue', methods=['GET'])
 def process_queue():
     auth_header = request.headers.get('Authorization')
     cron_secret = os.environ.get('CRON_SECRET')
     if not cron_secret or auth_header != f"Bearer {cron_secret}": return "Unauthorized", 401
     
-    job = db.get_pending_job()
-    if not job: return "No hay trabajos pendientes.", 200
-    
-    job_id, job_data, user_id, job_type = job['id'], job['file_data'], job['user_id'], job['type']
-    
     try:
-        content_parts =[]
-        if job_type == 'pdf':
-            pdf_stream = io.BytesIO(bytes(job_data))
-            pdf_reader = PdfReader(pdf_stream)
-            if not pdf_reader.pages: raise ValueError("PDF vacío.")
-            content_parts.append(prompt_multipagina_pdf)
-            for page in pdf_reader.pages:
-                if text := page.extract_text(): content_parts.append(text)
-                for image_obj in page.images:
-                    try: content_parts.append(Image.open(io.BytesIO(image_obj.data)))
-                    except Exception as e: print(f"⚠️ No se pudo procesar imagen en PDF: {e}")
-        elif job_type == 'image':
-            img = Image.open(io.BytesIO(bytes(job_data)))
-            content_parts = [prompt_plantilla_factura, img]
-            
-        if len(content_parts) <= 1: raise ValueError("No se extrajo contenido del documento.")
-        
-        response = gemini_model.generate_content(content_parts)
-        
-        raw_text = response.text
-        start_idx = raw_text.find('{')
-        end_idx = raw_text.rfind('}')
-        
-        if start_idx != -1 and end_idx != -1 and end_idx > start_idx:
-            json_text = raw_text[start_idx:end_idx + 1]
-            try:
-                final_invoice_data = json.loads(json_text)
-            except json.JSONDecodeError as e:
-                raise ValueError(f"El JSON extraído es inválido: {e}")
-        else:
-            raise ValueError("Gemini no devolvió ningún formato JSON reconocible.")
-        
-        file_info = None
-        try:
-            print(f"☁️ Subiendo archivo original ({job_type}) a Cloudinary (Private)...")
-            file_obj = io.BytesIO(bytes(job_data))
-            upload_params = {"file": file_obj, "type": "private", "folder": f"gestor_facturas/users/{user_id}"}
-            if job_type == 'pdf':
-                upload_params["resource_type"] = "image" 
-                upload_params["format"] = "pdf"
-            else:
-                upload_params["resource_type"] = "image"
-            upload_result = cloudinary.uploader.upload(**upload_params)
-            file_info = {
-                "public_id": upload_result.get("public_id"),
-                "resource_type": upload_result.get("resource_type"),
-                "format": upload_result.get("format", job_type)
-            }
-        except Exception as e:
-            print(f"❌ Error al subir a Cloudinary (se guardarán datos, pero no archivo): {e}")
-
-        invoice_id = db.add_invoice(final_invoice_data, f"gemini-3-flash-preview ({job_type})", user_id, file_info)
-        if not invoice_id: raise ValueError("Falló el guardado en la base de datos.")
-        
-        db.update_job_as_completed(job_id, final_invoice_data, job_type)
-        return f"Job {job_id} procesado.", 200
-        
+        batch_size = request.args.get('batch', default=worker.WORKER_BATCH_SIZE, type=int)
+        summary = worker.run_batch(batch_size=max(1, batch_size))
+        if not summary['claimed'] and not summary['paused']: return "No hay trabajos pendientes.", 200
+        summary['model'] = processing.gemini_client.stats()
+        return jsonify({"ok": True, "summary": summary}), 200
     except Exception as e:
-        db.update_job_as_failed(job_id, f"Error procesando documento: {str(e)}", job_type)
-        return f"Error en job {job_id}: {str(e)}", 500
+        return f"Error procesando la cola: {str(e)}", 500
+
+INVOICES_PAGE_MAX = 500
+
+def encode_cursor(after):
+    return base64.urlsafe_b64encode(json.dumps(after).encode('utf-8')).decode('ascii').rstrip('=')
+
+def decode_cursor(token: str):
+    try:
+        fecha_date, invoice_id = json.loads(base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)))
+        return (fecha_date, int(invoice_id))
+    except Exception:
+        raise ValueError("Cursor inválido.")
+
+def list_invoices_response():
+    fields = request.args.get('fields')
+    if fields:
+        fields = [f.strip() for f in fields.split(',') if f.strip()]
+        unknown = [f for f in fields if f not in db.INVOICE_LIST_FIELDS]
+        if unknown: return jsonify({"ok": False, "error": f"Campos no permitidos: {', '.join(unknown)}"}), 400
+    limit = request.args.get('limit', type=int)
+    if limit is not None: limit = max(1, min(limit, INVOICES_PAGE_MAX))
+    cursor = request.args.get('cursor')
+    try: after = decode_cursor(cursor) if cursor else None
+    except ValueError as e: return jsonify({"ok": False, "error": str(e)}), 400
+
+    # El ETag depende de la versión de la colección y de los parámetros: si coincide no se ejecuta el listado
+    version = db.get_collection_version(g.user_id)
+    params_digest = hashlib.sha1(f"{g.user_id}|{fields}|{limit}|{cursor}".encode('utf-8')).hexdigest()[:16]
+    etag = f"{version}-{params_digest}"
+    if request.if_none_match.contains_weak(etag):
+        response = app.response_class(status=304)
+    else:
+        invoices, next_after = db.list_invoices(g.user_id, fields=fields, limit=limit, after=after)
+        response = jsonify({"ok": True, "invoices": invoices, "next_cursor": encode_cursor(next_after) if next_after else None})
+    response.set_etag(etag, weak=True)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
 
 @app.route('/api/invoices', methods=['GET', 'POST'])
 @check_token
 @feature_protected
 def handle_invoices():
     if request.method == 'GET':
-        invoices = db.get_all_invoices(g.user_id)
-        return jsonify({"ok": True, "invoices": invoices})
+        return list_invoices_response()
     if request.method == 'POST':
         invoice_data = request.get_json()
         if not invoice_data or not invoice_data.get('emisor'):
@@ -206,6 +348,110 @@ def handle_invoices():
         if new_id: return jsonify({"ok": True, "id": new_id}), 201
         else: return jsonify({"ok": False, "error": "No se pudo guardar"}), 500
 
+BULK_IMPORT_MAX_ITEMS = int(os.environ.get('BULK_IMPORT_MAX_ITEMS', '20000'))
+
+def _iter_ndjson_chunks(stream, chunk_size: int):
+    chunk = []
+    for line_number, line in enumerate(stream, start=1):
+        if not line.strip(): continue
+        try: chunk.append(json.loads(line))
+        except json.JSONDecodeError as e: raise ValueError(f"Línea {line_number}: JSON inválido ({e})")
+        if len(chunk) >= chunk_size:
+            yield chunk; chunk = []
+    if chunk: yield chunk
+
+@app.route('/api/invoices/bulk', methods=['POST'])
+@check_token
+@feature_protected
+def bulk_import_invoices():
+    try:
+        if request.mimetype in ('application/x-ndjson', 'application/jsonl'):
+            # NDJSON: se lee línea a línea y se importa por bloques sin cargar el cuerpo entero
+            chunks = _iter_ndjson_chunks(request.stream, db.BULK_IMPORT_CHUNK_SIZE)
+        else:
+            invoices = request.get_json(silent=True)
+            if isinstance(invoices, dict): invoices = invoices.get('invoices')
+            if not isinstance(invoices, list): return jsonify({"ok": False, "error": "Se esperaba una lista de facturas o NDJSON."}), 400
+            chunks = [invoices]
+        results, total = [], 0
+        for chunk in chunks:
+            total += len(chunk)
+            if total > BULK_IMPORT_MAX_ITEMS:
+                return jsonify({"ok": False, "error": f"Máximo {BULK_IMPORT_MAX_ITEMS} facturas por importación.", "results": results}), 413
+            results.extend(db.add_invoices_bulk(chunk, "Importación", g.user_id, start_index=total - len(chunk)))
+        imported = sum(1 for r in results if r['ok'])
+        return jsonify({"ok": True, "imported": imported, "failed": len(results) - imported, "results": results})
+    except ValueError as e:
+        return jsonify({"ok": False, "error": str(e)}), 400
+    except Exception as e:
+        return jsonify({"ok": False, "error": f"Error interno: {str(e)}"}), 500
+
+EXPORT_FORMATS = {'csv': 'text/csv', 'ndjson': 'application/x-ndjson'}
+EXPORT_CHUNK_BYTES = 64 * 1024
+EXPORT_CSV_INVOICE_FIELDS = list(db.EXPORT_INVOICE_FIELDS) + ['impuestos']
+
+def _export_value(value):
+    if value is None: return ''
+    if hasattr(value, 'isoformat'): return value.isoformat()
+    if isinstance(value, dict): return json.dumps(value, ensure_ascii=False) if value else ''
+    # Los textos salen de documentos subidos: sin esto una hoja de cálculo ejecutaría "=HYPERLINK(...)" como fórmula
+    if isinstance(value, str) and value[:1] in ('=', '+', '-', '@', '\t', '\r'): return "'" + value
+    return value
+
+def iter_csv_export(rows):
+    """Una línea por concepto con los datos de su factura repetidos. El BOM inicial hace que Excel lea el UTF-8 (€, tildes)."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    buffer.write('\ufeff')
+    writer.writerow(['factura_id' if f == 'id' else f for f in EXPORT_CSV_INVOICE_FIELDS] + [f"concepto_{f}" for f in db.EXPORT_CONCEPT_FIELDS])
+    current, prefix, empty = None, None, [''] * len(db.EXPORT_CONCEPT_FIELDS)
+    for invoice, concepto in rows:
+        # Los campos de la factura se formatean una vez y se repiten en cada uno de sus conceptos
+        if invoice is not current: current, prefix = invoice, [_export_value(invoice[f]) for f in EXPORT_CSV_INVOICE_FIELDS]
+        writer.writerow(prefix + ([_export_value(concepto[f]) for f in db.EXPORT_CONCEPT_FIELDS] if concepto else empty))
+        if buffer.tell() >= EXPORT_CHUNK_BYTES:
+            yield buffer.getvalue(); buffer.seek(0); buffer.truncate()
+    yield buffer.getvalue()
+
+def iter_ndjson_export(rows):
+    """Un objeto JSON por factura con sus conceptos: la misma forma que /api/invoice/<id>."""
+    chunk, size, current = [], 0, None
+
+    def line(invoice):
+        return json.dumps(invoice, ensure_ascii=False, default=lambda v: v.isoformat() if hasattr(v, 'isoformat') else str(v)) + '\n'
+
+    for invoice, concepto in rows:
+        if invoice is not current:
+            if current is not None:
+                chunk.append(line(current)); size += len(chunk[-1])
+                if size >= EXPORT_CHUNK_BYTES:
+                    yield ''.join(chunk); chunk, size = [], 0
+            current = invoice; current['conceptos'] = []
+        if concepto: current['conceptos'].append(concepto)
+    if current is not None: chunk.append(line(current))
+    yield ''.join(chunk)
+
+@app.route('/api/invoices/export', methods=['GET'])
+@check_token
+@feature_protected
+def export_invoices():
+    """Exporta las facturas con sus conceptos en streaming (?format=csv|ndjson), con filtros opcionales
+    date_from/date_to (AAAA-MM-DD sobre la fecha de la factura), estado y moneda."""
+    export_format = request.args.get('format', 'csv').lower()
+    if export_format not in EXPORT_FORMATS:
+        return jsonify({"ok": False, "error": f"Formato no soportado: {export_format} (csv o ndjson)."}), 400
+    try:
+        dates = {name: datetime.strptime(request.args[name], '%Y-%m-%d').date().isoformat() if request.args.get(name) else None
+                 for name in ('date_from', 'date_to')}
+    except ValueError:
+        return jsonify({"ok": False, "error": "Las fechas deben tener el formato AAAA-MM-DD."}), 400
+    rows = db.iter_invoice_export(g.user_id, estado=request.args.get('estado') or None, moneda=request.args.get('moneda') or None, **dates)
+    body = iter_csv_export(rows) if export_format == 'csv' else iter_ndjson_export(rows)
+    filename = '_'.join(['facturas'] + [d for d in dates.values() if d]) + ('.csv' if export_format == 'csv' else '.ndjson')
+    # La conexión del cursor con nombre se devuelve al pool cuando el generador termina o el cliente corta la descarga
+    return Response(stream_with_context(body), mimetype=EXPORT_FORMATS[export_format],
+                    headers={'Content-Disposition': f'attachment; filename="{filename}"', 'Cache-Control': 'no-store', 'X-Accel-Buffering': 'no'})
+
 @app.route('/api/invoice/<int:invoice_id>', methods=['GET', 'DELETE'])
 @check_token
 def handle_single_invoice(invoice_id):
@@ -224,11 +470,14 @@ def handle_single_invoice(invoice_id):
 def get_original_document(invoice_id):
     try:
         details = db.get_invoice_details(invoice_id, g.user_id)
+        if details and not details.get('file_info') and db.has_pending_archival(invoice_id, g.user_id):
+            return jsonify({"ok": False, "pending": True, "error": "El documento original se está archivando, inténtalo en unos segundos."}), 409
         if not details or not details.get('file_info'):
             return jsonify({"ok": False, "error": "El documento original no está disponible para esta factura."}), 404
         
         f_info = details['file_info']
         
+        import cloudinary.utils
         url, options = cloudinary.utils.cloudinary_url(
             f_info['public_id'],
             resource_type=f_info['resource_type'],
@@ -255,6 +504,40 @@ def update_notes(invoice_id):
     except Exception as e:
         return jsonify({"ok": False, "error": f"Error interno: {str(e)}"}), 500
 
+@app.route('/api/invoice/<int:invoice_id>/estado', methods=['PUT'])
+@check_token
+@feature_protected
+def update_estado(invoice_id):
+    try:
+        data = request.get_json(silent=True) or {}
+        if data.get('estado') not in db.INVOICE_ESTADOS:
+            return jsonify({"ok": False, "error": f"El campo 'estado' debe ser uno de: {', '.join(db.INVOICE_ESTADOS)}"}), 400
+        success = db.update_invoice_estado(invoice_id, g.user_id, data['estado'])
+        if success: return jsonify({"ok": True, "message": "Estado actualizado"})
+        else: return jsonify({"ok": False, "error": "No se pudo actualizar"}), 404
+    except Exception as e:
+        return jsonify({"ok": False, "error": f"Error interno: {str(e)}"}), 500
+
+@app.route('/api/stats', methods=['GET'])
+@check_token
+@feature_protected
+def invoice_stats():
+    """Totales para el dashboard leídos de los resúmenes precalculados (no recorre las facturas)."""
+    try:
+        months = request.args.get('months', type=int)
+        top = max(1, min(request.args.get('top', 10, type=int), 50))
+        version = db.get_collection_version(g.user_id)
+        etag = f"stats-{version}-{months}-{top}"
+        if request.if_none_match.contains_weak(etag):
+            response = app.response_class(status=304)
+        else:
+            response = jsonify({"ok": True, "stats": db.get_invoice_stats(g.user_id, months=months, top_suppliers=top)})
+        response.set_etag(etag, weak=True)
+        response.headers['Cache-Control'] = 'private, no-cache'
+        return response
+    except Exception as e:
+        return jsonify({"ok": False, "error": f"Error interno: {str(e)}"}), 500
+
 @app.route('/api/ai/query', methods=['POST'])
 @check_token
 @feature_protected
@@ -263,13 +546,24 @@ def ai_query():
         query_data = request.get_json()
         if not query_data or 'query' not in query_data: return jsonify({"ok": False, "error": "Falta la pregunta."}), 400
         user_query = query_data['query']
-        all_invoices = db.get_all_invoices_with_details(g.user_id)
-        if not all_invoices: return jsonify({"ok": True, "answer": "No tienes facturas registradas."})
-        
-        invoices_context = json.dumps(all_invoices, indent=2, ensure_ascii=False, default=str)
+        emisores, monedas = db.get_query_vocabulary(g.user_id)
+        aggregate = query_router.parse_question(user_query, emisores, monedas)
+        if aggregate:
+            # Pregunta agregada: la responde PostgreSQL, sin llamar a Gemini
+            answer, invoice_id = query_router.answer_aggregate(g.user_id, aggregate)
+            return jsonify({"ok": True, "answer": answer, "invoice_id": invoice_id, "served_by": "sql"})
+
+        invoices, context_info = query_router.retrieve_context(g.user_id, user_query, emisores, monedas)
+        if not invoices: return jsonify({"ok": True, "answer": "No tienes facturas registradas.", "served_by": "none"})
+        summaries_context = json.dumps(query_router.build_summaries(g.user_id), ensure_ascii=False, default=str, separators=(',', ':'))
+        invoices_context = json.dumps(invoices, ensure_ascii=False, default=str, separators=(',', ':'))
         # --- MODIFICADO: Instrucción para Multi-idioma ---
         prompt_contextual = f"""Actúa como un asistente financiero experto y servicial.
-        DATOS DE FACTURAS:
+        RESUMEN DE TODAS LAS FACTURAS (totales por moneda y estado, principales proveedores, últimos meses):
+        ```json
+        {summaries_context}
+        ```
+        FACTURAS RELEVANTES PARA LA PREGUNTA (solo una selección, no todas):
         ```json
         {invoices_context}
         ```
@@ -277,15 +571,22 @@ def ai_query():
         
         INSTRUCCIONES ESTRICTAS DE RESPUESTA:
         1. IMPORTANTE IDIOMA: Responde EXACTAMENTE en el mismo idioma en el que está escrita la PREGUNTA DEL USUARIO (ej. si pregunta en inglés, responde en inglés).
-        2. Debes devolver tu respuesta ÚNICAMENTE en formato JSON válido:
+        2. Para totales y recuentos globales usa el RESUMEN; las FACTURAS RELEVANTES son solo una muestra.
+        3. Debes devolver tu respuesta ÚNICAMENTE en formato JSON válido:
         {{
           "answer": "Tu respuesta amable y conversacional aquí.",
           "invoice_id": 123
         }}
-        3. "invoice_id": Si el usuario pide explícitamente ver, mostrar, abrir o imprimir una factura concreta, pon su 'id' numérico. Si es una pregunta general, pon null. NUNCA inventes un ID.
+        4. "invoice_id": Si el usuario pide explícitamente ver, mostrar, abrir o imprimir una factura concreta, pon su 'id' numérico. Si es una pregunta general, pon null. NUNCA inventes un ID.
         """
         
-        response = gemini_model.generate_content(prompt_contextual)
+        try:
+            response = processing.gemini_client.generate(prompt_contextual, priority='interactive')
+        except model_client.RetryableModelError as e:
+            retry_after = max(1, int(processing.gemini_client.breaker.retry_after()) or 5)
+            response = jsonify({"ok": False, "error": f"El asistente no está disponible ahora mismo, inténtalo en unos segundos. ({e})"})
+            response.headers['Retry-After'] = str(retry_after)
+            return response, 503
         
         raw_text = response.text
         start_idx = raw_text.find('{')
@@ -305,13 +606,31 @@ def ai_query():
             answer = raw_text
             invoice_id = None
             
-        return jsonify({"ok": True, "answer": answer, "invoice_id": invoice_id})
+        return jsonify({"ok": True, "answer": answer, "invoice_id": invoice_id, "served_by": "model", "context": context_info})
     except Exception as e: return jsonify({"ok": False, "error": f"Error interno: {str(e)}"}), 500
 
 @app.route('/api/search', methods=['POST'])
 @check_token
 def search():
-    pass
+    try:
+        params = request.get_json(silent=True) or {}
+        def optional_float(name):
+            value = params.get(name)
+            return float(value) if value not in (None, '') else None
+        def optional_date(name):
+            value = params.get(name)
+            return datetime.strptime(value, '%Y-%m-%d').date().isoformat() if value else None
+        results, has_more = db.search_invoices(
+            g.user_id, text_query=(params.get('query') or '').strip() or None,
+            date_from=optional_date('date_from'), date_to=optional_date('date_to'),
+            min_total=optional_float('min_total'), max_total=optional_float('max_total'),
+            estado=params.get('estado'), moneda=params.get('moneda'),
+            page=int(params.get('page') or 1), page_size=int(params.get('page_size') or 20))
+        return jsonify({"ok": True, "results": results, "page": int(params.get('page') or 1), "has_more": has_more})
+    except (ValueError, TypeError) as e:
+        return jsonify({"ok": False, "error": f"Parámetros de búsqueda inválidos: {e}"}), 400
+    except Exception as e:
+        return jsonify({"ok": False, "error": f"Error interno: {str(e)}"}), 500
 
 if __name__ == '__main__':
     app.run(debug=True, port=int(os.environ.get("PORT", 5000)))
\ No newline at end of file
@@ -0,0 +1,88 @@
+import os
+import zipfile
+import posixpath
+import blobstore
+import processing
+import database as db
+
+BATCH_MAX_FILES = int(os.environ.get('BATCH_MAX_FILES', '500'))
+BATCH_MAX_BYTES = int(os.environ.get('BATCH_MAX_BYTES', str(1024 * 1024 * 1024)))
+SNIFF_BYTES = 1024
+
+class BatchError(ValueError):
+    def __init__(self, message: str, rejected=None):
+        super().__init__(message)
+        self.rejected = rejected or []
+
+def _iter_zip_entries(fileobj, archive_name: str):
+    """Entradas de un ZIP una a una: cada fichero se descomprime en streaming al leerlo,
+    el archivo nunca está entero en memoria (solo el directorio central)."""
+    try:
+        archive = zipfile.ZipFile(fileobj)
+    except zipfile.BadZipFile as e:
+        yield archive_name, None, f"ZIP inválido: {e}"; return
+    with archive:
+        for info in archive.infolist():
+            name = info.filename
+            base = posixpath.basename(name.rstrip('/'))
+            if info.is_dir() or name.startswith('__MACOSX/') or base.startswith('.'): continue
+            if info.flag_bits & 0x1:
+                yield name, None, "Entrada cifrada en el ZIP."; continue
+            if info.file_size > blobstore.MAX_UPLOAD_BYTES:
+                yield name, None, "El fichero supera el tamaño máximo permitido."; continue
+            with archive.open(info) as entry:
+                yield name, entry, None
+
+def iter_upload_entries(sources):
+    """Recorre los ficheros subidos (lista de (nombre, stream)) expandiendo los ZIP.
+    Produce (nombre, tipo, stream, error) con el stream ya posicionado tras la detección de tipo."""
+    for name, stream in sources:
+        head = stream.read(SNIFF_BYTES)
+        kind = blobstore.detect_content_type(head)
+        if kind == 'zip':
+            stream.seek(0)
+            for entry_name, entry, error in _iter_zip_entries(stream, name):
+                if error:
+                    yield entry_name, None, None, error; continue
+                entry_head = entry.read(SNIFF_BYTES)
+                entry_kind = blobstore.detect_content_type(entry_head)
+                if not entry_head:
+                    yield entry_name, None, None, "Fichero vacío."
+                elif entry_kind == 'zip':
+                    yield entry_name, None, None, "No se admiten ZIP dentro de ZIP."
+                else:
+                    yield entry_name, entry_kind, blobstore.PrefixedStream(entry_head, entry), None
+        elif not head:
+            yield name, None, None, "Fichero vacío."
+        else:
+            yield name, kind, blobstore.PrefixedStream(head, stream), None
+
+def enqueue_batch(user_id: str, sources):
+    """Guarda cada fichero válido en el almacén de blobs y encola todos sus trabajos en una sola
+    transacción. Los duplicados por contenido se resuelven luego en el worker desde la caché de extracciones.
+    Devuelve (batch_id, trabajos, rechazados)."""
+    store = blobstore.get_store()
+    accepted, rejected, used_bytes = [], [], 0
+    try:
+        for name, kind, stream, error in iter_upload_entries(sources):
+            if error is None and kind is None: error = "Tipo de fichero no soportado (se admiten PDF e imágenes)."
+            if error is None and len(accepted) >= BATCH_MAX_FILES: error = f"El lote supera el máximo de {BATCH_MAX_FILES} ficheros."
+            if error is None and used_bytes >= BATCH_MAX_BYTES: error = "El lote supera el tamaño máximo permitido."
+            if error:
+                rejected.append({'file_name': name, 'error': error}); continue
+            try:
+                blob_ref = store.put_stream(stream, max_bytes=min(blobstore.MAX_UPLOAD_BYTES, BATCH_MAX_BYTES - used_bytes))
+            except blobstore.BlobTooLarge as e:
+                rejected.append({'file_name': name, 'error': str(e)}); continue
+            used_bytes += blob_ref.size
+            accepted.append((blob_ref, kind, name, processing.plan_pdf_shards(blob_ref) if kind == 'pdf' else None))
+        if not accepted: raise BatchError("Ningún fichero del lote se pudo encolar.", rejected)
+        batch_id, job_ids = db.create_job_batch(user_id, accepted, rejected)
+    except BaseException:
+        for blob_ref, _, _, _ in accepted:
+            try: store.delete(blob_ref.key)
+            except Exception as e: print(f"⚠️ No se pudo borrar el blob {blob_ref.key}: {e}")
+        raise
+    jobs = [{'job_id': job_id, 'file_name': name, 'type': kind, 'shards': len(page_ranges) if page_ranges else None}
+            for job_id, (_, kind, name, page_ranges) in zip(job_ids, accepted)]
+    return batch_id, jobs, rejected
@@ -0,0 +1,130 @@
+import os
+import re
+import sys
+import json
+import math
+import time
+import platform
+from concurrent.futures import ThreadPoolExecutor
+
+BASELINE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baselines')
+# Métricas que se comparan con la línea base y en qué sentido empeoran
+COMPARED_METRICS = {'p50_ms': 'higher', 'p95_ms': 'higher', 'p99_ms': 'higher', 'throughput_rps': 'lower', 'queries_per_request': 'higher'}
+_QUERIES_RE = re.compile(r'sql;dur=[\d.]+;desc="(\d+) queries"')
+
+def configure(database_url: str):
+    """Debe llamarse antes de importar app: el benchmark nunca usa la DATABASE_URL del entorno por accidente."""
+    if not database_url: sys.exit("Falta --database-url (o BENCH_DATABASE_URL): el benchmark escribe datos y necesita una base de datos propia.")
+    os.environ['DATABASE_URL'] = database_url
+    os.environ['DB_AUTO_MIGRATE'] = '1'
+    os.environ.pop('FIREBASE_ADMIN_SDK_JSON', None)
+
+def percentile(sorted_values, p: float):
+    """Rango más cercano: el menor valor que deja por debajo (o igual) al menos el p% de las muestras."""
+    if not sorted_values: return 0.0
+    index = max(0, min(len(sorted_values) - 1, math.ceil(round(p / 100.0 * len(sorted_values), 9)) - 1))
+    return sorted_values[index]
+
+def summarize(name: str, latencies, queries, errors: int, elapsed: float, **extra):
+    latencies = sorted(latencies)
+    result = {
+        'name': name, 'requests': len(latencies), 'errors': errors, 'elapsed_s': round(elapsed, 3),
+        'throughput_rps': round(len(latencies) / elapsed, 2) if elapsed else 0.0,
+        'mean_ms': round(sum(latencies) / len(latencies) * 1000, 2) if latencies else 0.0,
+        'p50_ms': round(percentile(latencies, 50) * 1000, 2), 'p95_ms': round(percentile(latencies, 95) * 1000, 2),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 2),
+        'queries_per_request': round(sum(queries) / len(queries), 2) if queries else None,
+        'max_queries': max(queries) if queries else None,
+    }
+    result.update(extra)
+    return result
+
+class Bench:
+    """La app Flask en proceso (test client) contra Postgres local, con Firebase, Gemini y Cloudinary
+    sustituidos por fakes deterministas con latencia configurable."""
+
+    def __init__(self, model_latency: float = 0.0, upload_latency: float = 0.0, verify_latency: float = 0.0, model_rpm: float = None):
+        import app as appmod
+        import model_client
+        import identity
+        import processing
+        import fakes
+        import cloudinary.uploader
+        self.app, self.processing = appmod.app, processing
+        self.verifier = fakes.FakeVerifier(verify_latency)
+        self.model = fakes.FakeModel(latency=model_latency)
+        self.uploader = fakes.FakeUploader(latency=upload_latency)
+        identity.set_token_verifier(self.verifier)
+        processing.gemini_model = self.model
+        if model_rpm:
+            # Sin esto el token bucket de producción (MODEL_REQUESTS_PER_MINUTE) marca el ritmo y no la aplicación
+            client = processing.gemini_client
+            client.request_bucket = model_client.TokenBucket(model_rpm / 60.0, max(1.0, model_rpm / 60.0 * 10))
+            client.token_bucket = model_client.TokenBucket(float('inf'), float('inf'))
+        cloudinary.uploader.upload, cloudinary.uploader.destroy = self.uploader.upload, self.uploader.destroy
+        self.client = self.app.test_client()
+        self.config = {'model_latency': model_latency, 'upload_latency': upload_latency, 'verify_latency': verify_latency, 'model_rpm': model_rpm}
+
+    @staticmethod
+    def headers(user_id: str):
+        return {'Authorization': f"Bearer {user_id}"}
+
+    def measure(self, name: str, call, requests: int, concurrency: int = 1, warmup: int = 3, **extra):
+        """Ejecuta `call(i)` (devuelve una respuesta del test client) `requests` veces con `concurrency` hilos.
+        Las consultas por petición salen de la cabecera Server-Timing."""
+        for i in range(min(warmup, requests)): call(i)
+        latencies, queries, errors = [], [], 0
+
+        def one(i):
+            started = time.perf_counter()
+            response = call(i)
+            elapsed = time.perf_counter() - started
+            match = _QUERIES_RE.search(response.headers.get('Server-Timing', ''))
+            response.close()
+            return elapsed, int(match.group(1)) if match else 0, response.status_code >= 400
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=max(1, concurrency)) as pool:
+            for elapsed, n_queries, failed in pool.map(one, range(requests)):
+                latencies.append(elapsed); queries.append(n_queries); errors += failed
+        result = summarize(name, latencies, queries, errors, time.perf_counter() - started, concurrency=concurrency, **extra)
+        print_result(result)
+        return result
+
+def print_result(result: dict):
+    queries = f", {result['queries_per_request']} consultas/petición" if result.get('queries_per_request') is not None else ''
+    errors = f", {result['errors']} errores" if result.get('errors') else ''
+    print(f"📊 {result['name']}: {result['requests']} en {result['elapsed_s']}s ({result['throughput_rps']}/s) "
+          f"p50={result['p50_ms']}ms p95={result['p95_ms']}ms p99={result['p99_ms']}ms{queries}{errors}")
+
+def environment():
+    return {'python': platform.python_version(), 'platform': platform.platform(), 'cpus': os.cpu_count()}
+
+def save_baseline(name: str, results, config: dict):
+    os.makedirs(BASELINE_DIR, exist_ok=True)
+    path = os.path.join(BASELINE_DIR, f"{name}.json")
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump({'created_at': time.strftime('%Y-%m-%dT%H:%M:%S'), 'environment': environment(), 'config': config,
+                   'results': {r['name']: r for r in results}}, f, indent=2, ensure_ascii=False)
+    print(f"💾 Línea base guardada en {path}")
+
+def compare_baseline(name: str, results, tolerance: float):
+    """Compara con una línea base guardada. Devuelve las regresiones que superan `tolerance` (0.2 = 20%)."""
+    path = os.path.join(BASELINE_DIR, f"{name}.json")
+    with open(path, encoding='utf-8') as f: baseline = json.load(f)
+    if baseline.get('environment') != environment(): print("⚠️ La línea base se tomó en otro entorno: compara con cautela.")
+    regressions = []
+    for result in results:
+        before = baseline['results'].get(result['name'])
+        if not before:
+            print(f"   {result['name']}: sin línea base"); continue
+        for metric, worse in COMPARED_METRICS.items():
+            old, new = before.get(metric), result.get(metric)
+            if not old or new is None: continue
+            change = (new - old) / old
+            marker = ''
+            if (change > tolerance if worse == 'higher' else change < -tolerance):
+                marker = ' ❌'
+                regressions.append(f"{result['name']} {metric}: {old} -> {new} ({change:+.0%})")
+            print(f"   {result['name']} {metric}: {old} -> {new} ({change:+.0%}){marker}")
+    return regressions
@@ -0,0 +1,56 @@
+import os
+import sys
+import time
+import argparse
+from bench import harness
+
+SCENARIOS = ('list_invoices', 'job_status', 'queue_drain', 'ai_query')
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks de la API contra Postgres local con Firebase, Gemini y Cloudinary simulados.")
+    parser.add_argument('--database-url', default=os.environ.get('BENCH_DATABASE_URL'), help="Base de datos desechable (por defecto BENCH_DATABASE_URL).")
+    parser.add_argument('--scenario', action='append', choices=SCENARIOS, help="Escenario a ejecutar (repetible; por defecto todos).")
+    parser.add_argument('--rows', default='10,1000,50000', help="Tamaños de la lista de facturas, separados por comas.")
+    parser.add_argument('--ai-rows', type=int, default=5000, help="Facturas del usuario en el escenario ai_query.")
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--jobs', type=int, default=40, help="Documentos de los escenarios job_status y queue_drain.")
+    parser.add_argument('--model-latency', type=float, default=0.5)
+    parser.add_argument('--upload-latency', type=float, default=0.2)
+    parser.add_argument('--verify-latency', type=float, default=0.05)
+    parser.add_argument('--model-rpm', type=float, default=100000,
+                        help="Límite de peticiones por minuto del cliente del modelo durante el benchmark (0 = el de producción).")
+    parser.add_argument('--save', metavar='NOMBRE', help="Guarda los resultados como línea base en bench/baselines/NOMBRE.json.")
+    parser.add_argument('--compare', metavar='NOMBRE', help="Compara con bench/baselines/NOMBRE.json y termina con error si hay regresiones.")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="Empeoramiento admitido frente a la línea base (0.2 = 20%%).")
+    args = parser.parse_args()
+
+    harness.configure(args.database_url)
+    from bench import scenarios  # Importa la app: solo después de fijar DATABASE_URL
+
+    bench = harness.Bench(args.model_latency, args.upload_latency, args.verify_latency, args.model_rpm)
+    run_id = time.strftime('%Y%m%d%H%M%S')
+    selected = args.scenario or SCENARIOS
+    results = []
+    if 'list_invoices' in selected:
+        results += scenarios.list_invoices(bench, [int(r) for r in args.rows.split(',') if r.strip()], args.requests, args.concurrency)
+    if 'job_status' in selected:
+        results += scenarios.job_status(bench, args.jobs, args.requests, args.concurrency, run_id)
+    if 'queue_drain' in selected:
+        results += scenarios.queue_drain(bench, args.jobs, args.concurrency, run_id)
+    if 'ai_query' in selected:
+        results += scenarios.ai_query(bench, args.ai_rows, max(10, args.requests // 4), args.concurrency)
+
+    config = dict(bench.config, scenarios=list(selected), rows=args.rows, ai_rows=args.ai_rows, requests=args.requests,
+                  concurrency=args.concurrency, jobs=args.jobs)
+    if args.save: harness.save_baseline(args.save, results, config)
+    if args.compare:
+        regressions = harness.compare_baseline(args.compare, results, args.tolerance)
+        if regressions:
+            print(f"❌ {len(regressions)} regresiones frente a '{args.compare}':")
+            for line in regressions: print(f"   {line}")
+            sys.exit(1)
+        print(f"✅ Sin regresiones frente a '{args.compare}'.")
+
+if __name__ == '__main__':
+    main()
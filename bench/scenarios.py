@@ -0,0 +1,148 @@
+import io
+import time
+import random
+from PIL import Image, ImageDraw
+import database as db
+import metrics
+import worker
+import processing
+from bench.harness import summarize, print_result
+
+SUPPLIERS = ['Iberdrola', 'Endesa', 'Movistar', 'Vodafone', 'Amazon Business', 'Mercadona', 'Repsol', 'Renfe',
+             'Securitas Direct', 'Makro', 'Leroy Merlin', 'Canal de Isabel II', 'Mapfre', 'Correos', 'Google Ireland']
+CONCEPTS = ['Suministro eléctrico', 'Cuota mensual', 'Material de oficina', 'Transporte', 'Mantenimiento', 'Seguro', 'Licencia software']
+SQL_QUESTION = "¿Cuánto he gastado en total en 2024?"
+MODEL_QUESTION = "¿Hay alguna factura que parezca un cargo duplicado o un error?"
+
+def make_invoices(rows: int, seed: int = 42):
+    """Facturas sintéticas deterministas (misma semilla, mismos datos) repartidas entre 2023 y 2025."""
+    rng = random.Random(seed)
+    invoices = []
+    for i in range(rows):
+        base = round(rng.uniform(5, 2500), 2)
+        conceptos = [{"descripcion": rng.choice(CONCEPTS), "cantidad": float(rng.randint(1, 5)), "precio_unitario": round(rng.uniform(1, 500), 2)}
+                     for _ in range(rng.randint(1, 4))]
+        invoices.append({
+            "emisor": rng.choice(SUPPLIERS), "cif": f"B{rng.randint(10000000, 99999999)}",
+            "fecha": f"{rng.randint(1, 28):02d}/{rng.randint(1, 12):02d}/{rng.choice((2023, 2024, 2025))}",
+            "total": round(base * 1.21, 2), "base_imponible": base, "estado": rng.choice(("Pendiente", "Pagada")),
+            "moneda": "€" if rng.random() < 0.9 else "$", "conceptos": conceptos,
+        })
+    return invoices
+
+def activate_user(user_id: str):
+    db.get_or_create_user(user_id, f"{user_id}@bench.local")
+    with db.db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute("UPDATE users SET subscription_status = 'active' WHERE firebase_uid = %s", (user_id,))
+        conn.commit(); cur.close()
+
+def seed_invoices(user_id: str, rows: int):
+    """Deja exactamente `rows` facturas sintéticas al usuario. Si ya las tiene de una ejecución anterior no las
+    vuelve a crear: sembrar 50k facturas cuesta más que el propio escenario."""
+    activate_user(user_id)
+    with db.db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT COUNT(*) FROM facturas WHERE user_id = %s", (user_id,))
+        if cur.fetchone()[0] == rows:
+            cur.close(); return
+        cur.execute("DELETE FROM facturas WHERE user_id = %s", (user_id,))
+        conn.commit(); cur.close()
+    print(f"🌱 Sembrando {rows} facturas para {user_id}...")
+    started = time.perf_counter()
+    db.add_invoices_bulk(make_invoices(rows), 'bench', user_id)
+    db.rebuild_invoice_stats(user_id)
+    print(f"🌱 Sembradas en {time.perf_counter() - started:.1f}s")
+
+def sample_document(i: int):
+    """Documento determinista: PDF (escaneado, sin capa de texto) en los pares y JPEG en los impares. Devuelve (tipo, bytes)."""
+    img = Image.new('RGB', (850, 1100), (255, 255, 255))
+    draw = ImageDraw.Draw(img)
+    draw.text((60, 60), f"FACTURA {i:05d}", fill=(0, 0, 0))
+    for line in range(20): draw.text((60, 120 + line * 40), f"{CONCEPTS[(i + line) % len(CONCEPTS)]}  {((i * 37 + line * 11) % 900) / 7:.2f} EUR", fill=(30, 30, 30))
+    buf = io.BytesIO()
+    if i % 2 == 0:
+        img.save(buf, 'PDF'); return 'pdf', buf.getvalue()
+    img.save(buf, 'JPEG', quality=85); return 'image', buf.getvalue()
+
+def upload_documents(bench, user_id: str, count: int, name: str):
+    """Sube `count` documentos por los endpoints reales. Devuelve (job_ids, resultado de la subida)."""
+    documents = [sample_document(i) for i in range(count)]
+    job_ids = []
+
+    def upload(i):
+        job_type, data = documents[i]
+        response = bench.client.post('/api/upload_pdf' if job_type == 'pdf' else '/api/process_invoice', data=data, headers=bench.headers(user_id))
+        job_ids.append(response.get_json().get('job_id'))
+        return response
+
+    result = bench.measure(name, upload, count, warmup=0)
+    return job_ids, result
+
+def drain_queue(job_ids, user_id: str, concurrency: int, time_budget: float = 600):
+    """Vacía la cola con worker.run_batch hasta que todos los trabajos terminan. Devuelve (segundos, estados)."""
+    started = time.perf_counter()
+    pending = set(job_ids)
+    statuses = {}
+    while pending and time.perf_counter() - started < time_budget:
+        summary = worker.run_batch(batch_size=max(len(pending), concurrency), concurrency=concurrency, time_budget=time_budget)
+        for job_id in list(pending):
+            status = db.get_job_status(job_id, user_id)
+            if status and status['status'] in ('completed', 'failed'):
+                statuses[job_id] = status; pending.discard(job_id)
+        if pending and not summary['claimed']: time.sleep(0.2)
+    still_archiving = processing.wait_for_archival(time_budget)
+    if still_archiving: print(f"⚠️ {still_archiving} archivados siguen en curso")
+    return time.perf_counter() - started, statuses
+
+def list_invoices(bench, rows_list, requests: int, concurrency: int):
+    results = []
+    for rows in rows_list:
+        user_id = f"bench-list-{rows}"
+        seed_invoices(user_id, rows)
+        headers = bench.headers(user_id)
+        # La lista completa de 50k filas es lenta a propósito: menos repeticiones para no eternizar la ejecución
+        full_requests = requests if rows <= 1000 else max(10, requests // 10)
+        results.append(bench.measure(f"list_invoices.{rows}.full", lambda i: bench.client.get('/api/invoices', headers=headers),
+                                     full_requests, concurrency, rows=rows))
+        results.append(bench.measure(f"list_invoices.{rows}.page", lambda i: bench.client.get('/api/invoices?limit=100', headers=headers),
+                                     requests, concurrency, rows=rows))
+    return results
+
+def job_status(bench, jobs: int, requests: int, concurrency: int, run_id: str):
+    user_id = f"bench-status-{run_id}"
+    activate_user(user_id)
+    job_ids, upload = upload_documents(bench, user_id, jobs, 'job_status.upload')
+    headers = bench.headers(user_id)
+    poll = lambda i: bench.client.get(f"/api/job_status/{job_ids[i % len(job_ids)]}", headers=headers)
+    results = [upload, bench.measure('job_status.pending', poll, requests, concurrency)]
+    drain_queue(job_ids, user_id, concurrency)
+    results.append(bench.measure('job_status.completed', poll, requests, concurrency))
+    return results
+
+def queue_drain(bench, jobs: int, concurrency: int, run_id: str):
+    """N documentos mezclados (PDF e imágenes) de un usuario nuevo, procesados por el worker con los fakes."""
+    user_id = f"bench-drain-{run_id}"
+    activate_user(user_id)
+    job_ids, upload = upload_documents(bench, user_id, jobs, 'queue_drain.upload')
+    queries_before = metrics.total_count('app_db_query_duration_seconds')
+    elapsed, statuses = drain_queue(job_ids, user_id, concurrency)
+    queries = metrics.total_count('app_db_query_duration_seconds') - queries_before
+    # Latencia por trabajo: la que mide el propio worker en processing_report (de la lectura al guardado)
+    latencies = [(s.get('processing_report') or {}).get('stages', {}).get('total', {}).get('ms', 0) / 1000.0 for s in statuses.values()]
+    failed = sum(1 for s in statuses.values() if s['status'] == 'failed') + len(job_ids) - len(statuses)
+    result = summarize('queue_drain', latencies, [], failed, elapsed, concurrency=concurrency, jobs=len(job_ids),
+                       queries_per_request=round(queries / len(job_ids), 2) if job_ids else None)
+    print_result(result)
+    return [upload, result]
+
+def ai_query(bench, rows: int, requests: int, concurrency: int):
+    user_id = f"bench-ai-{rows}"
+    seed_invoices(user_id, rows)
+    headers = bench.headers(user_id)
+    return [
+        bench.measure('ai_query.sql', lambda i: bench.client.post('/api/ai/query', json={'query': SQL_QUESTION}, headers=headers),
+                      requests, concurrency, rows=rows),
+        bench.measure('ai_query.model', lambda i: bench.client.post('/api/ai/query', json={'query': MODEL_QUESTION}, headers=headers),
+                      requests, concurrency, rows=rows),
+    ]
@@ -0,0 +1,254 @@
+import os
+import io
+import mmap
+import uuid
+import hashlib
+import tempfile
+from abc import ABC, abstractmethod
+from collections import namedtuple
+import database as db
+
+# 'local' (spool en disco, por defecto), 's3' (object store compatible con S3) o 'postgres' (large objects: siguen
+# pasando por el WAL y hacen crecer la base de datos con los ficheros subidos; solo si se pide o en Vercel sin configurar)
+BLOB_STORE = os.environ.get('BLOB_STORE', '').lower()
+BLOB_STORE_DIR = os.environ.get('BLOB_STORE_DIR')
+BLOB_STORE_BUCKET = os.environ.get('BLOB_STORE_BUCKET')
+BLOB_STORE_PREFIX = os.environ.get('BLOB_STORE_PREFIX', 'blobs/')
+BLOB_STORE_ENDPOINT_URL = os.environ.get('BLOB_STORE_ENDPOINT_URL')  # R2, MinIO...
+MAX_UPLOAD_BYTES = int(os.environ.get('MAX_UPLOAD_BYTES', str(25 * 1024 * 1024)))
+UPLOAD_CHUNK_SIZE = 64 * 1024
+
+BlobRef = namedtuple('BlobRef', ['key', 'content_hash', 'size'])
+
+class BlobTooLarge(ValueError):
+    pass
+
+class _ViewStream(io.RawIOBase):
+    """Fichero de solo lectura sobre un memoryview: cada consumidor tiene su propia posición sin copiar el payload."""
+
+    def __init__(self, view: memoryview):
+        self._view, self._pos = view, 0
+
+    def readable(self): return True
+    def seekable(self): return True
+    def tell(self): return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR: offset += self._pos
+        elif whence == io.SEEK_END: offset += len(self._view)
+        self._pos = max(0, offset)
+        return self._pos
+
+    def readinto(self, buffer):
+        chunk = self._view[self._pos:self._pos + len(buffer)]
+        n = len(chunk)
+        buffer[:n] = chunk
+        self._pos += n
+        return n
+
+    def close(self):
+        self._view = memoryview(b'')
+        super().close()
+
+class Payload:
+    """Contenido de un trabajo leído una sola vez y compartido por PdfReader, PIL y la subida a Cloudinary."""
+
+    def __init__(self, view: memoryview, on_close=None):
+        self.view, self._on_close = view, on_close
+
+    def __len__(self): return len(self.view)
+
+    def stream(self):
+        return _ViewStream(self.view)
+
+    def close(self):
+        self.view.release()
+        if self._on_close:
+            try: self._on_close()
+            except BufferError: pass  # Aún queda algún objeto (p.ej. una imagen PIL) referenciando el mmap
+
+    def __enter__(self): return self
+    def __exit__(self, *exc): self.close()
+
+def _copy_limited(stream, write, max_bytes: int):
+    hasher, size = hashlib.sha256(), 0
+    while True:
+        chunk = stream.read(UPLOAD_CHUNK_SIZE)
+        if not chunk: break
+        size += len(chunk)
+        if size > max_bytes: raise BlobTooLarge(f"El fichero supera el máximo permitido ({max_bytes} bytes).")
+        hasher.update(chunk)
+        write(chunk)
+    return hasher.hexdigest(), size
+
+def spool_stream(stream, max_bytes: int):
+    """Vuelca un stream a un fichero temporal (en disco, no en memoria) para poder leerlo con seek, p.ej. un ZIP."""
+    spooled = tempfile.TemporaryFile()
+    try:
+        _copy_limited(stream, spooled.write, max_bytes)
+    except BaseException:
+        spooled.close(); raise
+    spooled.seek(0)
+    return spooled
+
+class PrefixedStream(io.RawIOBase):
+    """Devuelve primero `head` (bytes ya leídos para detectar el tipo) y después el resto de `stream`."""
+
+    def __init__(self, head: bytes, stream):
+        self._head, self._stream = head, stream
+
+    def readable(self): return True
+
+    def read(self, size=-1):
+        if self._head:
+            if size is None or size < 0:
+                data, self._head = self._head + self._stream.read(), b''
+                return data
+            data, self._head = self._head[:size], self._head[size:]
+            return data
+        return self._stream.read(size)
+
+# Firmas de inicio de fichero: el tipo se decide por el contenido, no por la extensión ni el Content-Type
+_IMAGE_SIGNATURES = (b'\xff\xd8\xff', b'\x89PNG\r\n\x1a\n', b'GIF87a', b'GIF89a', b'II*\x00', b'MM\x00*', b'BM')
+
+def detect_content_type(head: bytes):
+    """'pdf', 'image', 'zip' o None a partir de los primeros bytes."""
+    if head.startswith(b'PK\x03\x04'): return 'zip'
+    # La especificación permite basura antes de la cabecera %PDF- dentro del primer KiB
+    if b'%PDF-' in head[:1024]: return 'pdf'
+    if head.startswith(_IMAGE_SIGNATURES): return 'image'
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP': return 'image'
+    return None
+
+class BlobStore(ABC):
+    """Interfaz compatible con un object store: put por streaming, lectura completa y borrado por clave."""
+
+    @abstractmethod
+    def put_stream(self, stream, max_bytes: int = MAX_UPLOAD_BYTES) -> BlobRef: ...
+
+    @abstractmethod
+    def open(self, key: str) -> Payload: ...
+
+    @abstractmethod
+    def delete(self, key: str): ...
+
+class LocalBlobStore(BlobStore):
+    """Directorio de spool local (o volumen compartido entre la API y `python -m worker`)."""
+
+    def __init__(self, root: str):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.root, key[:2], key)
+
+    def put_stream(self, stream, max_bytes: int = MAX_UPLOAD_BYTES) -> BlobRef:
+        key = uuid.uuid4().hex
+        path = self._path(key); tmp_path = path + '.part'
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        try:
+            with open(tmp_path, 'wb') as f:
+                content_hash, size = _copy_limited(stream, f.write, max_bytes)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path): os.remove(tmp_path)
+            raise
+        return BlobRef(key, content_hash, size)
+
+    def open(self, key: str) -> Payload:
+        with open(self._path(key), 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0: return Payload(memoryview(b''))
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return Payload(memoryview(mm), on_close=mm.close)
+
+    def delete(self, key: str):
+        try: os.remove(self._path(key))
+        except FileNotFoundError: pass
+
+class S3BlobStore(BlobStore):
+    """Object store compatible con S3 (AWS S3, Cloudflare R2, MinIO...). Para Vercel, donde /tmp no se comparte
+    entre la función que recibe la subida y la del cron. boto3 (en requirements.txt) solo se importa si se usa este almacén."""
+
+    def __init__(self, bucket: str, prefix: str = '', endpoint_url: str = None):
+        import boto3
+        self.bucket, self.prefix = bucket, prefix
+        self.client = boto3.client('s3', endpoint_url=endpoint_url or None)
+
+    def _key(self, key):
+        return f"{self.prefix}{key}"
+
+    def put_stream(self, stream, max_bytes: int = MAX_UPLOAD_BYTES) -> BlobRef:
+        # El límite y el hash se comprueban antes de subir nada: el fichero pasa por un temporal (en memoria si es pequeño)
+        key = uuid.uuid4().hex
+        with tempfile.SpooledTemporaryFile(max_size=8 * 1024 * 1024) as spooled:
+            content_hash, size = _copy_limited(stream, spooled.write, max_bytes)
+            spooled.seek(0)
+            self.client.upload_fileobj(spooled, self.bucket, self._key(key))
+        return BlobRef(key, content_hash, size)
+
+    def open(self, key: str) -> Payload:
+        body = self.client.get_object(Bucket=self.bucket, Key=self._key(key))['Body']
+        try: data = body.read()
+        finally: body.close()
+        return Payload(memoryview(data))
+
+    def delete(self, key: str):
+        self.client.delete_object(Bucket=self.bucket, Key=self._key(key))
+
+class PostgresBlobStore(BlobStore):
+    """Large objects de PostgreSQL: se escriben por trozos y quedan fuera de la fila de job_queue (y fuera de su
+    TOAST), pero siguen en el WAL y en el tamaño de la base de datos. Con BLOB_STORE=postgres, o en Vercel si no
+    se configuró ningún almacén (para no romper las subidas de un despliegue sin variables nuevas)."""
+
+    def put_stream(self, stream, max_bytes: int = MAX_UPLOAD_BYTES) -> BlobRef:
+        with db.db_connection() as conn:
+            lobj = conn.lobject(0, 'wb')
+            content_hash, size = _copy_limited(stream, lobj.write, max_bytes)
+            key = str(lobj.oid); lobj.close()
+            conn.commit()
+        return BlobRef(key, content_hash, size)
+
+    def open(self, key: str) -> Payload:
+        with db.db_connection() as conn:
+            lobj = conn.lobject(int(key), 'rb')
+            data = lobj.read(); lobj.close()
+            conn.commit()
+        return Payload(memoryview(data))
+
+    def delete(self, key: str):
+        with db.db_connection() as conn:
+            cur = conn.cursor()
+            cur.execute("SELECT lo_unlink(%s) FROM pg_largeobject_metadata WHERE oid = %s", (int(key), int(key)))
+            conn.commit(); cur.close()
+
+_store = None
+
+def _create_store() -> BlobStore:
+    if BLOB_STORE == 'postgres': return PostgresBlobStore()
+    if BLOB_STORE == 's3':
+        if not BLOB_STORE_BUCKET: raise RuntimeError("BLOB_STORE=s3 necesita BLOB_STORE_BUCKET.")
+        return S3BlobStore(BLOB_STORE_BUCKET, BLOB_STORE_PREFIX, BLOB_STORE_ENDPOINT_URL)
+    if BLOB_STORE not in ('', 'local'): raise RuntimeError(f"BLOB_STORE desconocido: {BLOB_STORE!r} (local, s3 o postgres).")
+    if not BLOB_STORE and not BLOB_STORE_DIR and os.environ.get('VERCEL'):
+        # El /tmp de la función que recibe la subida no lo ve la del cron: sin configuración, Vercel sigue con Postgres
+        print("⚠️ Vercel sin BLOB_STORE: los ficheros subidos se guardan en Postgres (large objects). Configura BLOB_STORE=s3.")
+        return PostgresBlobStore()
+    if BLOB_STORE == 'local' and not BLOB_STORE_DIR and os.environ.get('VERCEL'):
+        raise RuntimeError("En Vercel el spool local no se comparte entre funciones: configura BLOB_STORE_DIR en un volumen compartido o BLOB_STORE=s3.")
+    return LocalBlobStore(BLOB_STORE_DIR or os.path.join(tempfile.gettempdir(), 'facturas-blobs'))
+
+def get_store() -> BlobStore:
+    global _store
+    if _store is None: _store = _create_store()
+    return _store
+
+def store_for(key: str) -> BlobStore:
+    """Almacén que guarda `key`. Los large objects (claves numéricas) que quedaron de cuando Postgres era el
+    almacén por defecto se siguen leyendo y borrando desde Postgres."""
+    if key.isdigit() and not isinstance(get_store(), PostgresBlobStore): return PostgresBlobStore()
+    return get_store()
+
+def open_job_payload(job: dict) -> Payload:
+    if job.get('blob_key'): return store_for(job['blob_key']).open(job['blob_key'])
+    # Trabajos encolados antes del almacén de blobs: el contenido sigue en job_queue.file_data
+    return Payload(memoryview(job.get('file_data') or b''))
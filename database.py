@@ -1,64 +1,461 @@
 import os
+import time
+import threading
 import psycopg2
 import psycopg2.extras
+import psycopg2.extensions
+import psycopg2.errors
+import re
 import json
 import uuid
+from collections import deque
+from contextlib import contextmanager
 from datetime import datetime, timedelta
+import metrics
+
+# --- Pool de conexiones (configurable por entorno) ---
+DB_POOL_MIN = int(os.environ.get('DB_POOL_MIN', '0'))
+DB_POOL_MAX = int(os.environ.get('DB_POOL_MAX', '5'))
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', '10'))
+DB_CONN_MAX_USES = int(os.environ.get('DB_CONN_MAX_USES', '500'))
+DB_CONN_MAX_AGE = float(os.environ.get('DB_CONN_MAX_AGE', '300'))
+DB_CONN_VALIDATE_IDLE = float(os.environ.get('DB_CONN_VALIDATE_IDLE', '30'))
+
+class _TimedCursorMixin:
+    """Cuenta y cronometra cada consulta para las métricas (y el Server-Timing de la petición en curso)."""
+
+    def execute(self, query, vars=None):
+        started = time.perf_counter()
+        try: return super().execute(query, vars)
+        finally: metrics.record_query(time.perf_counter() - started)
+
+    def executemany(self, query, vars_list):
+        started = time.perf_counter()
+        try: return super().executemany(query, vars_list)
+        finally: metrics.record_query(time.perf_counter() - started)
+
+_timed_cursor_classes = {}
+
+def _timed_cursor_class(base):
+    cls = _timed_cursor_classes.get(base)
+    if cls is None: cls = _timed_cursor_classes[base] = type(f"Timed{base.__name__}", (_TimedCursorMixin, base), {})
+    return cls
+
+class _InstrumentedConnection(psycopg2.extensions.connection):
+    # Cualquier cursor_factory (DictCursor incluido) se sustituye por su subclase cronometrada
+    def cursor(self, *args, **kwargs):
+        kwargs['cursor_factory'] = _timed_cursor_class(kwargs.get('cursor_factory') or self.cursor_factory or psycopg2.extensions.cursor)
+        return super().cursor(*args, **kwargs)
 
 def get_db_connection():
     conn_string = os.environ.get('DATABASE_URL')
     if not conn_string:
         raise ValueError("No se encontró la variable de entorno DATABASE_URL")
-    conn = psycopg2.connect(conn_string, connect_timeout=10)
+    conn = psycopg2.connect(conn_string, connect_timeout=10, connection_factory=_InstrumentedConnection)
     return conn
 
-def init_db():
-    conn = None
+class PoolError(Exception):
+    pass
+
+class PoolTimeout(PoolError):
+    pass
+
+class _PooledConnection:
+    __slots__ = ('conn', 'created_at', 'last_used_at', 'uses')
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.created_at = self.last_used_at = time.monotonic()
+        self.uses = 0
+
+class ConnectionPool:
+    """Pool acotado de conexiones psycopg2 con validación al sacar y reciclado por usos/edad."""
+
+    def __init__(self, factory, minconn=0, maxconn=5, timeout=10.0, max_uses=500, max_age=300.0, validate_idle=30.0):
+        self._factory = factory
+        self.minconn, self.maxconn, self.timeout = minconn, max(1, maxconn), timeout
+        self.max_uses, self.max_age, self.validate_idle = max_uses, max_age, validate_idle
+        self._idle = deque()
+        self._in_use = {}
+        self._size = 0
+        self._cond = threading.Condition()
+        self._closed = False
+        self.pid = os.getpid()
+        self.stats = {'checkouts': 0, 'waits': 0, 'wait_timeouts': 0, 'new_connections': 0,
+                      'recycled': 0, 'failed_validations': 0, 'discarded': 0}
+        for _ in range(min(self.minconn, self.maxconn)):
+            self._idle.append(self._new_connection())
+
+    def _new_connection(self):
+        entry = _PooledConnection(self._factory())
+        self._size += 1
+        self.stats['new_connections'] += 1
+        return entry
+
+    def _expired(self, entry):
+        return entry.uses >= self.max_uses or time.monotonic() - entry.created_at >= self.max_age
+
+    def _discard(self, entry, stat='discarded'):
+        self._size -= 1
+        self.stats[stat] += 1
+        try: entry.conn.close()
+        except Exception: pass
+
+    def _is_healthy(self, entry):
+        conn = entry.conn
+        if conn.closed: return False
+        if time.monotonic() - entry.last_used_at < self.validate_idle: return True
+        try:
+            cur = conn.cursor(); cur.execute('SELECT 1'); cur.close(); conn.rollback()
+            return True
+        except Exception:
+            return False
+
+    def getconn(self):
+        deadline = time.monotonic() + self.timeout
+        waited = False
+        with self._cond:
+            self.stats['checkouts'] += 1
+        while True:
+            entry = None
+            with self._cond:
+                while True:
+                    if self._closed: raise PoolError("El pool de conexiones está cerrado")
+                    if self._idle:
+                        entry = self._idle.pop(); break
+                    if self._size < self.maxconn:
+                        # Reservamos el hueco antes de conectar para no sobrepasar maxconn
+                        self._size += 1; break
+                    if not waited:
+                        self.stats['waits'] += 1; waited = True
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self.stats['wait_timeouts'] += 1
+                        raise PoolTimeout(f"No hay conexiones libres tras {self.timeout}s (max={self.maxconn})")
+                    self._cond.wait(remaining)
+            if entry is None: break
+            # La validación (posible SELECT 1) se hace fuera del lock
+            if self._expired(entry): reason = 'recycled'
+            elif not self._is_healthy(entry): reason = 'failed_validations'
+            else:
+                with self._cond: return self._checkout(entry)
+            with self._cond:
+                self._discard(entry, reason); self._cond.notify()
+        try:
+            conn = self._factory()
+        except Exception:
+            with self._cond:
+                self._size -= 1; self._cond.notify()
+            raise
+        with self._cond:
+            self.stats['new_connections'] += 1
+            return self._checkout(_PooledConnection(conn))
+
+    def _checkout(self, entry):
+        entry.uses += 1
+        self._in_use[id(entry.conn)] = entry
+        return entry.conn
+
+    def putconn(self, conn):
+        with self._cond:
+            entry = self._in_use.pop(id(conn), None)
+            if entry is None: return
+            try:
+                if not conn.closed and conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+            except Exception:
+                pass
+            if self._closed or conn.closed:
+                self._discard(entry)
+            elif self._expired(entry):
+                self._discard(entry, 'recycled')
+            else:
+                entry.last_used_at = time.monotonic()
+                self._idle.append(entry)
+            self._cond.notify()
+
+    def closeall(self):
+        with self._cond:
+            self._closed = True
+            while self._idle: self._discard(self._idle.pop())
+            self._cond.notify_all()
+
+    def snapshot(self):
+        with self._cond:
+            return dict(self.stats, size=self._size, idle=len(self._idle), in_use=len(self._in_use), max=self.maxconn)
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_pool():
+    global _pool
+    # Tras un fork (gunicorn --preload) no se pueden compartir los sockets del padre
+    if _pool is None or _pool.pid != os.getpid():
+        with _pool_lock:
+            if _pool is None or _pool.pid != os.getpid():
+                _pool = ConnectionPool(get_db_connection, DB_POOL_MIN, DB_POOL_MAX, DB_POOL_TIMEOUT,
+                                       DB_CONN_MAX_USES, DB_CONN_MAX_AGE, DB_CONN_VALIDATE_IDLE)
+    return _pool
+
+def pool_stats():
+    return get_pool().snapshot()
+
+@contextmanager
+def db_connection():
+    pool = get_pool()
+    conn = pool.getconn()
     try:
-        conn = get_db_connection()
+        yield conn
+    except Exception:
+        try: conn.rollback()
+        except Exception: pass
+        raise
+    finally:
+        pool.putconn(conn)
+
+# --- Esquema versionado: cada cambio es una migración numerada que se aplica una sola vez con `python manage.py migrate`.
+# El arranque de la app solo lee la versión (una consulta); con DB_AUTO_MIGRATE=1 (desarrollo, benchmarks) también migra.
+SCHEMA_AUTO_MIGRATE = os.environ.get('DB_AUTO_MIGRATE') == '1'
+SCHEMA_LOCK_ID = 740_001  # pg_advisory_lock: dos despliegues simultáneos no migran a la vez
+
+def _migration_001_base_schema(cur):
+    """Todo el esquema anterior al versionado (lo que init_db ejecutaba en cada arranque). Es idempotente,
+    así que también se aplica sin problemas sobre bases de datos creadas por init_db. Solo DDL: rellenar fecha_date,
+    search_text y los resúmenes de una tabla con datos se hace por lotes con manage.py (ver pending_backfills)."""
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS users (
+            id BIGSERIAL PRIMARY KEY,
+            firebase_uid TEXT NOT NULL UNIQUE,
+            email TEXT,
+            trial_start_date TIMESTAMPTZ,
+            trial_end_date TIMESTAMPTZ,
+            subscription_status TEXT DEFAULT 'trial',
+            created_at TIMESTAMPTZ DEFAULT NOW()
+        )
+    """)
+    # --- AÑADIDA: columna moneda TEXT DEFAULT '€' ---
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS facturas (
+            id BIGSERIAL PRIMARY KEY, emisor TEXT, cif TEXT, fecha TEXT, 
+            total REAL, base_imponible REAL, impuestos_json JSONB, 
+            ia_model TEXT, user_id TEXT, created_at TIMESTAMPTZ DEFAULT NOW(),
+            estado TEXT DEFAULT 'Pendiente', notas TEXT,
+            file_info JSONB, moneda TEXT DEFAULT '€'
+        )
+    """)
+    cur.execute('CREATE INDEX IF NOT EXISTS idx_facturas_user_id ON facturas(user_id);')
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS conceptos (
+            id BIGSERIAL PRIMARY KEY, factura_id BIGINT REFERENCES facturas(id) ON DELETE CASCADE, 
+            descripcion TEXT, cantidad REAL, precio_unitario REAL, user_id TEXT
+        )
+    """)
+    # --- AÑADIDOS: índices para leer los conceptos de una factura (y el ON DELETE CASCADE) sin seq scan ---
+    cur.execute('CREATE INDEX IF NOT EXISTS idx_conceptos_factura_id ON conceptos(factura_id);')
+    cur.execute('CREATE INDEX IF NOT EXISTS idx_conceptos_user_id ON conceptos(user_id);')
+    # --- AÑADIDA: fecha real (DATE) parseada desde el texto extraído, para ordenar y paginar por índice ---
+    cur.execute(r"""
+        CREATE OR REPLACE FUNCTION parse_fecha_factura(value TEXT) RETURNS DATE AS $$
+        BEGIN
+            value := btrim(value);
+            IF value ~ '^\d{1,2}[/.-]\d{1,2}[/.-]\d{4}$' THEN
+                RETURN TO_DATE(regexp_replace(value, '[.-]', '/', 'g'), 'DD/MM/YYYY');
+            ELSIF value ~ '^\d{1,2}/\d{1,2}/\d{2}$' THEN
+                RETURN TO_DATE(value, 'DD/MM/YY');
+            ELSIF value ~ '^\d{4}-\d{1,2}-\d{1,2}' THEN
+                RETURN TO_DATE(substring(value from '^\d{4}-\d{1,2}-\d{1,2}'), 'YYYY-MM-DD');
+            END IF;
+            RETURN NULL;
+        EXCEPTION WHEN others THEN
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql IMMUTABLE
+    """)
+    cur.execute('ALTER TABLE facturas ADD COLUMN IF NOT EXISTS fecha_date DATE')
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_facturas_user_fecha ON facturas(user_id, (COALESCE(fecha_date, '-infinity'::date)), id)")
+    cur.execute('CREATE TABLE IF NOT EXISTS user_collection_versions (user_id TEXT PRIMARY KEY, version BIGINT NOT NULL DEFAULT 0)')
+    # --- Búsqueda: texto indexable (emisor, cif, notas y conceptos) con índices full-text y trigram ---
+    cur.execute('ALTER TABLE facturas ADD COLUMN IF NOT EXISTS search_text TEXT')
+    cur.execute(f"CREATE INDEX IF NOT EXISTS idx_facturas_search_fts ON facturas USING GIN ({SQL_SEARCH_TSVECTOR})")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_facturas_user_total ON facturas(user_id, total)")
+    cur.execute("SAVEPOINT trgm")
+    try:
+        cur.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_facturas_search_trgm ON facturas USING GIN (search_text gin_trgm_ops)")
+        cur.execute("RELEASE SAVEPOINT trgm")
+    except psycopg2.Error as e:
+        # Sin permisos para la extensión: la búsqueda sigue funcionando solo con full-text
+        cur.execute("ROLLBACK TO SAVEPOINT trgm")
+        print(f"pg_trgm no disponible, búsqueda por subcadena desactivada: {e}")
+    # --- Resúmenes por usuario (mes x moneda x estado y por proveedor), mantenidos en cada escritura ---
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS user_invoice_stats (
+            user_id TEXT NOT NULL, mes TEXT NOT NULL, moneda TEXT NOT NULL, estado TEXT NOT NULL,
+            facturas INTEGER NOT NULL DEFAULT 0, total DOUBLE PRECISION NOT NULL DEFAULT 0,
+            base_imponible DOUBLE PRECISION NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, mes, moneda, estado)
+        )
+    """)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS user_supplier_stats (
+            user_id TEXT NOT NULL, emisor TEXT NOT NULL, moneda TEXT NOT NULL,
+            facturas INTEGER NOT NULL DEFAULT 0, total DOUBLE PRECISION NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, emisor, moneda)
+        )
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_user_supplier_stats_total ON user_supplier_stats(user_id, total DESC)")
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS job_queue (
+            id UUID PRIMARY KEY, type TEXT NOT NULL, status TEXT NOT NULL,
+            created_at TIMESTAMPTZ DEFAULT NOW(), user_id TEXT, file_data BYTEA,
+            result_json JSONB, error_message TEXT,
+            lease_expires_at TIMESTAMPTZ, attempts INTEGER NOT NULL DEFAULT 0
+        )
+    """)
+    # --- AÑADIDO: el contenido vive en el almacén de blobs; la fila guarda solo la referencia y el hash ---
+    cur.execute("ALTER TABLE job_queue ADD COLUMN IF NOT EXISTS blob_key TEXT")
+    cur.execute("ALTER TABLE job_queue ADD COLUMN IF NOT EXISTS content_hash TEXT")
+    cur.execute("ALTER TABLE job_queue ADD COLUMN IF NOT EXISTS size_bytes BIGINT")
+    # Índices parciales: solo contienen los trabajos vivos, así que no crecen con el histórico
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_job_queue_pending ON job_queue(created_at) WHERE status = 'pending';")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_job_queue_leases ON job_queue(lease_expires_at) WHERE status = 'processing';")
+    # --- Caché de extracciones por contenido (misma factura subida varias veces) ---
+    cur.execute("ALTER TABLE job_queue ADD COLUMN IF NOT EXISTS duplicate BOOLEAN NOT NULL DEFAULT FALSE")
+    cur.execute("ALTER TABLE job_queue ADD COLUMN IF NOT EXISTS processing_report JSONB")
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS extraction_cache (
+            user_id TEXT NOT NULL, content_hash TEXT NOT NULL, prompt_version TEXT NOT NULL, model_name TEXT NOT NULL,
+            result_json JSONB NOT NULL, file_info JSONB, created_at TIMESTAMPTZ DEFAULT NOW(),
+            hits INTEGER NOT NULL DEFAULT 0, last_hit_at TIMESTAMPTZ,
+            PRIMARY KEY (user_id, content_hash, prompt_version, model_name)
+        )
+    """)
+    # --- Lotes de subida (multipart o ZIP): muchos trabajos encolados en una sola transacción ---
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS job_batches (
+            id UUID PRIMARY KEY, user_id TEXT NOT NULL, created_at TIMESTAMPTZ DEFAULT NOW(),
+            files INTEGER NOT NULL DEFAULT 0, rejected JSONB
+        )
+    """)
+    cur.execute("ALTER TABLE job_queue ADD COLUMN IF NOT EXISTS batch_id UUID")
+    cur.execute("ALTER TABLE job_queue ADD COLUMN IF NOT EXISTS file_name TEXT")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_job_queue_batch ON job_queue(batch_id) WHERE batch_id IS NOT NULL")
+    # --- Archivado del original en Cloudinary fuera del camino crítico, con reintentos ---
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS archival_tasks (
+            id BIGSERIAL PRIMARY KEY, job_id UUID, invoice_id BIGINT, user_id TEXT NOT NULL,
+            job_type TEXT NOT NULL, blob_key TEXT NOT NULL, content_hash TEXT,
+            status TEXT NOT NULL DEFAULT 'pending', attempts INTEGER NOT NULL DEFAULT 0, last_error TEXT,
+            available_at TIMESTAMPTZ NOT NULL DEFAULT NOW(), lease_expires_at TIMESTAMPTZ,
+            created_at TIMESTAMPTZ DEFAULT NOW(), completed_at TIMESTAMPTZ
+        )
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_archival_tasks_open ON archival_tasks(available_at) WHERE status IN ('pending', 'processing')")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_archival_tasks_invoice ON archival_tasks(invoice_id)")
+    # --- Reintentos de trabajos por fallos transitorios del modelo: no se reclaman antes de available_at ---
+    cur.execute("ALTER TABLE job_queue ADD COLUMN IF NOT EXISTS available_at TIMESTAMPTZ")
+
+def _migration_002_fair_queue(cur):
+    """Reparto justo de la cola: clave de orden por trabajo (reloj virtual de su usuario) en vez del created_at global."""
+    cur.execute("ALTER TABLE job_queue ADD COLUMN IF NOT EXISTS fair_key DOUBLE PRECISION")
+    cur.execute("ALTER TABLE job_queue ADD COLUMN IF NOT EXISTS claimed_at TIMESTAMPTZ")
+    cur.execute("ALTER TABLE job_queue ALTER COLUMN fair_key SET DEFAULT EXTRACT(EPOCH FROM NOW())")
+    # Los trabajos ya encolados conservan su orden de llegada
+    cur.execute("UPDATE job_queue SET fair_key = EXTRACT(EPOCH FROM created_at) WHERE fair_key IS NULL AND status = 'pending'")
+    cur.execute("CREATE TABLE IF NOT EXISTS job_queue_users (user_id TEXT PRIMARY KEY, virtual_time DOUBLE PRECISION NOT NULL)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_job_queue_fair ON job_queue(fair_key) WHERE status = 'pending'")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_job_queue_user_pending ON job_queue(user_id, fair_key) WHERE status = 'pending'")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_job_queue_claimed ON job_queue(claimed_at) WHERE claimed_at IS NOT NULL")
+    cur.execute("DROP INDEX IF EXISTS idx_job_queue_pending")
+
+def _migration_003_pdf_shards(cur):
+    """PDFs grandes repartidos en fragmentos por rango de páginas: cada fragmento es un trabajo hijo del documento."""
+    cur.execute("ALTER TABLE job_queue ADD COLUMN IF NOT EXISTS parent_id UUID")
+    cur.execute("ALTER TABLE job_queue ADD COLUMN IF NOT EXISTS page_start INTEGER")
+    cur.execute("ALTER TABLE job_queue ADD COLUMN IF NOT EXISTS page_end INTEGER")
+    cur.execute("ALTER TABLE job_queue ADD COLUMN IF NOT EXISTS shards_total INTEGER")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_job_queue_parent ON job_queue(parent_id, page_start) WHERE parent_id IS NOT NULL")
+    # Documentos fallidos que conservan el blob para reintentar sus fragmentos: el worker lo libera pasado SHARD_RETRY_HOURS
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_job_queue_sharded_failed ON job_queue(created_at) WHERE status = 'failed' AND shards_total IS NOT NULL AND blob_key IS NOT NULL")
+
+def _migration_004_in_flight_index(cur):
+    """Trabajos en curso por usuario: claim_pending_jobs los cuenta en cada reclamación para el límite por usuario."""
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_job_queue_user_processing ON job_queue(user_id) WHERE status = 'processing'")
+
+def _migration_005_legacy_queues(cur):
+    """Trabajos de las antiguas pdf/image_processing_queue pasados a job_queue (no hace nada si ya no existen)."""
+    migrate_legacy_queues(cur)
+
+MIGRATIONS = [
+    (1, 'base_schema', _migration_001_base_schema),
+    (2, 'fair_queue', _migration_002_fair_queue),
+    (3, 'pdf_shards', _migration_003_pdf_shards),
+    (4, 'in_flight_index', _migration_004_in_flight_index),
+    (5, 'legacy_queues', _migration_005_legacy_queues),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+def get_schema_version():
+    """Versión aplicada del esquema (0 si la base de datos nunca se ha migrado)."""
+    with db_connection() as conn:
         cur = conn.cursor()
-        cur.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                id BIGSERIAL PRIMARY KEY,
-                firebase_uid TEXT NOT NULL UNIQUE,
-                email TEXT,
-                trial_start_date TIMESTAMPTZ,
-                trial_end_date TIMESTAMPTZ,
-                subscription_status TEXT DEFAULT 'trial',
-                created_at TIMESTAMPTZ DEFAULT NOW()
-            )
-        ''')
-        # --- AÑADIDA: columna moneda TEXT DEFAULT '€' ---
-        cur.execute('''
-            CREATE TABLE IF NOT EXISTS facturas (
-                id BIGSERIAL PRIMARY KEY, emisor TEXT, cif TEXT, fecha TEXT, 
-                total REAL, base_imponible REAL, impuestos_json JSONB, 
-                ia_model TEXT, user_id TEXT, created_at TIMESTAMPTZ DEFAULT NOW(),
-                estado TEXT DEFAULT 'Pendiente', notas TEXT,
-                file_info JSONB, moneda TEXT DEFAULT '€'
-            )
-        ''')
-        cur.execute('CREATE INDEX IF NOT EXISTS idx_facturas_user_id ON facturas(user_id);')
-        cur.execute('''
-            CREATE TABLE IF NOT EXISTS conceptos (
-                id BIGSERIAL PRIMARY KEY, factura_id BIGINT REFERENCES facturas(id) ON DELETE CASCADE, 
-                descripcion TEXT, cantidad REAL, precio_unitario REAL, user_id TEXT
+        try:
+            cur.execute("SELECT COALESCE(MAX(version), 0) FROM schema_migrations")
+            version = cur.fetchone()[0]
+        except psycopg2.errors.UndefinedTable:
+            version = 0
+        conn.rollback(); cur.close()
+    return version
+
+def migrate(target: int = None):
+    """Aplica en orden las migraciones pendientes (hasta `target`), cada una en su propia transacción.
+    Devuelve las versiones aplicadas."""
+    applied = []
+    with db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS schema_migrations (
+                version INTEGER PRIMARY KEY, name TEXT NOT NULL, applied_at TIMESTAMPTZ DEFAULT NOW()
             )
-        ''')
-        cur.execute('CREATE TABLE IF NOT EXISTS pdf_processing_queue (id UUID PRIMARY KEY, created_at TIMESTAMPTZ DEFAULT NOW(), status TEXT NOT NULL, pdf_data BYTEA, result_json JSONB, error_message TEXT, user_id TEXT, type TEXT DEFAULT \'pdf\')')
-        cur.execute('CREATE TABLE IF NOT EXISTS image_processing_queue (id UUID PRIMARY KEY, created_at TIMESTAMPTZ DEFAULT NOW(), status TEXT NOT NULL, image_data BYTEA, result_json JSONB, error_message TEXT, user_id TEXT, type TEXT DEFAULT \'image\')')
+        """)
         conn.commit()
-        cur.close()
-        print("Base de datos y tablas listas (Cloudinary y Moneda soportados).")
+        cur.execute("SELECT pg_advisory_lock(%s)", (SCHEMA_LOCK_ID,))
+        try:
+            cur.execute("SELECT version FROM schema_migrations")
+            done = {row[0] for row in cur.fetchall()}
+            conn.commit()
+            for version, name, apply in MIGRATIONS:
+                if version in done or (target is not None and version > target): continue
+                print(f"🛠️ Aplicando migración {version:03d} ({name})...")
+                started = time.perf_counter()
+                try:
+                    apply(cur)
+                    cur.execute("INSERT INTO schema_migrations (version, name) VALUES (%s, %s)", (version, name))
+                    conn.commit()
+                except Exception:
+                    conn.rollback(); raise
+                print(f"✅ Migración {version:03d} aplicada en {time.perf_counter() - started:.1f}s")
+                applied.append(version)
+        finally:
+            cur.execute("SELECT pg_advisory_unlock(%s)", (SCHEMA_LOCK_ID,))
+            conn.commit(); cur.close()
+    return applied
+
+def check_schema(auto_migrate: bool = SCHEMA_AUTO_MIGRATE):
+    """Comprobación de arranque: una consulta, sin DDL. Avisa si el código espera migraciones que no se han aplicado."""
+    try:
+        version = get_schema_version()
+        if version >= SCHEMA_VERSION: return version
+        if auto_migrate:
+            migrate(); return SCHEMA_VERSION
+        print(f"⚠️ Esquema de la base de datos en la versión {version}, el código espera la {SCHEMA_VERSION}: ejecuta `python manage.py migrate`.")
+        return version
     except Exception as e:
-        print(f"Error al inicializar la base de datos: {e}")
-    finally:
-        if conn: conn.close()
+        print(f"Error al comprobar la versión del esquema: {e}")
+        return None
 
 def get_or_create_user(firebase_uid: str, email: str = None):
-    conn = None
-    try:
-        conn = get_db_connection()
+    with db_connection() as conn:
         cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
         cur.execute("SELECT * FROM users WHERE firebase_uid = %s", (firebase_uid,))
         user = cur.fetchone()
@@ -74,11 +471,8 @@ def get_or_create_user(firebase_uid: str, email: str = None):
             new_user = cur.fetchone()
             conn.commit()
             return dict(new_user)
-    finally:
-        if conn: conn.close()
 
-def get_user_status(firebase_uid: str):
-    user = get_or_create_user(firebase_uid)
+def compute_user_status(user: dict):
     if not user: return {'status': 'not_found'}
     status = user['subscription_status']
     is_active = False
@@ -87,144 +481,811 @@ def get_user_status(firebase_uid: str):
             is_active = True
             return {'status': 'trial_active', 'trial_end_date': user['trial_end_date'].isoformat(), 'is_active': is_active}
         else:
-            conn = None
-            try:
-                conn = get_db_connection(); cur = conn.cursor()
-                cur.execute("UPDATE users SET subscription_status = 'trial_expired' WHERE firebase_uid = %s", (firebase_uid,))
+            # Solo la primera llamada tras caducar escribe; después la fila ya no está en 'trial'
+            with db_connection() as conn:
+                cur = conn.cursor()
+                cur.execute("UPDATE users SET subscription_status = 'trial_expired' WHERE firebase_uid = %s AND subscription_status = 'trial'", (user['firebase_uid'],))
                 conn.commit()
-            finally:
-                if conn: conn.close()
+            user['subscription_status'] = 'trial_expired'
             return {'status': 'trial_expired', 'is_active': False}
     elif status in ['active', 'subscribed']:
         return {'status': 'subscribed', 'is_active': True}
     else: return {'status': status, 'is_active': False}
 
+def get_user_status(firebase_uid: str):
+    return compute_user_status(get_or_create_user(firebase_uid))
+
 def to_float(value):
     if value is None: return 0.0
     try: return float(value)
     except (ValueError, TypeError): return 0.0
 
+SQL_SEARCH_TEXT = "concat_ws(' ', f.emisor, f.cif, f.notas, (SELECT string_agg(c.descripcion, ' ' ORDER BY c.id) FROM conceptos c WHERE c.factura_id = f.id))"
+SQL_SEARCH_TSVECTOR = "to_tsvector('simple', COALESCE(search_text, ''))"
+
+def _search_text(invoice_data: dict, conceptos: list):
+    # Mismo contenido que SQL_SEARCH_TEXT, calculado en Python al insertar para no releer los conceptos
+    parts = [invoice_data.get('emisor'), invoice_data.get('cif'), invoice_data.get('notas')] + [row[1] for row in conceptos]
+    return ' '.join(str(p) for p in parts if p)
+
+def _factura_row(invoice_data: dict, ia_model: str, user_id: str, file_info: dict = None):
+    impuestos_str = json.dumps(invoice_data.get('impuestos')) if isinstance(invoice_data.get('impuestos'), dict) else None
+    estado = invoice_data.get('estado', 'Pendiente')
+    moneda = invoice_data.get('moneda', '€') # Capturamos la moneda extraída por IA, o € por defecto
+    file_info_str = json.dumps(file_info) if file_info else None
+    return (
+        invoice_data.get('emisor'), invoice_data.get('cif'), invoice_data.get('fecha'),
+        to_float(invoice_data.get('total')), to_float(invoice_data.get('base_imponible')),
+        impuestos_str, ia_model, user_id, estado, file_info_str, moneda, invoice_data.get('fecha'),
+        _search_text(invoice_data, _concepto_rows(None, invoice_data, user_id))
+    )
+
+def _concepto_rows(factura_id, invoice_data: dict, user_id: str):
+    conceptos_list = invoice_data.get('conceptos',[])
+    if not conceptos_list or not isinstance(conceptos_list, list): return []
+    rows = []
+    for concepto in conceptos_list:
+        if not isinstance(concepto, dict): continue
+        descripcion = str(concepto.get('descripcion') or '').strip()
+        if descripcion:
+            rows.append((factura_id, descripcion, to_float(concepto.get('cantidad')), to_float(concepto.get('precio_unitario')), user_id))
+    return rows
+
+def _insert_invoices(cur, invoices: list, ia_model: str, user_id: str):
+    """Inserta varias facturas (lista de (invoice_data, file_info)) con un INSERT multi-fila para
+    facturas y otro para todos sus conceptos. Devuelve los ids en el mismo orden."""
+    if not invoices: return []
+    rows = [_factura_row(data, ia_model, user_id, file_info) for data, file_info in invoices]
+    ids = [row[0] for row in psycopg2.extras.execute_values(cur, """
+        INSERT INTO facturas (emisor, cif, fecha, total, base_imponible, impuestos_json, ia_model, user_id, estado, file_info, moneda, fecha_date, search_text)
+        VALUES %s RETURNING id
+    """, rows, template="(%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, parse_fecha_factura(%s), %s)", page_size=len(rows), fetch=True)]
+    concepto_rows = [row for factura_id, (data, _) in zip(ids, invoices) for row in _concepto_rows(factura_id, data, user_id)]
+    if concepto_rows:
+        psycopg2.extras.execute_values(cur, "INSERT INTO conceptos (factura_id, descripcion, cantidad, precio_unitario, user_id) VALUES %s",
+                                       concepto_rows, page_size=1000)
+    _apply_stats_delta(cur, user_id, ids, 1)
+    bump_collection_version(cur, user_id)
+    return ids
+
+def bump_collection_version(cur, user_id: str):
+    """Incrementa la versión de la colección de facturas del usuario (base del ETag de /api/invoices).
+    Debe llamarse dentro de la misma transacción que la escritura."""
+    cur.execute("""
+        INSERT INTO user_collection_versions (user_id, version) VALUES (%s, 1)
+        ON CONFLICT (user_id) DO UPDATE SET version = user_collection_versions.version + 1
+    """, (user_id,))
+
+# Claves de agrupación de los resúmenes; una factura sin fecha reconocible cuenta en el mes ''
+SQL_STATS_KEYS = "COALESCE(to_char(f.fecha_date, 'YYYY-MM'), ''), COALESCE(f.moneda, '€'), COALESCE(f.estado, 'Pendiente')"
+SQL_SUPPLIER_KEYS = "COALESCE(f.emisor, ''), COALESCE(f.moneda, '€')"
+
+def _apply_stats_delta(cur, user_id: str, invoice_ids, sign: int):
+    """Suma (sign=1) o resta (sign=-1) las facturas indicadas a los resúmenes del usuario.
+    Debe llamarse en la misma transacción que la escritura: al restar, antes de borrar o modificar las filas.
+    El ORDER BY fija el orden de bloqueo de las filas del resumen y evita interbloqueos entre escrituras."""
+    if not invoice_ids: return
+    cur.execute(f"""
+        INSERT INTO user_invoice_stats (user_id, mes, moneda, estado, facturas, total, base_imponible)
+        SELECT f.user_id, {SQL_STATS_KEYS}, %s * COUNT(*), %s * COALESCE(SUM(f.total), 0), %s * COALESCE(SUM(f.base_imponible), 0)
+        FROM facturas f WHERE f.user_id = %s AND f.id = ANY(%s)
+        GROUP BY 1, 2, 3, 4 ORDER BY 2, 3, 4
+        ON CONFLICT (user_id, mes, moneda, estado) DO UPDATE SET
+            facturas = user_invoice_stats.facturas + EXCLUDED.facturas,
+            total = user_invoice_stats.total + EXCLUDED.total,
+            base_imponible = user_invoice_stats.base_imponible + EXCLUDED.base_imponible
+    """, (sign, sign, sign, user_id, list(invoice_ids)))
+    cur.execute(f"""
+        INSERT INTO user_supplier_stats (user_id, emisor, moneda, facturas, total)
+        SELECT f.user_id, {SQL_SUPPLIER_KEYS}, %s * COUNT(*), %s * COALESCE(SUM(f.total), 0)
+        FROM facturas f WHERE f.user_id = %s AND f.id = ANY(%s)
+        GROUP BY 1, 2, 3 ORDER BY 2, 3
+        ON CONFLICT (user_id, emisor, moneda) DO UPDATE SET
+            facturas = user_supplier_stats.facturas + EXCLUDED.facturas,
+            total = user_supplier_stats.total + EXCLUDED.total
+    """, (sign, sign, user_id, list(invoice_ids)))
+    if sign < 0:
+        cur.execute("DELETE FROM user_invoice_stats WHERE user_id = %s AND facturas <= 0", (user_id,))
+        cur.execute("DELETE FROM user_supplier_stats WHERE user_id = %s AND facturas <= 0", (user_id,))
+
+def _rebuild_stats(cur, user_id: str = None):
+    """Recalcula desde facturas los resúmenes de un usuario (o de todos)."""
+    condition, params = ("WHERE f.user_id = %s", (user_id,)) if user_id else ("WHERE f.user_id IS NOT NULL", ())
+    cur.execute("DELETE FROM user_invoice_stats" + (" WHERE user_id = %s" if user_id else ""), params)
+    cur.execute("DELETE FROM user_supplier_stats" + (" WHERE user_id = %s" if user_id else ""), params)
+    cur.execute(f"""
+        INSERT INTO user_invoice_stats (user_id, mes, moneda, estado, facturas, total, base_imponible)
+        SELECT f.user_id, {SQL_STATS_KEYS}, COUNT(*), COALESCE(SUM(f.total), 0), COALESCE(SUM(f.base_imponible), 0)
+        FROM facturas f {condition} GROUP BY 1, 2, 3, 4
+    """, params)
+    cur.execute(f"""
+        INSERT INTO user_supplier_stats (user_id, emisor, moneda, facturas, total)
+        SELECT f.user_id, {SQL_SUPPLIER_KEYS}, COUNT(*), COALESCE(SUM(f.total), 0)
+        FROM facturas f {condition} GROUP BY 1, 2, 3
+    """, params)
+
+def rebuild_invoice_stats(user_id: str = None):
+    """Reconstruye los resúmenes (backfill o corrección de deriva). Sin user_id, usuario a usuario
+    para no mantener una transacción larga sobre toda la tabla. Devuelve el número de usuarios."""
+    with db_connection() as conn:
+        cur = conn.cursor()
+        if user_id: user_ids = [user_id]
+        else:
+            cur.execute("SELECT DISTINCT user_id FROM facturas WHERE user_id IS NOT NULL UNION SELECT DISTINCT user_id FROM user_invoice_stats")
+            user_ids = [row[0] for row in cur.fetchall()]
+        for uid in user_ids:
+            _rebuild_stats(cur, uid); conn.commit()
+        cur.close()
+    return len(user_ids)
+
+def get_invoice_stats(user_id: str, months: int = None, top_suppliers: int = 10):
+    """Lee los resúmenes precalculados: el coste depende del número de meses y monedas, no de facturas."""
+    with db_connection() as conn:
+        cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+        cur.execute("SELECT mes, moneda, estado, facturas, total, base_imponible FROM user_invoice_stats WHERE user_id = %s ORDER BY mes DESC, moneda, estado", (user_id,))
+        rows = [dict(row) for row in cur.fetchall()]
+        cur.execute("SELECT emisor, moneda, facturas, total FROM user_supplier_stats WHERE user_id = %s ORDER BY total DESC LIMIT %s", (user_id, top_suppliers))
+        suppliers = [dict(row) for row in cur.fetchall()]
+        cur.close()
+    totals, by_month = {}, {}
+    for row in rows:
+        key = (row['moneda'], row['estado'])
+        entry = totals.setdefault(key, {'moneda': row['moneda'], 'estado': row['estado'], 'facturas': 0, 'total': 0.0, 'base_imponible': 0.0})
+        for field in ('facturas', 'total', 'base_imponible'): entry[field] += row[field]
+        by_month.setdefault(row['mes'], []).append(row)
+    month_keys = [m for m in by_month if m]
+    if months: month_keys = month_keys[:months]
+    for entry in list(totals.values()) + rows + suppliers:
+        for field in ('total', 'base_imponible'):
+            if field in entry: entry[field] = round(entry[field], 2)
+    return {
+        'facturas': sum(entry['facturas'] for entry in totals.values()),
+        'totales': sorted(totals.values(), key=lambda e: (e['moneda'], e['estado'])),
+        'meses': [{'mes': mes, 'desglose': [{k: row[k] for k in ('moneda', 'estado', 'facturas', 'total', 'base_imponible')} for row in by_month[mes]]} for mes in month_keys],
+        'sin_fecha': [{k: row[k] for k in ('moneda', 'estado', 'facturas', 'total', 'base_imponible')} for row in by_month.get('', [])],
+        'proveedores': suppliers,
+    }
+
+def get_collection_version(user_id: str):
+    with db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT version FROM user_collection_versions WHERE user_id = %s", (user_id,))
+        row = cur.fetchone(); cur.close()
+        return row[0] if row else 0
+
 def add_invoice(invoice_data: dict, ia_model: str, user_id: str, file_info: dict = None):
-    sql_factura = """
-    INSERT INTO facturas (emisor, cif, fecha, total, base_imponible, impuestos_json, ia_model, user_id, estado, file_info, moneda)
-    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s) RETURNING id;
-    """
-    sql_concepto = "INSERT INTO conceptos (factura_id, descripcion, cantidad, precio_unitario, user_id) VALUES (%s, %s, %s, %s, %s);"
-    conn = None
     try:
-        conn = get_db_connection(); cur = conn.cursor()
-        impuestos_str = json.dumps(invoice_data.get('impuestos')) if isinstance(invoice_data.get('impuestos'), dict) else None
-        estado = invoice_data.get('estado', 'Pendiente')
-        moneda = invoice_data.get('moneda', '€') # Capturamos la moneda extraída por IA, o € por defecto
-        file_info_str = json.dumps(file_info) if file_info else None
-
-        cur.execute(sql_factura, (
-            invoice_data.get('emisor'), invoice_data.get('cif'), invoice_data.get('fecha'),
-            to_float(invoice_data.get('total')), to_float(invoice_data.get('base_imponible')),
-            impuestos_str, ia_model, user_id, estado, file_info_str, moneda
-        ))
-        factura_id = cur.fetchone()[0]
-        
-        conceptos_list = invoice_data.get('conceptos',[])
-        if conceptos_list and isinstance(conceptos_list, list):
-            for concepto in conceptos_list:
-                descripcion = concepto.get('descripcion', '').strip()
-                if descripcion:
-                    cur.execute(sql_concepto, (factura_id, descripcion, to_float(concepto.get('cantidad')), to_float(concepto.get('precio_unitario')), user_id))
-        conn.commit(); cur.close(); return factura_id
+        with db_connection() as conn:
+            cur = conn.cursor()
+            factura_id = _insert_invoices(cur, [(invoice_data, file_info)], ia_model, user_id)[0]
+            conn.commit(); cur.close(); return factura_id
     except Exception as error:
         print(f"Error DB en add_invoice: {error}");
-        if conn: conn.rollback()
         return None
-    finally:
-        if conn: conn.close()
 
-def create_pdf_job(pdf_data, user_id: str):
-    job_id = str(uuid.uuid4())
-    sql = "INSERT INTO pdf_processing_queue (id, status, pdf_data, user_id, type) VALUES (%s, 'pending', %s, %s, 'pdf');"
-    conn = None;
-    try:
-        conn = get_db_connection(); cur = conn.cursor()
-        cur.execute(sql, (job_id, psycopg2.Binary(pdf_data), user_id))
-        conn.commit(); cur.close(); return job_id
-    finally:
-        if conn: conn.close()
+BULK_IMPORT_CHUNK_SIZE = int(os.environ.get('BULK_IMPORT_CHUNK_SIZE', '500'))
+
+def add_invoices_bulk(invoices, ia_model: str, user_id: str, chunk_size: int = BULK_IMPORT_CHUNK_SIZE, start_index: int = 0):
+    """Importa un lote de facturas en transacciones de `chunk_size`. Si un bloque falla se reintenta
+    factura a factura con savepoints para aislar las erróneas. Devuelve un resultado por factura."""
+    results = []
+    with db_connection() as conn:
+        cur = conn.cursor()
+        for offset in range(0, len(invoices), chunk_size):
+            chunk = []
+            for index, data in enumerate(invoices[offset:offset + chunk_size], start=start_index + offset):
+                if isinstance(data, dict) and data.get('emisor'): chunk.append((index, data))
+                else: results.append({'index': index, 'ok': False, 'error': "Datos inválidos"})
+            if not chunk: continue
+            try:
+                ids = _insert_invoices(cur, [(data, None) for _, data in chunk], ia_model, user_id)
+                conn.commit()
+                results.extend({'index': index, 'ok': True, 'id': factura_id} for (index, _), factura_id in zip(chunk, ids))
+                continue
+            except Exception as error:
+                conn.rollback()
+                print(f"Error DB en add_invoices_bulk (bloque desde {chunk[0][0]}), reintentando una a una: {error}")
+            for index, data in chunk:
+                cur.execute("SAVEPOINT bulk_item")
+                try:
+                    factura_id = _insert_invoices(cur, [(data, None)], ia_model, user_id)[0]
+                    cur.execute("RELEASE SAVEPOINT bulk_item")
+                    results.append({'index': index, 'ok': True, 'id': factura_id})
+                except Exception as error:
+                    cur.execute("ROLLBACK TO SAVEPOINT bulk_item")
+                    results.append({'index': index, 'ok': False, 'error': str(error).strip()})
+            conn.commit()
+        cur.close()
+    return sorted(results, key=lambda r: r['index'])
+
+def migrate_legacy_queues(cur):
+    """Mueve las filas de las antiguas tablas pdf/image_processing_queue a job_queue y las elimina."""
+    for table, data_column, job_type in (('pdf_processing_queue', 'pdf_data', 'pdf'), ('image_processing_queue', 'image_data', 'image')):
+        cur.execute("SELECT to_regclass(%s) IS NOT NULL", (table,))
+        if not cur.fetchone()[0]: continue
+        cur.execute(f"""
+            INSERT INTO job_queue (id, type, status, created_at, user_id, file_data, result_json, error_message, lease_expires_at, attempts)
+            SELECT id, '{job_type}', CASE WHEN status = 'processing' THEN 'pending' ELSE status END,
+                created_at, user_id, {data_column}, result_json, error_message, NULL, 0
+            FROM {table}
+            ON CONFLICT (id) DO NOTHING
+        """)
+        print(f"Migrados {cur.rowcount} trabajos de {table} a job_queue.")
+        cur.execute(f"DROP TABLE {table}")
 
-def create_image_job(image_data, user_id: str):
+# --- Reparto justo (weighted fair queuing): cada usuario tiene un reloj virtual que avanza FAIR_JOB_COST / peso
+# segundos por trabajo encolado, y cada trabajo se ordena por el instante virtual que le toca. 800 PDFs de un usuario
+# quedan repartidos en el tiempo y la foto de otro usuario se intercala casi en cabeza, sin dejar de ser un único
+# recorrido del índice parcial idx_job_queue_fair al reclamar.
+FAIR_JOB_COST = float(os.environ.get('FAIR_JOB_COST', '10'))
+FAIR_WEIGHT_SUBSCRIBED = float(os.environ.get('FAIR_WEIGHT_SUBSCRIBED', '3'))
+# Las subidas sueltas (interactivas) se adelantan este número de segundos virtuales a los lotes
+FAIR_INTERACTIVE_BOOST = float(os.environ.get('FAIR_INTERACTIVE_BOOST', '30'))
+JOB_USER_MAX_IN_FLIGHT = int(os.environ.get('JOB_USER_MAX_IN_FLIGHT', '4'))
+JOB_SUBSCRIBED_MAX_IN_FLIGHT = int(os.environ.get('JOB_SUBSCRIBED_MAX_IN_FLIGHT', '8'))
+# Candidatos que se bloquean por trabajo pedido, para poder saltarse a quien ya está en su límite
+FAIR_CLAIM_WINDOW = int(os.environ.get('FAIR_CLAIM_WINDOW', '8'))
+SQL_SUBSCRIBED = "subscription_status IN ('active', 'subscribed')"
+
+def _reserve_fair_keys(cur, user_id: str, count: int, interactive: bool):
+    """Avanza el reloj virtual del usuario `count` trabajos y devuelve sus claves de orden. Sin crédito acumulado:
+    un usuario inactivo empieza en NOW(), no en el pasado."""
+    cur.execute(f"""
+        WITH w AS (SELECT CASE WHEN EXISTS (SELECT 1 FROM users WHERE firebase_uid = %(user_id)s AND {SQL_SUBSCRIBED})
+                               THEN %(weight)s ELSE 1.0 END AS weight)
+        INSERT INTO job_queue_users AS q (user_id, virtual_time)
+        SELECT %(user_id)s, EXTRACT(EPOCH FROM NOW()) + %(count)s * %(cost)s / w.weight FROM w
+        ON CONFLICT (user_id) DO UPDATE SET virtual_time = GREATEST(q.virtual_time, EXTRACT(EPOCH FROM NOW())) + %(count)s * %(cost)s / (SELECT weight FROM w)
+        RETURNING virtual_time, (SELECT weight FROM w)
+    """, {'user_id': user_id, 'count': count, 'cost': FAIR_JOB_COST, 'weight': FAIR_WEIGHT_SUBSCRIBED})
+    end, weight = cur.fetchone()
+    step, boost = FAIR_JOB_COST / float(weight), FAIR_INTERACTIVE_BOOST if interactive else 0.0
+    return [end - (count - 1 - i) * step - boost for i in range(count)]
+
+def _document_job_rows(blob_ref, user_id: str, job_type: str, batch_id=None, file_name=None, page_ranges=None):
+    """Filas de job_queue de un documento: una sola o, con `page_ranges` ([(primera, última)], desde 1), el documento en
+    'waiting' y un fragmento pendiente por rango. Los fragmentos comparten el blob y no llevan content_hash: la caché de
+    extracciones, el archivado y el borrado del blob son del documento. Devuelve (id del documento, filas)."""
     job_id = str(uuid.uuid4())
-    sql = "INSERT INTO image_processing_queue (id, status, image_data, user_id, type) VALUES (%s, 'pending', %s, %s, 'image');"
-    conn = None
-    try:
-        conn = get_db_connection(); cur = conn.cursor()
-        cur.execute(sql, (job_id, psycopg2.Binary(image_data), user_id))
+    if not page_ranges:
+        return job_id, [[job_id, job_type, 'pending', blob_ref.key, blob_ref.content_hash, blob_ref.size, user_id, batch_id, file_name, None, None, None, None]]
+    rows = [[job_id, job_type, 'waiting', blob_ref.key, blob_ref.content_hash, blob_ref.size, user_id, batch_id, file_name, None, None, None, len(page_ranges)]]
+    rows += [[str(uuid.uuid4()), job_type, 'pending', blob_ref.key, None, None, user_id, None, file_name, job_id, start, end, None]
+             for start, end in page_ranges]
+    return job_id, rows
+
+def _insert_jobs(cur, user_id: str, rows, interactive: bool):
+    # Solo los trabajos pendientes ocupan el reloj virtual; un documento en 'waiting' recibe su clave al volver a la cola
+    pending = [row for row in rows if row[2] == 'pending']
+    fair_keys = iter(_reserve_fair_keys(cur, user_id, len(pending), interactive)) if pending else iter(())
+    rows = [row + [next(fair_keys) if row[2] == 'pending' else None] for row in rows]
+    psycopg2.extras.execute_values(cur, """
+        INSERT INTO job_queue (id, type, status, blob_key, content_hash, size_bytes, user_id, batch_id, file_name,
+                               parent_id, page_start, page_end, shards_total, fair_key) VALUES %s
+    """, rows, page_size=500)
+
+def create_job(blob_ref, user_id: str, job_type: str, page_ranges=None):
+    job_id, rows = _document_job_rows(blob_ref, user_id, job_type, page_ranges=page_ranges)
+    with db_connection() as conn:
+        cur = conn.cursor()
+        _insert_jobs(cur, user_id, rows, interactive=True)
         conn.commit(); cur.close(); return job_id
-    finally:
-        if conn: conn.close()
+
+def create_job_batch(user_id: str, entries, rejected=None):
+    """Encola todos los ficheros de un lote (lista de (blob_ref, job_type, file_name, page_ranges)) en una sola
+    transacción. Devuelve (batch_id, job_ids en el mismo orden)."""
+    batch_id = str(uuid.uuid4())
+    job_ids, rows = [], []
+    for blob_ref, job_type, file_name, page_ranges in entries:
+        job_id, job_rows = _document_job_rows(blob_ref, user_id, job_type, batch_id, file_name, page_ranges)
+        job_ids.append(job_id); rows.extend(job_rows)
+    with db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute("INSERT INTO job_batches (id, user_id, files, rejected) VALUES (%s, %s, %s, %s)",
+                    (batch_id, user_id, len(job_ids) + len(rejected or []), json.dumps(rejected or [])))
+        # Un lote no es interactivo: sus trabajos ocupan el reloj del usuario sin adelantarse
+        if rows: _insert_jobs(cur, user_id, rows, interactive=False)
+        conn.commit(); cur.close()
+    return batch_id, job_ids
+
+def get_batch_status(batch_id, user_id: str, with_jobs: bool = False):
+    """Progreso agregado de un lote: un recuento por estado en vez de un job_status por fichero."""
+    try: uuid.UUID(str(batch_id))
+    except ValueError: return None
+    with db_connection() as conn:
+        cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+        cur.execute("SELECT created_at, files, rejected FROM job_batches WHERE id = %s AND user_id = %s", (batch_id, user_id))
+        batch = cur.fetchone()
+        if not batch:
+            cur.close(); return None
+        cur.execute("""
+            SELECT COUNT(*) AS jobs,
+                   COUNT(*) FILTER (WHERE status = 'pending') AS pending,
+                   COUNT(*) FILTER (WHERE status IN ('processing', 'waiting')) AS processing,
+                   COUNT(*) FILTER (WHERE status = 'completed') AS completed,
+                   COUNT(*) FILTER (WHERE status = 'failed') AS failed,
+                   COUNT(*) FILTER (WHERE duplicate) AS duplicates
+            FROM job_queue WHERE batch_id = %s AND user_id = %s
+        """, (batch_id, user_id))
+        status = dict(cur.fetchone())
+        if with_jobs:
+            cur.execute("SELECT id, file_name, type, status, error_message, duplicate FROM job_queue WHERE batch_id = %s AND user_id = %s ORDER BY file_name, id", (batch_id, user_id))
+            status['job_list'] = [dict(row, id=str(row['id'])) for row in cur.fetchall()]
+        cur.close()
+    finished = status['completed'] + status['failed']
+    status.update({'created_at': batch['created_at'].isoformat(), 'files': batch['files'], 'rejected': batch['rejected'] or [],
+                   'progress': round(finished / status['jobs'], 3) if status['jobs'] else 1.0, 'done': finished == status['jobs']})
+    return status
 
 def get_job_status(job_id, user_id):
-    sql_pdf = "SELECT status, result_json, error_message, 'pdf' as type FROM pdf_processing_queue WHERE id = %s AND user_id = %s;"
-    sql_image = "SELECT status, result_json, error_message, 'image' as type FROM image_processing_queue WHERE id = %s AND user_id = %s;"
-    conn = None
-    try:
-        conn = get_db_connection(); cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
-        cur.execute(sql_pdf, (job_id, user_id)); job = cur.fetchone()
-        if not job: cur.execute(sql_image, (job_id, user_id)); job = cur.fetchone()
-        cur.close(); return dict(job) if job else None
-    finally:
-        if conn: conn.close()
+    """Estado de un trabajo. Si el documento se fragmentó, `shards` resume el progreso de sus fragmentos."""
+    with db_connection() as conn:
+        cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+        cur.execute("SELECT status, result_json, error_message, type, duplicate, processing_report, shards_total FROM job_queue WHERE id = %s AND user_id = %s;", (job_id, user_id))
+        job = cur.fetchone()
+        job = dict(job) if job else None
+        if job and job['shards_total']:
+            cur.execute("""
+                SELECT COUNT(*) FILTER (WHERE status = 'completed') AS completed, COUNT(*) FILTER (WHERE status = 'failed') AS failed,
+                       COUNT(*) FILTER (WHERE status = 'processing') AS processing, COUNT(*) FILTER (WHERE status = 'pending') AS pending,
+                       COALESCE(json_agg(json_build_array(page_start, page_end) ORDER BY page_start) FILTER (WHERE status = 'failed'), '[]') AS failed_pages
+                FROM job_queue WHERE parent_id = %s
+            """, (job_id,))
+            shards = dict(cur.fetchone())
+            job['shards'] = dict(shards, total=job['shards_total'], progress=round(shards['completed'] / job['shards_total'], 3))
+        if job: job.pop('shards_total')
+        cur.close(); return job
+
+def get_active_jobs(user_id: str, limit: int = 200):
+    """Trabajos todavía sin terminar de un usuario: el punto de partida de un stream de eventos."""
+    with db_connection() as conn:
+        cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+        cur.execute("""
+            SELECT id, status, type, batch_id, file_name FROM job_queue
+            WHERE user_id = %s AND status IN ('pending', 'processing', 'waiting') AND parent_id IS NULL ORDER BY created_at LIMIT %s
+        """, (user_id, limit))
+        jobs = [dict(row, id=str(row['id']), batch_id=str(row['batch_id']) if row['batch_id'] else None) for row in cur.fetchall()]
+        cur.close(); return jobs
 
-def get_pending_job():
+def get_cached_extraction(user_id: str, content_hash: str, prompt_version: str, model_name: str):
     sql = """
-    (SELECT id, pdf_data as file_data, user_id, 'pdf' as type FROM pdf_processing_queue WHERE status = 'pending' ORDER BY created_at LIMIT 1)
-    UNION ALL
-    (SELECT id, image_data as file_data, user_id, 'image' as type FROM image_processing_queue WHERE status = 'pending' ORDER BY created_at LIMIT 1)
-    LIMIT 1;
+    UPDATE extraction_cache SET hits = hits + 1, last_hit_at = NOW()
+    WHERE user_id = %s AND content_hash = %s AND prompt_version = %s AND model_name = %s
+    RETURNING result_json, file_info;
     """
-    conn = None;
-    try:
-        conn = get_db_connection(); cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
-        cur.execute(sql); job = cur.fetchone(); cur.close(); return dict(job) if job else None
-    finally:
-        if conn: conn.close()
+    with db_connection() as conn:
+        cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+        cur.execute(sql, (user_id, content_hash, prompt_version, model_name))
+        row = cur.fetchone(); conn.commit(); cur.close()
+        return dict(row) if row else None
 
-def update_job_as_completed(job_id, result_json, job_type):
-    table_name = "pdf_processing_queue" if job_type == 'pdf' else "image_processing_queue"
-    data_column_to_clear = "pdf_data" if job_type == 'pdf' else "image_data"
-    sql = f"UPDATE {table_name} SET status = 'completed', result_json = %s, {data_column_to_clear} = NULL WHERE id = %s;"
-    conn = None
-    try:
-        conn = get_db_connection(); cur = conn.cursor()
-        cur.execute(sql, (json.dumps(result_json), job_id))
+def save_cached_extraction(user_id: str, content_hash: str, prompt_version: str, model_name: str, result_json: dict, file_info: dict = None):
+    sql = """
+    INSERT INTO extraction_cache (user_id, content_hash, prompt_version, model_name, result_json, file_info)
+    VALUES (%s, %s, %s, %s, %s, %s)
+    ON CONFLICT (user_id, content_hash, prompt_version, model_name)
+    DO UPDATE SET result_json = EXCLUDED.result_json, file_info = COALESCE(EXCLUDED.file_info, extraction_cache.file_info);
+    """
+    with db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute(sql, (user_id, content_hash, prompt_version, model_name, json.dumps(result_json), json.dumps(file_info) if file_info else None))
         conn.commit(); cur.close()
-    finally:
-        if conn: conn.close()
 
-def update_job_as_failed(job_id, error_message, job_type):
-    table_name = "pdf_processing_queue" if job_type == 'pdf' else "image_processing_queue"
-    data_column_to_clear = "pdf_data" if job_type == 'pdf' else "image_data"
-    sql = f"UPDATE {table_name} SET status = 'failed', error_message = %s, {data_column_to_clear} = NULL WHERE id = %s;"
-    conn = None
-    try:
-        conn = get_db_connection(); cur = conn.cursor()
+def create_completed_duplicate_job(blob_ref, user_id: str, job_type: str, result_json: dict):
+    """Registra un trabajo ya completado a partir de la caché, sin pasar por la cola."""
+    job_id = str(uuid.uuid4())
+    sql = """
+    INSERT INTO job_queue (id, type, status, content_hash, size_bytes, user_id, result_json, duplicate)
+    VALUES (%s, %s, 'completed', %s, %s, %s, %s, TRUE);
+    """
+    with db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute(sql, (job_id, job_type, blob_ref.content_hash, blob_ref.size, user_id, json.dumps(result_json)))
+        conn.commit(); cur.close(); return job_id
+
+def get_extraction_cache_stats(user_id: str):
+    with db_connection() as conn:
+        cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+        cur.execute("SELECT COUNT(*) AS entries, COALESCE(SUM(hits), 0) AS hits FROM extraction_cache WHERE user_id = %s", (user_id,))
+        stats = dict(cur.fetchone()); cur.close()
+        return stats
+
+JOB_MAX_ATTEMPTS = int(os.environ.get('JOB_MAX_ATTEMPTS', '3'))
+JOB_EVENTS_CHANNEL = 'job_events'
+
+def _notify_job_events(cur, rows):
+    """pg_notify por cada (id, user_id, status, batch_id) cambiado. Postgres solo entrega las notificaciones
+    al hacer commit, así que quien escucha nunca ve un estado que aún no sea visible en job_queue."""
+    payloads = [json.dumps({'job_id': str(job_id), 'user_id': user_id, 'status': status, 'batch_id': str(batch_id) if batch_id else None})
+                for job_id, user_id, status, batch_id in rows]
+    if payloads: cur.execute("SELECT pg_notify(%s, payload) FROM unnest(%s::text[]) AS payload", (JOB_EVENTS_CHANNEL, payloads))
+
+def _document_events(rows):
+    # Filas (id, user_id, status, batch_id, parent_id): los fragmentos no se notifican, el cliente sigue a su documento
+    return [row[:4] for row in rows if row[4] is None]
+
+def _fail_shard_parents(cur, shard_ids):
+    """Marca como fallidos los documentos de fragmentos que acaban de fallar definitivamente. El documento conserva
+    el blob para reintentar solo esos fragmentos (retry_failed_shards). Devuelve sus filas para _notify_job_events."""
+    if not shard_ids: return []
+    cur.execute("""
+        UPDATE job_queue p SET status = 'failed',
+            error_message = 'Falló el fragmento de las páginas ' || c.page_start || '-' || c.page_end || ': ' || COALESCE(c.error_message, '')
+        FROM job_queue c WHERE c.id = ANY(%s::uuid[]) AND c.status = 'failed' AND p.id = c.parent_id AND p.status = 'waiting'
+        RETURNING p.id, p.user_id, p.status, p.batch_id
+    """, ([str(shard_id) for shard_id in shard_ids],))
+    return cur.fetchall()
+
+def requeue_expired_jobs():
+    """Devuelve a 'pending' los trabajos con lease caducado y marca como fallidos los que agotaron
+    JOB_MAX_ATTEMPTS. Devuelve (nº reencolados, blob_keys de los trabajos abandonados)."""
+    with db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute("""
+            UPDATE job_queue SET status = 'failed', file_data = NULL, lease_expires_at = NULL,
+                error_message = 'Trabajo abandonado tras ' || attempts || ' intentos.'
+            WHERE status = 'processing' AND lease_expires_at < NOW() AND attempts >= %s
+            RETURNING CASE WHEN parent_id IS NULL THEN blob_key END, id, user_id, status, batch_id, parent_id;
+        """, (JOB_MAX_ATTEMPTS,))
+        rows = cur.fetchall()
+        # El blob de un fragmento es el de su documento: no se borra, se queda para reintentarlo
+        abandoned = [row[0] for row in rows]
+        cur.execute("UPDATE job_queue SET status = 'pending', lease_expires_at = NULL WHERE status = 'processing' AND lease_expires_at < NOW() RETURNING id, user_id, status, batch_id, parent_id;")
+        requeued_rows = cur.fetchall()
+        requeued = len(requeued_rows)
+        failed_parents = _fail_shard_parents(cur, [row[1] for row in rows if row[5]])
+        _notify_job_events(cur, _document_events([row[1:] for row in rows] + requeued_rows) + failed_parents)
+        conn.commit(); cur.close()
+    return requeued, abandoned
+
+def claim_pending_jobs(limit: int, lease_seconds: int):
+    """Reclama hasta `limit` trabajos pendientes en orden de fair_key (reparto justo entre usuarios), sin pasar
+    del límite de trabajos en curso de cada usuario. Recorre idx_job_queue_fair hasta limit * FAIR_CLAIM_WINDOW
+    candidatos con FOR UPDATE SKIP LOCKED, así que dos workers concurrentes nunca procesan el mismo trabajo."""
+    sql = f"""
+    WITH candidates AS (
+        SELECT id, user_id, fair_key FROM job_queue
+        WHERE status = 'pending' AND (available_at IS NULL OR available_at <= NOW())
+        ORDER BY fair_key LIMIT %(window)s FOR UPDATE SKIP LOCKED
+    ), in_flight AS (
+        SELECT user_id, COUNT(*) AS jobs FROM job_queue
+        WHERE status = 'processing' AND user_id IN (SELECT user_id FROM candidates) GROUP BY user_id
+    ), ranked AS (
+        SELECT c.id, c.fair_key,
+               ROW_NUMBER() OVER (PARTITION BY c.user_id ORDER BY c.fair_key) + COALESCE(f.jobs, 0) AS slot,
+               CASE WHEN u.{SQL_SUBSCRIBED} THEN %(cap_subscribed)s ELSE %(cap)s END AS cap
+        FROM candidates c LEFT JOIN in_flight f USING (user_id) LEFT JOIN users u ON u.firebase_uid = c.user_id
+    ), picked AS (
+        SELECT id FROM ranked WHERE slot <= cap ORDER BY fair_key LIMIT %(limit)s
+    )
+    UPDATE job_queue q SET status = 'processing', attempts = q.attempts + 1, claimed_at = COALESCE(q.claimed_at, NOW()),
+        lease_expires_at = NOW() + make_interval(secs => %(lease)s)
+    FROM picked WHERE q.id = picked.id
+    RETURNING q.id, q.file_data, q.blob_key, q.content_hash, q.user_id, q.type, q.attempts, q.batch_id,
+              q.parent_id, q.page_start, q.page_end, q.shards_total, EXTRACT(EPOCH FROM NOW() - q.created_at) AS waited;
+    """
+    with db_connection() as conn:
+        cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+        cur.execute(sql, {'window': limit * FAIR_CLAIM_WINDOW, 'limit': limit, 'lease': lease_seconds,
+                          'cap': JOB_USER_MAX_IN_FLIGHT, 'cap_subscribed': JOB_SUBSCRIBED_MAX_IN_FLIGHT})
+        claimed = [dict(row) for row in cur.fetchall()]
+        _notify_job_events(cur, [(job['id'], job['user_id'], 'processing', job['batch_id']) for job in claimed if not job['parent_id']])
+        conn.commit(); cur.close()
+    return claimed
+
+def get_queue_metrics():
+    """Profundidad y antigüedad (segundos desde created_at) de la cola por estado y tipo ('waiting': documentos
+    fragmentados esperando a sus fragmentos), más las tareas de archivado abiertas."""
+    with db_connection() as conn:
+        cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+        cur.execute("""
+            SELECT status, type, COUNT(*) AS jobs, COALESCE(EXTRACT(EPOCH FROM NOW() - MIN(created_at)), 0) AS oldest_age,
+                   COUNT(*) FILTER (WHERE available_at > NOW()) AS delayed
+            FROM job_queue WHERE status IN ('pending', 'processing', 'waiting') GROUP BY status, type
+        """)
+        queue = [dict(row) for row in cur.fetchall()]
+        cur.execute("SELECT status, COUNT(*) AS tasks FROM archival_tasks WHERE status IN ('pending', 'processing') GROUP BY status")
+        archival = {row['status']: row['tasks'] for row in cur.fetchall()}
+        cur.execute("SELECT COUNT(DISTINCT user_id) FROM job_queue WHERE status = 'pending'")
+        users_waiting = cur.fetchone()[0]
+        cur.close()
+    return {'queue': queue, 'archival': archival, 'users_waiting': users_waiting}
+
+def get_queue_user_stats(window_minutes: int = 60, limit: int = 50):
+    """Reparto de la cola por usuario para comprobar la equidad: trabajos pendientes y en curso, espera del pendiente
+    más antiguo y esperas (de created_at a claimed_at) de los trabajos reclamados en los últimos `window_minutes`."""
+    with db_connection() as conn:
+        cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+        cur.execute(f"""
+            WITH live AS (
+                SELECT user_id, COUNT(*) FILTER (WHERE status = 'pending') AS pending,
+                       COUNT(*) FILTER (WHERE status = 'processing') AS processing,
+                       EXTRACT(EPOCH FROM NOW() - MIN(created_at) FILTER (WHERE status = 'pending')) AS oldest_pending_s,
+                       MIN(fair_key) FILTER (WHERE status = 'pending') - EXTRACT(EPOCH FROM NOW()) AS next_fair_key_s
+                FROM job_queue WHERE status IN ('pending', 'processing') GROUP BY user_id
+            ), recent AS (
+                SELECT user_id, COUNT(*) AS claimed, AVG(EXTRACT(EPOCH FROM claimed_at - created_at)) AS avg_wait_s,
+                       percentile_cont(0.95) WITHIN GROUP (ORDER BY EXTRACT(EPOCH FROM claimed_at - created_at)) AS p95_wait_s,
+                       MAX(EXTRACT(EPOCH FROM claimed_at - created_at)) AS max_wait_s
+                FROM job_queue WHERE claimed_at > NOW() - make_interval(mins => %s) GROUP BY user_id
+            )
+            SELECT user_id, COALESCE(l.pending, 0) AS pending, COALESCE(l.processing, 0) AS processing, l.oldest_pending_s,
+                   l.next_fair_key_s, COALESCE(r.claimed, 0) AS claimed, r.avg_wait_s, r.p95_wait_s, r.max_wait_s,
+                   COALESCE(u.{SQL_SUBSCRIBED}, FALSE) AS subscribed
+            FROM live l FULL JOIN recent r USING (user_id) LEFT JOIN users u ON u.firebase_uid = user_id
+            ORDER BY COALESCE(l.pending, 0) DESC, r.max_wait_s DESC NULLS LAST LIMIT %s
+        """, (window_minutes, limit))
+        users = []
+        for row in cur.fetchall():
+            users.append({k: round(float(v), 1) if k.endswith('_s') and v is not None else v for k, v in dict(row).items()})
+        cur.close()
+    return users
+
+def update_job_as_completed(job_id, result_json, duplicate: bool = False, report: dict = None):
+    sql = "UPDATE job_queue SET status = 'completed', result_json = %s, duplicate = %s, processing_report = %s, file_data = NULL, lease_expires_at = NULL WHERE id = %s RETURNING id, user_id, status, batch_id;"
+    with db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute(sql, (json.dumps(result_json), duplicate, json.dumps(report) if report else None, job_id))
+        _notify_job_events(cur, cur.fetchall())
+        conn.commit(); cur.close()
+
+def requeue_job(job_id, error_message: str, delay_seconds: float, count_attempt: bool = True):
+    """Devuelve a la cola un trabajo que falló por un error transitorio (rate limit, caída del proveedor)
+    para reintentarlo pasado `delay_seconds`. Si ya agotó JOB_MAX_ATTEMPTS queda como fallido.
+    Con count_attempt=False (no hubo fallo, p.ej. se acabó el presupuesto del lote) el intento no cuenta.
+    Devuelve True si se reencoló."""
+    with db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute("""
+            UPDATE job_queue SET lease_expires_at = NULL, error_message = %s,
+                attempts = CASE WHEN %s THEN attempts ELSE GREATEST(attempts - 1, 0) END,
+                status = CASE WHEN %s AND attempts >= %s THEN 'failed' ELSE 'pending' END,
+                available_at = CASE WHEN %s AND attempts >= %s THEN NULL ELSE NOW() + make_interval(secs => %s) END
+            WHERE id = %s RETURNING id, user_id, status, batch_id, parent_id
+        """, (error_message, count_attempt, count_attempt, JOB_MAX_ATTEMPTS, count_attempt, JOB_MAX_ATTEMPTS, delay_seconds, job_id))
+        row = cur.fetchone()
+        if row: _notify_job_events(cur, _document_events([row]) + (_fail_shard_parents(cur, [row[0]]) if row[2] == 'failed' and row[4] else []))
+        conn.commit(); cur.close()
+    return bool(row) and row[2] == 'pending'
+
+def update_job_as_failed(job_id, error_message):
+    sql = "UPDATE job_queue SET status = 'failed', error_message = %s, file_data = NULL, lease_expires_at = NULL WHERE id = %s RETURNING id, user_id, status, batch_id, parent_id;"
+    with db_connection() as conn:
+        cur = conn.cursor()
         cur.execute(sql, (error_message, job_id))
+        rows = cur.fetchall()
+        _notify_job_events(cur, _document_events(rows) + _fail_shard_parents(cur, [row[0] for row in rows if row[4]]))
         conn.commit(); cur.close()
-    finally:
-        if conn: conn.close()
+
+def update_job_report_stage(job_id, stage: str, data: dict, status: str = None):
+    """Añade a processing_report.stages una etapa que termina después de completar el trabajo (el archivado).
+    Con status también actualiza processing_report[stage] (p.ej. archive: 'pending' -> 'done')."""
+    with db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute("""
+            UPDATE job_queue SET processing_report = jsonb_set(
+                jsonb_set(COALESCE(processing_report, '{}'::jsonb), '{stages}', COALESCE(processing_report->'stages', '{}'::jsonb)),
+                ARRAY['stages', %s], %s::jsonb)
+                || CASE WHEN %s IS NULL THEN '{}'::jsonb ELSE jsonb_build_object(%s::text, %s::text) END
+            WHERE id = %s
+        """, (stage, json.dumps(data), status, stage, status, job_id))
+        conn.commit(); cur.close()
+
+# --- PDFs fragmentados: el documento espera en 'waiting' mientras sus fragmentos (trabajos hijos) pasan por la cola;
+# al completarse el último, el documento vuelve a 'pending' y su paso de unión guarda una sola factura ---
+SHARD_RETRY_HOURS = float(os.environ.get('SHARD_RETRY_HOURS', '72'))
+
+def complete_shard(job_id, result_json, report: dict = None):
+    """Guarda el resultado de un fragmento. Si era el último sin completar, devuelve su documento a la cola para la
+    unión (True). El FOR UPDATE sobre el documento serializa a los fragmentos hermanos que terminan a la vez: el
+    segundo en tomar el bloqueo ya ve completado al primero."""
+    with db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute("""
+            UPDATE job_queue SET status = 'completed', result_json = %s, processing_report = %s, lease_expires_at = NULL, error_message = NULL
+            WHERE id = %s RETURNING parent_id
+        """, (json.dumps(result_json), json.dumps(report) if report else None, job_id))
+        row = cur.fetchone()
+        cur.execute("SELECT id, user_id, status, batch_id FROM job_queue WHERE id = %s FOR UPDATE", (row[0] if row else None,))
+        parent = cur.fetchone()
+        ready = False
+        if parent and parent[2] == 'waiting':
+            cur.execute("SELECT COUNT(*) FROM job_queue WHERE parent_id = %s AND status <> 'completed'", (parent[0],))
+            ready = cur.fetchone()[0] == 0
+            if ready:
+                # La unión no llama al modelo: entra con la clave de ahora y no detrás del resto de la cola del usuario
+                cur.execute("""
+                    UPDATE job_queue SET status = 'pending', fair_key = EXTRACT(EPOCH FROM NOW()), available_at = NULL
+                    WHERE id = %s RETURNING id, user_id, status, batch_id
+                """, (parent[0],))
+                parent = cur.fetchone()
+            # Con 'waiting' el evento solo avisa de progreso: quien lo sigue consulta `shards` en job_status
+            _notify_job_events(cur, [parent])
+        conn.commit(); cur.close()
+    return ready
+
+def get_shard_results(parent_id):
+    with db_connection() as conn:
+        cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+        cur.execute("SELECT page_start, page_end, status, result_json, processing_report FROM job_queue WHERE parent_id = %s ORDER BY page_start", (parent_id,))
+        shards = [dict(row) for row in cur.fetchall()]; cur.close()
+    return shards
+
+def retry_failed_shards(job_id, user_id: str):
+    """Vuelve a encolar solo los fragmentos fallidos de un documento fallido; los completados conservan su resultado.
+    Devuelve cuántos se reencolaron (0 si el documento no se puede reintentar) o None si no existe."""
+    try: uuid.UUID(str(job_id))
+    except ValueError: return None
+    with db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT status, shards_total, blob_key FROM job_queue WHERE id = %s AND user_id = %s FOR UPDATE", (job_id, user_id))
+        job = cur.fetchone()
+        if not job:
+            cur.close(); return None
+        status, shards_total, blob_key = job
+        cur.execute("SELECT id FROM job_queue WHERE parent_id = %s AND status = 'failed' ORDER BY page_start", (job_id,))
+        shard_ids = [row[0] for row in cur.fetchall()]
+        if status != 'failed' or not shards_total or not blob_key or not shard_ids:
+            conn.rollback(); cur.close(); return 0
+        cur.execute("""
+            UPDATE job_queue q SET status = 'pending', attempts = 0, error_message = NULL, available_at = NULL, lease_expires_at = NULL, fair_key = v.fair_key
+            FROM unnest(%s::uuid[], %s::float8[]) AS v(id, fair_key) WHERE q.id = v.id
+        """, ([str(i) for i in shard_ids], _reserve_fair_keys(cur, user_id, len(shard_ids), interactive=True)))
+        cur.execute("UPDATE job_queue SET status = 'waiting', error_message = NULL WHERE id = %s RETURNING id, user_id, status, batch_id", (job_id,))
+        _notify_job_events(cur, cur.fetchall())
+        conn.commit(); cur.close()
+    return len(shard_ids)
+
+def release_failed_shard_blobs(max_age_hours: float = SHARD_RETRY_HOURS):
+    """Documentos fragmentados que fallaron hace más de `max_age_hours` y nadie reintentó: dejan de ser reintentables.
+    Devuelve las claves de blob que ya se pueden borrar."""
+    with db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute("""
+            WITH expired AS (
+                SELECT id, blob_key FROM job_queue
+                WHERE status = 'failed' AND shards_total IS NOT NULL AND blob_key IS NOT NULL AND created_at < NOW() - make_interval(secs => %s)
+                FOR UPDATE SKIP LOCKED
+            )
+            UPDATE job_queue q SET blob_key = NULL FROM expired WHERE q.id = expired.id RETURNING expired.blob_key
+        """, (max_age_hours * 3600,))
+        keys = [row[0] for row in cur.fetchall()]
+        conn.commit(); cur.close()
+    return keys
+
+ARCHIVAL_MAX_ATTEMPTS = int(os.environ.get('ARCHIVAL_MAX_ATTEMPTS', '8'))
+
+def create_archival_task(job_id, invoice_id: int, user_id: str, job_type: str, blob_key: str, content_hash: str,
+                         in_flight: bool = False, lease_seconds: int = 300, error: str = None):
+    """Registra el archivado pendiente de un original. Con in_flight la subida ya está en curso en este
+    proceso: la tarea nace reclamada (con lease) y solo se reintenta si el proceso muere antes de terminarla."""
+    with db_connection() as conn:
+        cur = conn.cursor()
+        # Si la subida ya falló, el primer reintento espera un minuto (como en fail_archival_task)
+        cur.execute("""
+            INSERT INTO archival_tasks (job_id, invoice_id, user_id, job_type, blob_key, content_hash, status, attempts, last_error, available_at, lease_expires_at)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, 1, %s, NOW() + CASE WHEN %s IS NULL THEN interval '0' ELSE interval '1 minute' END,
+                    CASE WHEN %s THEN NOW() + make_interval(secs => %s) END)
+            RETURNING id
+        """, (job_id, invoice_id, user_id, job_type, blob_key, content_hash, 'processing' if in_flight else 'pending', error,
+              error, in_flight, lease_seconds))
+        task_id = cur.fetchone()[0]
+        conn.commit(); cur.close()
+    return task_id
+
+def claim_archival_tasks(limit: int, lease_seconds: int):
+    """Reclama tareas de archivado vencidas (o cuyo proceso murió con la subida en curso)."""
+    with db_connection() as conn:
+        cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+        cur.execute("""
+            UPDATE archival_tasks t SET status = 'processing', attempts = t.attempts + 1,
+                lease_expires_at = NOW() + make_interval(secs => %s)
+            WHERE t.id IN (
+                SELECT id FROM archival_tasks
+                WHERE status IN ('pending', 'processing') AND available_at <= NOW()
+                  AND (status = 'pending' OR lease_expires_at < NOW())
+                ORDER BY available_at LIMIT %s FOR UPDATE SKIP LOCKED
+            )
+            RETURNING t.id, t.job_id, t.invoice_id, t.user_id, t.job_type, t.blob_key, t.content_hash, t.attempts
+        """, (lease_seconds, limit))
+        claimed = [dict(row) for row in cur.fetchall()]
+        conn.commit(); cur.close()
+    return claimed
+
+def complete_archival_task(task_id: int, invoice_id: int, user_id: str, content_hash: str, file_info: dict):
+    """Adjunta file_info a la factura (y a la caché de extracciones) y cierra la tarea, en una transacción.
+    Devuelve False si la factura ya no existe (se borró mientras se archivaba)."""
+    with db_connection() as conn:
+        cur = conn.cursor()
+        attached = _attach_file_info(cur, invoice_id, user_id, content_hash, file_info)
+        cur.execute("UPDATE archival_tasks SET status = 'done', completed_at = NOW(), lease_expires_at = NULL, last_error = NULL WHERE id = %s", (task_id,))
+        conn.commit(); cur.close()
+    return attached
+
+def attach_file_info(invoice_id: int, user_id: str, content_hash: str, file_info: dict):
+    """Adjunta el file_info de una subida que terminó después de guardar la factura (sin tarea de archivado).
+    Devuelve False si la factura ya no existe."""
+    with db_connection() as conn:
+        cur = conn.cursor()
+        attached = _attach_file_info(cur, invoice_id, user_id, content_hash, file_info)
+        conn.commit(); cur.close()
+    return attached
+
+def _attach_file_info(cur, invoice_id, user_id, content_hash, file_info):
+    cur.execute("UPDATE facturas SET file_info = %s WHERE id = %s AND user_id = %s RETURNING id", (json.dumps(file_info), invoice_id, user_id))
+    attached = cur.fetchone() is not None
+    # Si la factura se borró, quien llama descarta el original: la caché no debe quedarse apuntando a él
+    if attached and content_hash:
+        cur.execute("UPDATE extraction_cache SET file_info = %s WHERE user_id = %s AND content_hash = %s AND file_info IS NULL",
+                    (json.dumps(file_info), user_id, content_hash))
+    return attached
+
+def fail_archival_task(task_id: int, error: str, permanent: bool = False):
+    """Devuelve la tarea a 'pending' con espera exponencial (1, 2, 4... minutos, máx. 1 h) o la marca
+    como 'failed' al agotar ARCHIVAL_MAX_ATTEMPTS. El blob se conserva para poder reintentarla a mano."""
+    with db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute("""
+            UPDATE archival_tasks SET last_error = %s, lease_expires_at = NULL,
+                status = CASE WHEN %s OR attempts >= %s THEN 'failed' ELSE 'pending' END,
+                available_at = NOW() + make_interval(secs => LEAST(3600, 60 * power(2, GREATEST(attempts - 1, 0))))
+            WHERE id = %s
+        """, (error[:1000], permanent, ARCHIVAL_MAX_ATTEMPTS, task_id))
+        conn.commit(); cur.close()
+
+def reset_failed_archival_tasks():
+    """Vuelve a poner en cola las tareas de archivado que agotaron sus intentos."""
+    with db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute("UPDATE archival_tasks SET status = 'pending', attempts = 0, available_at = NOW() WHERE status = 'failed'")
+        count = cur.rowcount; conn.commit(); cur.close()
+    return count
+
+def has_pending_archival(invoice_id: int, user_id: str):
+    with db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT EXISTS (SELECT 1 FROM archival_tasks WHERE invoice_id = %s AND user_id = %s AND status IN ('pending', 'processing'))", (invoice_id, user_id))
+        pending = cur.fetchone()[0]; cur.close()
+    return pending
+
+INVOICE_LIST_FIELDS = ('id', 'emisor', 'cif', 'fecha', 'fecha_date', 'total', 'base_imponible', 'estado', 'moneda', 'notas', 'ia_model', 'created_at')
+INVOICE_LIST_DEFAULT_FIELDS = ('id', 'emisor', 'fecha', 'total', 'estado', 'moneda')
+SQL_FECHA_SORT = "COALESCE(fecha_date, '-infinity'::date)"
+
+def list_invoices(user_id: str, fields=None, limit: int = None, after=None):
+    """Lista paginada por keyset sobre (fecha real, id) usando idx_facturas_user_fecha.
+    `after` es la tupla (fecha_date, id) de la última fila de la página anterior.
+    Devuelve (facturas, siguiente_after) con siguiente_after a None en la última página."""
+    # 'id' siempre se devuelve: el cliente lo necesita para abrir o borrar la factura
+    fields = ['id'] + [f for f in (fields or INVOICE_LIST_DEFAULT_FIELDS) if f in INVOICE_LIST_FIELDS and f != 'id']
+    columns = sorted(set(fields) | {'id', 'fecha_date'}, key=INVOICE_LIST_FIELDS.index)
+    query = f"SELECT {', '.join(columns)} FROM facturas WHERE user_id = %s"
+    params = [user_id]
+    if after is not None:
+        query += f" AND ({SQL_FECHA_SORT}, id) < (COALESCE(%s::date, '-infinity'::date), %s)"
+        params.extend(after)
+    query += f" ORDER BY {SQL_FECHA_SORT} DESC, id DESC"
+    if limit:
+        query += " LIMIT %s"; params.append(limit + 1)
+    with db_connection() as conn:
+        cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+        cur.execute(query, tuple(params))
+        rows = [dict(row) for row in cur.fetchall()]; cur.close()
+    next_after = None
+    if limit and len(rows) > limit:
+        rows = rows[:limit]
+        next_after = (rows[-1]['fecha_date'].isoformat() if rows[-1]['fecha_date'] else None, rows[-1]['id'])
+    for row in rows:
+        if row['fecha_date']: row['fecha_date'] = row['fecha_date'].isoformat()
+    return [{k: row[k] for k in fields} for row in rows], next_after
 
 def get_all_invoices(user_id: str):
-    conn = None
-    try:
-        conn = get_db_connection(); cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
-        # --- AÑADIDA la extracción de 'moneda' ---
-        cur.execute('SELECT id, emisor, fecha, total, estado, moneda FROM facturas WHERE user_id = %s ORDER BY fecha DESC, id DESC', (user_id,))
-        invoices =[dict(row) for row in cur.fetchall()]; cur.close(); return invoices
-    finally:
-        if conn: conn.close()
+    # --- AÑADIDA la extracción de 'moneda' ---
+    return list_invoices(user_id)[0]
 
 def get_invoice_details(invoice_id: int, user_id: str):
-    conn = None
-    try:
-        conn = get_db_connection(); cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+    with db_connection() as conn:
+        cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
         cur.execute('SELECT * FROM facturas WHERE id = %s AND user_id = %s', (invoice_id, user_id))
         invoice = cur.fetchone()
         if not invoice: return None
@@ -241,66 +1302,330 @@ def get_invoice_details(invoice_id: int, user_id: str):
             except: invoice_details['file_info'] = None
 
         cur.close(); return invoice_details
-    finally:
-        if conn: conn.close()
+
+# Una sola consulta: los conceptos de cada factura se agregan en el servidor como JSON
+SQL_INVOICES_WITH_DETAILS = """
+SELECT f.*, COALESCE(c.conceptos, '[]'::json) AS conceptos
+FROM facturas f
+LEFT JOIN LATERAL (
+    SELECT json_agg(json_build_object('descripcion', c.descripcion, 'cantidad', c.cantidad, 'precio_unitario', c.precio_unitario) ORDER BY c.id) AS conceptos
+    FROM conceptos c WHERE c.factura_id = f.id AND c.user_id = f.user_id
+) c ON TRUE
+WHERE f.user_id = %s
+ORDER BY COALESCE(f.fecha_date, '-infinity'::date) DESC, f.id DESC
+"""
 
 def get_all_invoices_with_details(user_id: str):
-    conn = None
-    try:
-        conn = get_db_connection(); cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
-        cur.execute('SELECT * FROM facturas WHERE user_id = %s ORDER BY fecha DESC, id DESC', (user_id,))
-        facturas = cur.fetchall(); invoices_list =[]
-        for f in facturas:
-            details = dict(f); factura_id = details['id']
-            cur.execute('SELECT descripcion, cantidad, precio_unitario FROM conceptos WHERE factura_id = %s AND user_id = %s', (factura_id, user_id))
-            details['conceptos'] = [dict(row) for row in cur.fetchall()]
-            invoices_list.append(details)
+    with db_connection() as conn:
+        cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+        cur.execute(SQL_INVOICES_WITH_DETAILS, (user_id,))
+        invoices_list = [dict(row) for row in cur.fetchall()]
         cur.close(); return invoices_list
-    finally:
-        if conn: conn.close()
 
-def search_invoices(user_id: str, text_query=None, date_from=None, date_to=None):
-    conn = None
-    try:
-        conn = get_db_connection(); cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
-        # --- AÑADIDA la extracción de 'moneda' en búsqueda ---
-        query = "SELECT DISTINCT f.id, f.emisor, f.fecha, f.total, f.estado, f.moneda FROM facturas f LEFT JOIN conceptos c ON f.id=c.factura_id WHERE f.user_id = %s"
-        params = [user_id]
-        if text_query:
-            query += " AND (LOWER(f.emisor) LIKE %s OR LOWER(c.descripcion) LIKE %s)"
-            params.extend([f'%{text_query.lower()}%', f'%{text_query.lower()}%'])
-        if date_from:
-            query += " AND TO_DATE(f.fecha, 'DD/MM/YYYY') >= TO_DATE(%s, 'YYYY-MM-DD')"
-            params.append(date_from)
-        if date_to:
-            query += " AND TO_DATE(f.fecha, 'DD/MM/YYYY') <= TO_DATE(%s, 'YYYY-MM-DD')"
-            params.append(date_to)
-        query += " ORDER BY f.fecha DESC, f.id DESC"
-        cur.execute(query, tuple(params)); return[dict(row) for row in cur.fetchall()]
-    finally:
-        if conn: conn.close()
+def iter_invoices_with_details(user_id: str, fetch_size: int = 500):
+    """Igual que get_all_invoices_with_details pero en streaming: un cursor con nombre (del lado del
+    servidor) trae las filas de `fetch_size` en `fetch_size`. La conexión se devuelve al pool al
+    agotar o cerrar el generador."""
+    with db_connection() as conn:
+        cur = conn.cursor(name=f'invoices_{uuid.uuid4().hex}', cursor_factory=psycopg2.extras.DictCursor)
+        cur.itersize = fetch_size
+        try:
+            cur.execute(SQL_INVOICES_WITH_DETAILS, (user_id,))
+            for row in cur: yield dict(row)
+        finally:
+            cur.close(); conn.rollback()
+
+EXPORT_FETCH_SIZE = int(os.environ.get('EXPORT_FETCH_SIZE', '2000'))
+EXPORT_INVOICE_FIELDS = ('id', 'fecha', 'fecha_date', 'emisor', 'cif', 'base_imponible', 'total', 'moneda', 'estado', 'notas', 'ia_model', 'created_at')
+EXPORT_CONCEPT_FIELDS = ('descripcion', 'cantidad', 'precio_unitario')
+
+def iter_invoice_export(user_id: str, date_from=None, date_to=None, estado=None, moneda=None, fetch_size: int = None):
+    """Facturas del usuario en orden cronológico con sus conceptos, para exportar. Es un JOIN plano (una fila por
+    concepto; como en get_invoice_details se omiten los conceptos sin descripción y la factura que no tiene
+    ninguno sale una vez) leído con un cursor con nombre de `fetch_size` en `fetch_size` filas: la memoria no
+    depende del número de facturas. Produce tuplas (factura, concepto): la factura es un dict con los impuestos
+    ya decodificados (el mismo objeto para todos sus conceptos) y el concepto un dict o None."""
+    where, params = _invoice_filter_sql(date_from=date_from, date_to=date_to, estado=estado, moneda=moneda)
+    sql = f"""
+        SELECT {', '.join('f.' + field for field in EXPORT_INVOICE_FIELDS)}, f.impuestos_json,
+               {', '.join(f'c.{field} AS concepto_{field}' for field in EXPORT_CONCEPT_FIELDS)}
+        FROM facturas f
+        LEFT JOIN conceptos c ON c.factura_id = f.id AND c.user_id = f.user_id AND c.descripcion <> ''
+        WHERE {' AND '.join(["f.user_id = %s"] + where)}
+        ORDER BY {SQL_FECHA_SORT}, f.id, c.id
+    """
+    with db_connection() as conn:
+        # Tuplas y no DictCursor: construir un DictRow por fila duplicaba el tiempo de exportar 100k conceptos
+        cur = conn.cursor(name=f'export_{uuid.uuid4().hex}')
+        cur.itersize = fetch_size or EXPORT_FETCH_SIZE
+        n_fields = len(EXPORT_INVOICE_FIELDS)
+        try:
+            cur.execute(sql, [user_id] + params)
+            invoice = None
+            for row in cur:
+                if invoice is None or invoice['id'] != row[0]:
+                    invoice = dict(zip(EXPORT_INVOICE_FIELDS, row))
+                    impuestos = row[n_fields]
+                    if isinstance(impuestos, str):
+                        try: impuestos = json.loads(impuestos)
+                        except ValueError: impuestos = None
+                    invoice['impuestos'] = impuestos or {}
+                concepto = dict(zip(EXPORT_CONCEPT_FIELDS, row[n_fields + 1:])) if row[n_fields + 1] is not None else None
+                yield invoice, concepto
+        finally:
+            cur.close(); conn.rollback()
+
+def get_invoices_with_details_by_ids(user_id: str, invoice_ids):
+    if not invoice_ids: return []
+    sql = SQL_INVOICES_WITH_DETAILS.replace("WHERE f.user_id = %s", "WHERE f.user_id = %s AND f.id = ANY(%s)")
+    with db_connection() as conn:
+        cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+        cur.execute(sql, (user_id, list(invoice_ids)))
+        invoices_list = [dict(row) for row in cur.fetchall()]
+        cur.close(); return invoices_list
+
+INVOICE_AGGREGATE_GROUPS = {
+    'emisor': "f.emisor",
+    'mes': "to_char(f.fecha_date, 'YYYY-MM')",
+    'estado': "f.estado",
+}
+
+def aggregate_invoices(user_id: str, group_by=None, limit=None, **filters):
+    """Número, suma, media, máximo y mínimo de `total` por moneda (nunca se suman divisas distintas),
+    opcionalmente agrupado también por emisor, mes o estado. Los filtros son los de _invoice_filter_sql."""
+    where, params = _invoice_filter_sql(**filters)
+    group = INVOICE_AGGREGATE_GROUPS[group_by] if group_by else None
+    columns = f"{group} AS grupo, " if group else ""
+    order = "ORDER BY grupo DESC" if group_by == 'mes' else "ORDER BY total DESC"
+    sql = f"""
+        SELECT {columns}COALESCE(f.moneda, '€') AS moneda, COUNT(*) AS facturas, COALESCE(SUM(f.total), 0) AS total,
+               AVG(f.total) AS media, MAX(f.total) AS maximo, MIN(f.total) AS minimo
+        FROM facturas f WHERE {' AND '.join(["f.user_id = %s"] + where)}
+        GROUP BY {'1, 2' if group else '1'} {order}
+    """
+    if limit:
+        sql += " LIMIT %s"; params.append(limit)
+    with db_connection() as conn:
+        cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+        cur.execute(sql, [user_id] + params)
+        rows = [dict(row) for row in cur.fetchall()]; cur.close()
+    for row in rows:
+        for key in ('total', 'media', 'maximo', 'minimo'):
+            row[key] = round(float(row[key]), 2) if row[key] is not None else None
+    return rows
+
+def extreme_invoices(user_id: str, highest: bool = True, **filters):
+    """La factura de mayor (o menor) importe de cada moneda que cumple los filtros."""
+    where, params = _invoice_filter_sql(**filters)
+    direction = "DESC" if highest else "ASC"
+    with db_connection() as conn:
+        cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+        cur.execute(f"""
+            SELECT DISTINCT ON (COALESCE(f.moneda, '€')) f.id, f.emisor, f.fecha, f.total, COALESCE(f.moneda, '€') AS moneda
+            FROM facturas f WHERE {' AND '.join(["f.user_id = %s", "f.total IS NOT NULL"] + where)}
+            ORDER BY COALESCE(f.moneda, '€'), f.total {direction}, f.id DESC
+        """, [user_id] + params)
+        rows = [dict(row) for row in cur.fetchall()]; cur.close()
+    return rows
+
+def get_query_vocabulary(user_id: str):
+    """Emisores y monedas distintos del usuario, para reconocerlos en las preguntas a la IA."""
+    with db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT DISTINCT emisor FROM facturas WHERE user_id = %s AND emisor IS NOT NULL", (user_id,))
+        emisores = [row[0] for row in cur.fetchall()]
+        cur.execute("SELECT DISTINCT moneda FROM facturas WHERE user_id = %s AND moneda IS NOT NULL", (user_id,))
+        monedas = [row[0] for row in cur.fetchall()]
+        cur.close()
+    return emisores, monedas
+
+SEARCH_PAGE_MAX = 100
+_has_trigram = None
+
+def search_supports_trigram():
+    global _has_trigram
+    if _has_trigram is None:
+        with db_connection() as conn:
+            cur = conn.cursor()
+            cur.execute("SELECT EXISTS (SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm')")
+            _has_trigram = cur.fetchone()[0]; cur.close()
+    return _has_trigram
+
+def _prefix_tsquery(text_query: str, operator: str = '&'):
+    terms = re.findall(r'\w+', text_query.lower())
+    return f' {operator} '.join(f"{term}:*" for term in terms)
+
+def _invoice_filter_sql(date_from=None, date_to=None, min_total=None, max_total=None, estado=None, moneda=None, emisores=None):
+    """Condiciones comunes a búsquedas y agregados (sobre el alias `f`). Devuelve (condiciones, parámetros)."""
+    where, params = [], []
+    if date_from:
+        where.append(f"{SQL_FECHA_SORT} >= %s::date"); params.append(date_from)
+    if date_to:
+        where.append(f"f.fecha_date IS NOT NULL AND {SQL_FECHA_SORT} <= %s::date"); params.append(date_to)
+    if min_total is not None:
+        where.append("f.total >= %s"); params.append(min_total)
+    if max_total is not None:
+        where.append("f.total <= %s"); params.append(max_total)
+    if estado:
+        where.append("f.estado = %s"); params.append(estado)
+    if moneda:
+        where.append("f.moneda = %s"); params.append(moneda)
+    if emisores:
+        where.append("f.emisor = ANY(%s)"); params.append(list(emisores))
+    return where, params
+
+def _escape_like(text: str) -> str:
+    """El texto del usuario se busca literal: '%', '_' y '\\' no son comodines."""
+    return text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+def _build_search_query(user_id: str, text_query=None, date_from=None, date_to=None, min_total=None, max_total=None,
+                        estado=None, moneda=None, limit: int = 20, offset: int = 0, match_any: bool = False):
+    select = "SELECT f.id, f.emisor, f.cif, f.fecha, f.fecha_date, f.total, f.estado, f.moneda"
+    where, params, select_params = ["f.user_id = %s"], [user_id], []
+    order = f"ORDER BY {SQL_FECHA_SORT} DESC, f.id DESC"
+    tsquery = _prefix_tsquery(text_query, '|' if match_any else '&') if text_query else None
+    if text_query and (tsquery or search_supports_trigram()):
+        text_conditions = []
+        rank = "0"
+        if tsquery:
+            text_conditions.append(f"{SQL_SEARCH_TSVECTOR} @@ to_tsquery('simple', %s)")
+            params.append(tsquery)
+            rank = f"ts_rank({SQL_SEARCH_TSVECTOR}, to_tsquery('simple', %s))"
+            select_params.append(tsquery)
+        if search_supports_trigram():
+            # Subcadenas (CIF parciales, fragmentos de palabra) vía índice trigram
+            text_conditions.append("f.search_text ILIKE %s ESCAPE '\\'")
+            params.append(f"%{_escape_like(text_query)}%")
+            rank += " + similarity(f.search_text, %s)"
+            select_params.append(text_query)
+        where.append(f"({' OR '.join(text_conditions)})")
+        select += f", {rank} AS score"
+        order = "ORDER BY score DESC, f.id DESC"
+    filter_where, filter_params = _invoice_filter_sql(date_from, date_to, min_total, max_total, estado, moneda)
+    where += filter_where; params += filter_params
+    sql = f"{select} FROM facturas f WHERE {' AND '.join(where)} {order} LIMIT %s OFFSET %s"
+    return sql, tuple(select_params + params + [limit, offset])
+
+def search_invoices(user_id: str, text_query=None, date_from=None, date_to=None, min_total=None, max_total=None,
+                    estado=None, moneda=None, page: int = 1, page_size: int = 20, match_any: bool = False):
+    """Búsqueda paginada: por relevancia si hay texto, si no por fecha. Devuelve (resultados, hay_más).
+    Con match_any basta con que coincida uno de los términos (recuperación de contexto para la IA)."""
+    page_size = max(1, min(page_size, SEARCH_PAGE_MAX))
+    sql, params = _build_search_query(user_id, text_query, date_from, date_to, min_total, max_total, estado, moneda,
+                                      limit=page_size + 1, offset=(max(1, page) - 1) * page_size, match_any=match_any)
+    with db_connection() as conn:
+        cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+        cur.execute(sql, params)
+        rows = [dict(row) for row in cur.fetchall()]; cur.close()
+    for row in rows:
+        if row['fecha_date']: row['fecha_date'] = row['fecha_date'].isoformat()
+        if 'score' in row: row['score'] = round(float(row['score']), 4)
+    return rows[:page_size], len(rows) > page_size
+
+def backfill_search_text(batch_size: int = 5000):
+    """Recalcula search_text de todas las facturas por lotes (tras cambiar SQL_SEARCH_TEXT)."""
+    total, last_id = 0, 0
+    with db_connection() as conn:
+        cur = conn.cursor()
+        while True:
+            cur.execute(f"""
+                UPDATE facturas f SET search_text = {SQL_SEARCH_TEXT}
+                WHERE f.id IN (SELECT id FROM facturas WHERE id > %s ORDER BY id LIMIT %s)
+                RETURNING f.id
+            """, (last_id, batch_size))
+            ids = [row[0] for row in cur.fetchall()]; conn.commit()
+            if not ids: break
+            total += len(ids); last_id = max(ids)
+        cur.close()
+    return total
+
+def backfill_fecha_date(batch_size: int = 5000):
+    """Rellena fecha_date de las facturas que no la tienen por lotes de ids. Devuelve cuántas se han rellenado."""
+    total, last_id = 0, 0
+    with db_connection() as conn:
+        cur = conn.cursor()
+        while True:
+            cur.execute("""
+                WITH batch AS (SELECT id FROM facturas WHERE id > %s ORDER BY id LIMIT %s),
+                updated AS (
+                    UPDATE facturas f SET fecha_date = parse_fecha_factura(f.fecha) FROM batch
+                    WHERE f.id = batch.id AND f.fecha_date IS NULL AND parse_fecha_factura(f.fecha) IS NOT NULL
+                    RETURNING f.id
+                )
+                SELECT (SELECT MAX(id) FROM batch), (SELECT COUNT(*) FROM updated)
+            """, (last_id, batch_size))
+            batch_last, updated = cur.fetchone(); conn.commit()
+            if batch_last is None: break
+            total += updated; last_id = batch_last
+        cur.close()
+    return total
+
+def pending_backfills():
+    """Comandos de manage.py que faltan por ejecutar tras migrar una base de datos anterior al versionado."""
+    with db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute("""
+            SELECT EXISTS (SELECT 1 FROM facturas WHERE fecha_date IS NULL AND parse_fecha_factura(fecha) IS NOT NULL),
+                   EXISTS (SELECT 1 FROM facturas WHERE search_text IS NULL),
+                   NOT EXISTS (SELECT 1 FROM user_invoice_stats) AND EXISTS (SELECT 1 FROM facturas WHERE user_id IS NOT NULL)
+        """)
+        dates, search, stats = cur.fetchone(); cur.close()
+    return [command for command, needed in (('backfill-dates', dates), ('backfill-search', search), ('rebuild-stats', stats)) if needed]
+
+def explain_search_invoices(user_id: str, **filters):
+    """Plan real (EXPLAIN ANALYZE) de search_invoices, para comprobar que la búsqueda va por índices."""
+    sql, params = _build_search_query(user_id, **filters)
+    with db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute("EXPLAIN (ANALYZE, BUFFERS) " + sql, params)
+        plan = [row[0] for row in cur.fetchall()]; cur.close(); conn.rollback()
+        return plan
 
 def delete_invoice(invoice_id: int, user_id: str):
-    conn = None
-    try:
-        conn = get_db_connection(); cur = conn.cursor()
-        cur.execute("DELETE FROM facturas WHERE id = %s AND user_id = %s RETURNING id", (invoice_id, user_id))
-        was_deleted = cur.fetchone() is not None; conn.commit(); cur.close()
-        return was_deleted
-    finally:
-        if conn: conn.close()
+    with db_connection() as conn:
+        cur = conn.cursor()
+        # FOR UPDATE: nadie puede cambiar la factura entre restarla del resumen y borrarla
+        cur.execute("SELECT id FROM facturas WHERE id = %s AND user_id = %s FOR UPDATE", (invoice_id, user_id))
+        if cur.fetchone() is None:
+            conn.rollback(); cur.close(); return False
+        _apply_stats_delta(cur, user_id, [invoice_id], -1)
+        cur.execute("DELETE FROM facturas WHERE id = %s AND user_id = %s", (invoice_id, user_id))
+        bump_collection_version(cur, user_id)
+        conn.commit(); cur.close()
+        return True
+
+INVOICE_ESTADOS = ('Pendiente', 'Pagada')
+
+def update_invoice_estado(invoice_id: int, user_id: str, estado: str):
+    """Cambia el estado de una factura moviendo su importe de fila en el resumen, en la misma transacción."""
+    with db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT estado FROM facturas WHERE id = %s AND user_id = %s FOR UPDATE", (invoice_id, user_id))
+        row = cur.fetchone()
+        if row is None:
+            conn.rollback(); cur.close(); return False
+        if row[0] != estado:
+            _apply_stats_delta(cur, user_id, [invoice_id], -1)
+            cur.execute("UPDATE facturas SET estado = %s WHERE id = %s AND user_id = %s", (estado, invoice_id, user_id))
+            _apply_stats_delta(cur, user_id, [invoice_id], 1)
+            bump_collection_version(cur, user_id)
+        conn.commit(); cur.close()
+        return True
 
 def update_invoice_notes(invoice_id: int, user_id: str, notes: str):
-    conn = None
     try:
-        conn = get_db_connection(); cur = conn.cursor()
-        cur.execute("UPDATE facturas SET notas = %s WHERE id = %s AND user_id = %s RETURNING id", (notes, invoice_id, user_id))
-        was_updated = cur.fetchone() is not None
-        conn.commit(); cur.close()
-        return was_updated
+        with db_connection() as conn:
+            cur = conn.cursor()
+            cur.execute("UPDATE facturas SET notas = %s WHERE id = %s AND user_id = %s RETURNING id", (notes, invoice_id, user_id))
+            was_updated = cur.fetchone() is not None
+            if was_updated:
+                cur.execute(f"UPDATE facturas f SET search_text = {SQL_SEARCH_TEXT} WHERE f.id = %s", (invoice_id,))
+                bump_collection_version(cur, user_id)
+            conn.commit(); cur.close()
+            return was_updated
     except Exception as e:
         print(f"Error en update_invoice_notes: {e}")
-        if conn: conn.rollback()
         return False
-    finally:
-        if conn: conn.close()
\ No newline at end of file
+
+# Un span por función pública de acceso a datos (app_stage_duration_seconds{stage="db.<función>"})
+metrics.instrument_module(globals(), 'db', exclude={'get_pool', 'pool_stats', 'db_connection', 'compute_user_status', 'to_float', 'bump_collection_version'})
@@ -0,0 +1,91 @@
+import json
+import time
+import threading
+
+class FakeProviderError(Exception):
+    """Imita google.api_core.exceptions: el código HTTP va en `code` (429, 503, 400...)."""
+
+    def __init__(self, code: int, message: str = ''):
+        super().__init__(f"{code} {message}".strip())
+        self.code = code
+
+class FakeResponse:
+    def __init__(self, text: str):
+        self.text = text
+
+DEFAULT_INVOICE = {
+    "emisor": "Proveedor de Prueba SL", "cif": "B00000000", "fecha": "15/01/2024", "total": 121.0,
+    "base_imponible": 100.0, "estado": "Pendiente", "moneda": "€",
+    "conceptos": [{"descripcion": "Servicio de prueba", "cantidad": 1.0, "precio_unitario": 100.0}],
+}
+
+class FakeModel:
+    """Sustituto local de genai.GenerativeModel para pruebas y benchmarks: latencia configurable,
+    errores programados (p.ej. [429, 429, None] = dos rate limits y después éxito) y respuestas fijas.
+    Si la latencia supera el timeout de request_options responde con 504 como el proveedor real."""
+
+    def __init__(self, latency: float = 0.0, errors=None, response=None, answer=None):
+        self.latency = latency
+        self.errors = list(errors or [])
+        self.response = response if response is not None else DEFAULT_INVOICE
+        self.answer = answer or {"answer": "Respuesta de prueba.", "invoice_id": None}
+        self.calls, self.active, self.max_active = 0, 0, 0
+        self._lock = threading.Lock()
+
+    def generate_content(self, contents, request_options=None, **kwargs):
+        with self._lock:
+            self.calls += 1
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+            error = self.errors.pop(0) if self.errors else None
+        try:
+            timeout = (request_options or {}).get('timeout')
+            if timeout is not None and self.latency > timeout:
+                time.sleep(timeout)
+                raise FakeProviderError(504, "Deadline Exceeded")
+            if self.latency: time.sleep(self.latency)
+            if error: raise FakeProviderError(error)
+            # Las consultas de /api/ai/query son un único prompt de texto; las extracciones, una lista de partes
+            payload = self.answer if isinstance(contents, str) else self.response
+            return FakeResponse(json.dumps(payload, ensure_ascii=False))
+        finally:
+            with self._lock: self.active -= 1
+
+class FakeVerifier:
+    """Sustituto de firebase auth.verify_id_token: el token es directamente el uid ('bench-1' -> uid bench-1)."""
+
+    def __init__(self, latency: float = 0.0):
+        self.latency, self.calls = latency, 0
+
+    def __call__(self, id_token: str):
+        self.calls += 1
+        if self.latency: time.sleep(self.latency)
+        return {'uid': id_token, 'email': f"{id_token}@bench.local", 'exp': time.time() + 3600}
+
+class FakeUploader:
+    """Sustituto de cloudinary.uploader: consume el stream como la subida real y devuelve un public_id inventado."""
+
+    def __init__(self, latency: float = 0.0, errors=None):
+        self.latency, self.errors = latency, list(errors or [])
+        self.uploads, self.destroyed, self.bytes = 0, 0, 0
+        self._lock = threading.Lock()
+
+    def upload(self, file=None, **params):
+        size = 0
+        if hasattr(file, 'read'):
+            while True:
+                chunk = file.read(64 * 1024)
+                if not chunk: break
+                size += len(chunk)
+        if self.latency: time.sleep(self.latency)
+        with self._lock:
+            error = self.errors.pop(0) if self.errors else None
+            if error: raise FakeProviderError(error)
+            self.uploads += 1
+            self.bytes += size
+            n = self.uploads
+        return {"public_id": f"{params.get('folder', 'fake')}/fake-{n}", "resource_type": params.get('resource_type', 'image'), "format": params.get('format', 'jpg')}
+
+    def destroy(self, public_id, **params):
+        with self._lock: self.destroyed += 1
+        return {"result": "ok"}
@@ -0,0 +1,118 @@
+import os
+import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+import database as db
+import metrics
+
+TOKEN_CACHE_SIZE = int(os.environ.get('TOKEN_CACHE_SIZE', '2048'))
+USER_CACHE_SIZE = int(os.environ.get('USER_CACHE_SIZE', '2048'))
+USER_CACHE_TTL = float(os.environ.get('USER_CACHE_TTL', '30'))
+
+class TTLCache:
+    """LRU acotado en el que cada entrada caduca en un instante absoluto (time.time())."""
+
+    def __init__(self, maxsize: int, ttl: float = None):
+        self.maxsize, self.ttl = max(1, maxsize), ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None or item[1] <= time.time():
+                if item is not None: del self._data[key]
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[0]
+
+    def set(self, key, value, expires_at: float = None):
+        if expires_at is None:
+            if self.ttl is None: raise ValueError("Se necesita expires_at o un ttl por defecto")
+            expires_at = time.time() + self.ttl
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize: self._data.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            item = self._data.pop(key, None)
+            return item[0] if item else None
+
+    def clear(self):
+        with self._lock: self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            return {'size': len(self._data), 'maxsize': self.maxsize, 'hits': self.hits, 'misses': self.misses}
+
+_claims_cache = TTLCache(TOKEN_CACHE_SIZE)
+_user_cache = TTLCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+_verifier = None
+
+_firebase_lock = threading.Lock()
+_firebase_initialized = False
+
+def _init_firebase():
+    # Se inicializa con la primera verificación de token, no al importar la app
+    global _firebase_initialized
+    if _firebase_initialized: return
+    import firebase_admin
+    from firebase_admin import credentials
+    with _firebase_lock:
+        if _firebase_initialized or firebase_admin._apps: return
+        _firebase_initialized = True
+        try:
+            firebase_sdk_json_str = os.environ.get("FIREBASE_ADMIN_SDK_JSON")
+            if not firebase_sdk_json_str: raise ValueError("FIREBASE_ADMIN_SDK_JSON no configurada.")
+            firebase_admin.initialize_app(credentials.Certificate(json.loads(firebase_sdk_json_str)))
+            print("Firebase Admin SDK inicializado.")
+        except Exception as e:
+            print(f"ERROR CRÍTICO al inicializar Firebase: {e}")
+
+def _firebase_verifier(id_token: str):
+    _init_firebase()
+    from firebase_admin import auth
+    return auth.verify_id_token(id_token)
+
+def set_token_verifier(verifier):
+    """Sustituye la verificación de Firebase (p.ej. por un verificador local en benchmarks)."""
+    global _verifier
+    _verifier = verifier
+    _claims_cache.clear()
+
+def verify_token(id_token: str):
+    # Clave por hash: no guardamos tokens en claro en memoria más de lo necesario
+    key = hashlib.sha256(id_token.encode('utf-8')).hexdigest()
+    claims = _claims_cache.get(key)
+    if claims is not None: return claims
+    with metrics.span('auth.verify_token'): claims = (_verifier or _firebase_verifier)(id_token)
+    exp = claims.get('exp')
+    if exp: _claims_cache.set(key, claims, expires_at=float(exp))
+    return claims
+
+def resolve_user(firebase_uid: str, email: str = None):
+    """Devuelve (user, status) cacheados por uid durante USER_CACHE_TTL segundos."""
+    cached = _user_cache.get(firebase_uid)
+    if cached is not None: return cached
+    user = db.get_or_create_user(firebase_uid, email)
+    status = db.compute_user_status(user)
+    expires_at = time.time() + USER_CACHE_TTL
+    if status.get('status') == 'trial_active':
+        # El estado cacheado no debe sobrevivir al final del periodo de prueba
+        expires_at = min(expires_at, user['trial_end_date'].timestamp())
+    resolved = (user, status)
+    _user_cache.set(firebase_uid, resolved, expires_at=expires_at)
+    return resolved
+
+def invalidate_user(firebase_uid: str):
+    _user_cache.pop(firebase_uid)
+
+def cache_stats():
+    return {'tokens': _claims_cache.stats(), 'users': _user_cache.stats()}
@@ -0,0 +1,65 @@
+import os
+import io
+import time
+from collections import namedtuple
+from PIL import Image, ImageOps
+import metrics
+
+IMAGE_MAX_EDGE = int(os.environ.get('IMAGE_MAX_EDGE', '2048'))
+IMAGE_TARGET_BYTES = int(os.environ.get('IMAGE_TARGET_BYTES', str(1536 * 1024)))
+IMAGE_GRAYSCALE = os.environ.get('IMAGE_GRAYSCALE', '').lower() in ('1', 'true', 'yes')
+IMAGE_JPEG_QUALITY = int(os.environ.get('IMAGE_JPEG_QUALITY', '85'))
+IMAGE_MIN_JPEG_QUALITY = 50
+
+NormalizedImage = namedtuple('NormalizedImage', ['data', 'mime_type', 'stats'])
+
+def _encode(img, target_bytes: int):
+    """Re-codifica a JPEG bajando la calidad (y si no basta, la resolución) hasta caber en target_bytes."""
+    while True:
+        for quality in range(IMAGE_JPEG_QUALITY, IMAGE_MIN_JPEG_QUALITY - 1, -10):
+            buf = io.BytesIO()
+            img.save(buf, 'JPEG', quality=quality, optimize=True)
+            if buf.tell() <= target_bytes: return buf.getvalue(), img
+        if max(img.size) <= 256: return buf.getvalue(), img
+        img = img.resize((max(1, int(img.width * 0.75)), max(1, int(img.height * 0.75))), Image.LANCZOS)
+
+@metrics.timed('image.normalize')
+def normalize_image(source, original_bytes: int, max_edge: int = IMAGE_MAX_EDGE, target_bytes: int = IMAGE_TARGET_BYTES, grayscale: bool = IMAGE_GRAYSCALE):
+    """Aplica la orientación EXIF, reduce al lado máximo configurado, convierte opcionalmente a grises
+    y re-codifica dentro del presupuesto de bytes. En JPEG usa Image.draft para que el decodificador
+    escale por DCT y una foto de 12 MP nunca se decodifique a resolución completa."""
+    started = time.perf_counter()
+    img = Image.open(source)
+    original_format, (original_w, original_h) = img.format, img.size
+    used_draft = False
+    if original_format == 'JPEG':
+        used_draft = img.draft('L' if grayscale else 'RGB', (max_edge, max_edge)) is not None
+    orientation = img.getexif().get(0x0112, 1)
+    img = ImageOps.exif_transpose(img)
+    if grayscale: img = img.convert('L')
+    elif img.mode in ('RGBA', 'LA', 'P'):
+        img = img.convert('RGBA')
+        background = Image.new('RGB', img.size, 'white'); background.paste(img, mask=img.getchannel('A'))
+        img = background
+    elif img.mode != 'RGB': img = img.convert('RGB')
+    img.thumbnail((max_edge, max_edge), Image.LANCZOS)
+    unchanged = original_format == 'JPEG' and orientation == 1 and img.size == (original_w, original_h) and img.mode == 'RGB'
+    if unchanged and original_bytes <= target_bytes:
+        # Ya cumple todos los límites: re-codificarlo solo perdería calidad
+        source.seek(0); data = source.read()
+    else:
+        data, img = _encode(img, target_bytes)
+    stats = {
+        'format': original_format, 'draft': used_draft,
+        'original_bytes': original_bytes, 'bytes': len(data),
+        'original_pixels': original_w * original_h, 'pixels': img.width * img.height,
+        'size': [img.width, img.height],
+        'byte_reduction': round(1 - len(data) / original_bytes, 3) if original_bytes else 0.0,
+        'pixel_reduction': round(1 - (img.width * img.height) / (original_w * original_h), 3) if original_w * original_h else 0.0,
+        'ms': round((time.perf_counter() - started) * 1000, 1),
+    }
+    return NormalizedImage(data, 'image/jpeg', stats)
+
+def as_model_part(normalized: NormalizedImage):
+    # Se envían exactamente los bytes ya presupuestados, sin que el SDK vuelva a codificar la imagen
+    return {'mime_type': normalized.mime_type, 'data': normalized.data}
@@ -0,0 +1,130 @@
+import os
+import json
+import time
+import queue
+import select
+import threading
+import psycopg2.extensions
+import database as db
+
+# Cada cuánto se despierta el hilo de escucha aunque no haya notificaciones (para detectar cierres)
+LISTEN_POLL_SECONDS = 5.0
+SUBSCRIBER_QUEUE_SIZE = 1000
+# Cuánto espera subscribe() a que el LISTEN esté activo (la primera vez, o mientras se reconecta)
+LISTEN_READY_TIMEOUT = float(os.environ.get('JOB_EVENTS_READY_TIMEOUT', '2'))
+
+class Subscription:
+    """Eventos de trabajos de un usuario. Si la escucha se reconecta llega un evento {'type': 'resync'}:
+    pudo perderse alguna notificación y hay que volver a consultar el estado en la base de datos."""
+
+    def __init__(self, hub, user_id: str):
+        self.hub, self.user_id = hub, user_id
+        self.events = queue.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+
+    def put(self, event: dict):
+        try: self.events.put_nowait(event)
+        except queue.Full:
+            # Consumidor lento: se descarta lo acumulado y se le pide que resincronice
+            with self.events.mutex: self.events.queue.clear()
+            self.events.put_nowait({'type': 'resync'})
+
+    def get(self, timeout: float):
+        try: return self.events.get(timeout=max(0.0, timeout))
+        except queue.Empty: return None
+
+    def close(self):
+        self.hub.unsubscribe(self)
+
+    def __enter__(self): return self
+    def __exit__(self, *exc): self.close()
+
+class JobEventHub:
+    """Un único LISTEN por proceso sobre una conexión propia (fuera del pool) que reparte las
+    notificaciones de job_queue entre las peticiones en espera (long-poll y SSE) del mismo usuario."""
+
+    def __init__(self):
+        self.pid = os.getpid()
+        self._subscribers = {}
+        self._lock = threading.Lock()
+        self._thread = None
+        self._listening = threading.Event()
+        self._missed = False  # Alguna suscripción no esperó al LISTEN: al conectar se les pide resincronizar
+        self.stats = {'notifications': 0, 'delivered': 0, 'reconnects': 0}
+
+    def subscribe(self, user_id: str) -> Subscription:
+        """Devuelve la suscripción con el LISTEN ya activo: una notificación posterior no se pierde.
+        Si la escucha no está lista a tiempo, la suscripción recibirá 'resync' en cuanto lo esté."""
+        subscription = Subscription(self, user_id)
+        with self._lock:
+            self._subscribers.setdefault(user_id, set()).add(subscription)
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='job-events', daemon=True)
+                self._thread.start()
+        if not self._listening.wait(LISTEN_READY_TIMEOUT):
+            with self._lock: self._missed = True
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        with self._lock:
+            subscribers = self._subscribers.get(subscription.user_id)
+            if subscribers:
+                subscribers.discard(subscription)
+                if not subscribers: del self._subscribers[subscription.user_id]
+
+    def subscriber_count(self):
+        with self._lock: return sum(len(s) for s in self._subscribers.values())
+
+    def _dispatch(self, event: dict, user_id: str = None):
+        with self._lock:
+            targets = [s for uid, subs in self._subscribers.items() if user_id is None or uid == user_id for s in subs]
+        for subscription in targets: subscription.put(event)
+        self.stats['delivered'] += len(targets)
+
+    def _run(self):
+        backoff, connected_before = 1.0, False
+        while True:
+            conn = None
+            try:
+                conn = db.get_db_connection()
+                conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+                cur = conn.cursor()
+                cur.execute(f"LISTEN {db.JOB_EVENTS_CHANNEL}")
+                with self._lock:
+                    self._listening.set()
+                    missed, self._missed = self._missed, False
+                if connected_before: self.stats['reconnects'] += 1
+                if connected_before or missed: self._dispatch({'type': 'resync'})
+                connected_before, backoff = True, 1.0
+                while True:
+                    if select.select([conn], [], [], LISTEN_POLL_SECONDS) == ([], [], []): continue
+                    conn.poll()
+                    while conn.notifies:
+                        notify = conn.notifies.pop(0)
+                        self.stats['notifications'] += 1
+                        try: event = json.loads(notify.payload)
+                        except ValueError: continue
+                        event['type'] = 'job'
+                        self._dispatch(event, event.get('user_id'))
+            except Exception as e:
+                self._listening.clear()
+                print(f"⚠️ Escucha de eventos de trabajos caída, reconectando en {backoff:.0f}s: {e}")
+                time.sleep(backoff)
+                backoff = min(backoff * 2, 30.0)
+            finally:
+                if conn is not None:
+                    try: conn.close()
+                    except Exception: pass
+
+_hub = None
+_hub_lock = threading.Lock()
+
+def get_hub() -> JobEventHub:
+    global _hub
+    # Igual que el pool: tras un fork el hilo de escucha del padre no existe en el hijo
+    if _hub is None or _hub.pid != os.getpid():
+        with _hub_lock:
+            if _hub is None or _hub.pid != os.getpid(): _hub = JobEventHub()
+    return _hub
+
+def subscribe(user_id: str) -> Subscription:
+    return get_hub().subscribe(user_id)
@@ -0,0 +1,138 @@
+import os
+import re
+import sys
+import json
+import argparse
+import subprocess
+import database as db
+
+# Presupuesto por defecto de `manage.py importtime` para el arranque en frío de app.py
+IMPORT_BUDGET_MS = float(os.environ.get('IMPORT_BUDGET_MS', '400'))
+# Módulos que no deben cargarse al importar app.py: se importan en la primera petición que los usa
+LAZY_MODULES = ('google.generativeai', 'firebase_admin', 'cloudinary', 'pypdf', 'PIL')
+_IMPORTTIME_RE = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)')
+
+def cmd_migrate(args):
+    if args.status:
+        version = db.get_schema_version()
+        for number, name, _ in db.MIGRATIONS: print(f"{'✅' if number <= version else '⏳'} {number:03d} {name}")
+        print(f"Versión aplicada: {version}; versión del código: {db.SCHEMA_VERSION}")
+        return
+    applied = db.migrate(args.target)
+    print(f"{len(applied)} migración(es) aplicada(s); esquema en la versión {db.get_schema_version()}.")
+    # La migración 001 sobre una base de datos con facturas deja los datos derivados para los backfills por lotes
+    if 1 in applied:
+        for command in db.pending_backfills(): print(f"⚠️ Falta rellenar datos: ejecuta `python manage.py {command}`.")
+
+def cmd_queue_stats(args):
+    users = db.get_queue_user_stats(args.minutes, args.limit)
+    if args.json:
+        print(json.dumps(users, ensure_ascii=False, indent=2)); return
+    print(f"{'usuario':<32} {'pend.':>6} {'curso':>6} {'reclam.':>7} {'espera media':>12} {'p95':>8} {'más antiguo':>11}")
+    for u in users:
+        fmt = lambda v: f"{v:.0f}s" if v is not None else '-'
+        print(f"{u['user_id'][:31] + ('*' if u['subscribed'] else ''):<32} {u['pending']:>6} {u['processing']:>6} {u['claimed']:>7} "
+              f"{fmt(u['avg_wait_s']):>12} {fmt(u['p95_wait_s']):>8} {fmt(u['oldest_pending_s']):>11}")
+
+def profile_imports(module: str):
+    """Importa `module` en un proceso nuevo con -X importtime. Devuelve (total en ms, [(ms acumulados, módulo)])."""
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.abspath(__file__)))
+    # Sin DATABASE_URL la comprobación del esquema falla rápido y no mide la red
+    env.pop('DATABASE_URL', None)
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f"import {module}"], capture_output=True, text=True, env=env)
+    modules = []
+    for line in result.stderr.splitlines():
+        match = _IMPORTTIME_RE.match(line)
+        if match: modules.append((int(match.group(2)) / 1000.0, match.group(4), len(match.group(3)) // 2))
+    total = next((ms for ms, name, depth in reversed(modules) if name == module), 0.0)
+    return total, modules
+
+def cmd_importtime(args):
+    total, modules = profile_imports(args.module)
+    print(f"Importar {args.module}: {total:.0f} ms (presupuesto {args.budget:.0f} ms)")
+    for ms, name, depth in sorted((m for m in modules if m[2] <= args.depth), reverse=True)[:args.top]:
+        print(f"  {ms:8.1f} ms  {name}")
+    eager = sorted({name.split('.')[0] if name.split('.')[0] in LAZY_MODULES else name for _, name, _ in modules
+                    if any(name == lazy or name.startswith(lazy + '.') for lazy in LAZY_MODULES)})
+    if eager: print(f"❌ SDKs que deberían cargarse bajo demanda: {', '.join(eager)}")
+    if total > args.budget: print(f"❌ El arranque supera el presupuesto en {total - args.budget:.0f} ms")
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({'module': args.module, 'total_ms': round(total, 1), 'budget_ms': args.budget, 'eager_sdks': eager,
+                       'modules': [{'module': name, 'cumulative_ms': round(ms, 1)} for ms, name, depth in sorted(modules, reverse=True)]}, f, indent=2)
+    return 1 if eager or total > args.budget else 0
+
+def cmd_backfill_search(args):
+    print(f"search_text recalculado en {db.backfill_search_text(args.batch_size)} facturas.")
+
+def cmd_backfill_dates(args):
+    print(f"fecha_date rellenada en {db.backfill_fecha_date(args.batch_size)} facturas.")
+
+def cmd_rebuild_stats(args):
+    print(f"Resúmenes reconstruidos para {db.rebuild_invoice_stats(args.user)} usuario(s).")
+
+def cmd_retry_archival(args):
+    if args.reset_failed: print(f"{db.reset_failed_archival_tasks()} tarea(s) de archivado fallidas vueltas a poner en cola.")
+    import processing
+    done, failed = processing.retry_archival_tasks(args.limit)
+    print(f"Archivado reintentado: {done} correctas, {failed} fallidas.")
+
+def cmd_explain_search(args):
+    filters = {'text_query': args.query, 'date_from': args.date_from, 'date_to': args.date_to,
+               'min_total': args.min_total, 'max_total': args.max_total, 'estado': args.estado, 'moneda': args.moneda}
+    print(f"Filtros: {json.dumps({k: v for k, v in filters.items() if v is not None}, ensure_ascii=False)}")
+    for line in db.explain_search_invoices(args.user_id, **filters): print(line)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Tareas de mantenimiento del backend de facturas.")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    backfill = commands.add_parser('backfill-search', help="Recalcula el texto de búsqueda de todas las facturas.")
+    backfill.add_argument('--batch-size', type=int, default=5000)
+    backfill.set_defaults(func=cmd_backfill_search)
+
+    dates = commands.add_parser('backfill-dates', help="Rellena la fecha ordenable de las facturas que no la tienen.")
+    dates.add_argument('--batch-size', type=int, default=5000)
+    dates.set_defaults(func=cmd_backfill_dates)
+
+    stats = commands.add_parser('rebuild-stats', help="Recalcula los resúmenes de facturas (todos los usuarios o uno).")
+    stats.add_argument('--user')
+    stats.set_defaults(func=cmd_rebuild_stats)
+
+    archival = commands.add_parser('retry-archival', help="Reintenta ya las subidas a Cloudinary pendientes.")
+    archival.add_argument('--limit', type=int, default=50)
+    archival.add_argument('--reset-failed', action='store_true', help="Incluye las que agotaron sus intentos.")
+    archival.set_defaults(func=cmd_retry_archival)
+
+    explain = commands.add_parser('explain-search', help="Muestra el plan real de una búsqueda (EXPLAIN ANALYZE).")
+    explain.add_argument('user_id')
+    explain.add_argument('--query')
+    explain.add_argument('--date-from'); explain.add_argument('--date-to')
+    explain.add_argument('--min-total', type=float); explain.add_argument('--max-total', type=float)
+    explain.add_argument('--estado'); explain.add_argument('--moneda')
+    explain.set_defaults(func=cmd_explain_search)
+
+    migrate = commands.add_parser('migrate', help="Aplica las migraciones de esquema pendientes.")
+    migrate.add_argument('--status', action='store_true', help="Solo muestra qué migraciones están aplicadas.")
+    migrate.add_argument('--target', type=int, help="Migra solo hasta esta versión.")
+    migrate.set_defaults(func=cmd_migrate)
+
+    queue = commands.add_parser('queue-stats', help="Reparto de la cola por usuario (* = suscriptor).")
+    queue.add_argument('--minutes', type=int, default=60, help="Ventana de trabajos reclamados para las esperas.")
+    queue.add_argument('--limit', type=int, default=50)
+    queue.add_argument('--json', action='store_true')
+    queue.set_defaults(func=cmd_queue_stats)
+
+    importtime = commands.add_parser('importtime', help="Perfil de importación (arranque en frío); termina con error si se pasa del presupuesto.")
+    importtime.add_argument('--module', default='app')
+    importtime.add_argument('--budget', type=float, default=IMPORT_BUDGET_MS, help="Milisegundos admitidos.")
+    importtime.add_argument('--top', type=int, default=15)
+    importtime.add_argument('--depth', type=int, default=1, help="Profundidad máxima de módulos listados (1 = importados directamente).")
+    importtime.add_argument('--json', help="Guarda el perfil completo en este fichero.")
+    importtime.set_defaults(func=cmd_importtime)
+
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+if __name__ == '__main__':
+    sys.exit(main())
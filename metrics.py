@@ -0,0 +1,167 @@
+import time
+import inspect
+import threading
+import functools
+from contextlib import contextmanager
+
+# Límites de los histogramas de latencia, en segundos (de una consulta a una llamada al modelo)
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum, self.count = 0.0, 0
+
+    def observe(self, value: float):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.sum += value
+        self.count += 1
+
+_lock = threading.Lock()
+_histograms = {}  # nombre -> {labels (tupla ordenada) -> Histogram}
+_counters = {}    # nombre -> {labels -> valor}
+_help = {}
+_gauges = []      # (nombre, ayuda, función que devuelve [(labels, valor)])
+_local = threading.local()
+
+def _key(labels: dict):
+    return tuple(sorted(labels.items()))
+
+def describe(name: str, help_text: str):
+    _help[name] = help_text
+
+def observe(name: str, seconds: float, **labels):
+    with _lock:
+        series = _histograms.setdefault(name, {})
+        histogram = series.get(_key(labels))
+        if histogram is None: histogram = series[_key(labels)] = Histogram()
+        histogram.observe(seconds)
+
+def count(name: str, amount: float = 1, **labels):
+    with _lock:
+        series = _counters.setdefault(name, {})
+        series[_key(labels)] = series.get(_key(labels), 0) + amount
+
+def total_count(name: str) -> int:
+    """Observaciones acumuladas de un histograma (todas las series): p.ej. consultas SQL ejecutadas."""
+    with _lock: return sum(h.count for h in _histograms.get(name, {}).values())
+
+def register_gauge(name: str, help_text: str, collect):
+    """`collect()` se llama en cada scrape y devuelve [(labels, valor)]; si falla, la métrica se omite."""
+    _gauges.append((name, help_text, collect))
+
+# --- Tiempos de la petición en curso (para Server-Timing); son por hilo, como las peticiones de Flask ---
+
+def start_request():
+    _local.timings, _local.queries, _local.started = {}, 0, time.perf_counter()
+
+def _add_timing(name: str, seconds: float):
+    timings = getattr(_local, 'timings', None)
+    if timings is None: return
+    total, calls = timings.get(name, (0.0, 0))
+    timings[name] = (total + seconds, calls + 1)
+
+def finish_request():
+    """Cierra la petición en curso y devuelve (segundos, {etapa: (segundos, llamadas)}, consultas)."""
+    timings, queries, started = getattr(_local, 'timings', None), getattr(_local, 'queries', 0), getattr(_local, 'started', None)
+    _local.timings = None
+    if timings is None or started is None: return 0.0, {}, 0
+    return time.perf_counter() - started, timings, queries
+
+def record_query(seconds: float):
+    """Lo llama el cursor instrumentado de database.py por cada execute."""
+    observe('app_db_query_duration_seconds', seconds)
+    if getattr(_local, 'timings', None) is not None:
+        _local.queries += 1
+        _add_timing('sql', seconds)
+
+@contextmanager
+def span(stage: str):
+    started = time.perf_counter()
+    try: yield
+    finally:
+        elapsed = time.perf_counter() - started
+        observe('app_stage_duration_seconds', elapsed, stage=stage)
+        _add_timing(stage, elapsed)
+
+def timed(stage: str):
+    def decorator(f):
+        @functools.wraps(f)
+        def wrap(*args, **kwargs):
+            with span(stage): return f(*args, **kwargs)
+        return wrap
+    return decorator
+
+def instrument_module(namespace: dict, prefix: str, exclude=()):
+    """Envuelve en un span cada función pública definida en el módulo (no generadores ni context managers,
+    cuyo tiempo real no es el de la llamada). Las llamadas internas también pasan por la versión envuelta."""
+    module = namespace['__name__']
+    for name, obj in list(namespace.items()):
+        if name.startswith('_') or name in exclude or not inspect.isfunction(obj) or obj.__module__ != module: continue
+        if inspect.isgeneratorfunction(obj) or hasattr(obj, '__wrapped__'): continue
+        namespace[name] = timed(f"{prefix}.{name}")(obj)
+
+def server_timing_header(elapsed: float, timings: dict, queries: int, limit: int = 12):
+    """Cabecera Server-Timing con las etapas más lentas de la petición y el total."""
+    entries = []
+    for name, (seconds, calls) in sorted(timings.items(), key=lambda item: -item[1][0])[:limit]:
+        desc = f'{queries} queries' if name == 'sql' else (f'{calls} calls' if calls > 1 else None)
+        entries.append(f'{name};dur={seconds * 1000:.1f}' + (f';desc="{desc}"' if desc else ''))
+    entries.append(f'total;dur={elapsed * 1000:.1f}')
+    return ', '.join(entries)
+
+# --- Exposición en formato texto de Prometheus ---
+
+def _format_labels(labels, extra=None):
+    pairs = list(labels) + ([extra] if extra else [])
+    if not pairs: return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in pairs)
+    return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + '}'
+
+def _format_value(value):
+    if value == float('inf'): return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+def render_prometheus():
+    lines = []
+    with _lock:
+        histograms = {name: {labels: (list(h.counts), h.sum, h.count, h.buckets) for labels, h in series.items()} for name, series in _histograms.items()}
+        counters = {name: dict(series) for name, series in _counters.items()}
+    for name in sorted(histograms):
+        if name in _help: lines.append(f"# HELP {name} {_help[name]}")
+        lines.append(f"# TYPE {name} histogram")
+        for labels, (counts, total, n, buckets) in sorted(histograms[name].items()):
+            cumulative = 0
+            for bound, c in zip(buckets, counts):
+                cumulative += c
+                lines.append(f"{name}_bucket{_format_labels(labels, ('le', _format_value(bound)))} {cumulative}")
+            lines.append(f"{name}_bucket{_format_labels(labels, ('le', '+Inf'))} {n}")
+            lines.append(f"{name}_sum{_format_labels(labels)} {_format_value(total)}")
+            lines.append(f"{name}_count{_format_labels(labels)} {n}")
+    for name in sorted(counters):
+        if name in _help: lines.append(f"# HELP {name} {_help[name]}")
+        lines.append(f"# TYPE {name} counter")
+        for labels, value in sorted(counters[name].items()):
+            lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+    for name, help_text, collect in _gauges:
+        try: samples = collect()
+        except Exception as e:
+            print(f"⚠️ No se pudo calcular la métrica {name}: {e}")
+            continue
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} gauge")
+        for labels, value in samples:
+            lines.append(f"{name}{_format_labels(_key(labels))} {_format_value(value)}")
+    return '\n'.join(lines) + '\n'
+
+describe('app_stage_duration_seconds', 'Duración de cada etapa instrumentada (funciones de base de datos, preprocesado, modelo, subidas).')
+describe('app_job_stage_duration_seconds', 'Duración de cada etapa de un trabajo de la cola (read, prepare, model, save, archive).')
+describe('app_job_wait_seconds', 'Espera en cola (de created_at a reclamado) de cada trabajo reclamado, incluidos reintentos.')
+describe('app_db_query_duration_seconds', 'Duración de cada consulta SQL ejecutada.')
+describe('app_http_request_duration_seconds', 'Duración de las peticiones HTTP por ruta (hasta enviar las cabeceras).')
+describe('app_http_requests_total', 'Peticiones HTTP por ruta y código de estado.')
+describe('app_http_db_queries_total', 'Consultas SQL ejecutadas por las peticiones HTTP, por ruta.')
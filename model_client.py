@@ -0,0 +1,258 @@
+import os
+import time
+import random
+import threading
+import metrics
+
+MODEL_MAX_CONCURRENCY = int(os.environ.get('MODEL_MAX_CONCURRENCY', '4'))
+# Huecos de concurrencia que los trabajos en segundo plano nunca ocupan: quedan para /api/ai/query
+MODEL_INTERACTIVE_RESERVE = int(os.environ.get('MODEL_INTERACTIVE_RESERVE', '1'))
+MODEL_REQUESTS_PER_MINUTE = float(os.environ.get('MODEL_REQUESTS_PER_MINUTE', '60'))
+MODEL_TOKENS_PER_MINUTE = float(os.environ.get('MODEL_TOKENS_PER_MINUTE', '1000000'))
+MODEL_MAX_RETRIES = int(os.environ.get('MODEL_MAX_RETRIES', '3'))
+MODEL_BACKOFF_BASE = float(os.environ.get('MODEL_BACKOFF_BASE', '1.0'))
+MODEL_BACKOFF_MAX = float(os.environ.get('MODEL_BACKOFF_MAX', '20'))
+MODEL_TIMEOUT = float(os.environ.get('MODEL_TIMEOUT', '60'))
+# Tiempo máximo esperando hueco (concurrencia + rate limit) antes de rendirse
+MODEL_QUEUE_TIMEOUT = float(os.environ.get('MODEL_QUEUE_TIMEOUT', '30'))
+MODEL_BREAKER_THRESHOLD = int(os.environ.get('MODEL_BREAKER_THRESHOLD', '5'))
+MODEL_BREAKER_COOLDOWN = float(os.environ.get('MODEL_BREAKER_COOLDOWN', '60'))
+# Con un plazo (deadline) no se empieza una llamada con menos margen que este
+MODEL_MIN_CALL_SECONDS = float(os.environ.get('MODEL_MIN_CALL_SECONDS', '5'))
+MODEL_OUTPUT_TOKENS_ESTIMATE = int(os.environ.get('MODEL_OUTPUT_TOKENS_ESTIMATE', '1000'))
+# Gemini factura cada imagen como un bloque fijo de tokens, independientemente de su tamaño en bytes
+IMAGE_TOKENS_ESTIMATE = 258
+
+# Códigos HTTP/gRPC de google.api_core que indican un fallo transitorio del proveedor
+RETRYABLE_STATUS = {408, 429, 500, 502, 503, 504}
+
+class ModelError(Exception):
+    pass
+
+class RetryableModelError(ModelError):
+    """El proveedor falló de forma transitoria y se agotaron los reintentos: el trabajo puede volver a la cola."""
+
+class ModelUnavailable(RetryableModelError):
+    """Circuito abierto o sin hueco a tiempo: ni siquiera se llamó al modelo."""
+
+class DeadlineExceeded(RetryableModelError):
+    """No queda tiempo del plazo del llamante (p.ej. el presupuesto del lote del worker) para llamar al modelo
+    o la llamada se cortó al agotarlo: no es un fallo del proveedor."""
+
+def is_retryable(error: Exception) -> bool:
+    if isinstance(error, (TimeoutError, ConnectionError)): return True
+    return getattr(error, 'code', None) in RETRYABLE_STATUS
+
+def estimate_tokens(contents) -> int:
+    """Estimación barata (~4 caracteres por token) para el token bucket; no necesita llamar a count_tokens."""
+    parts = contents if isinstance(contents, (list, tuple)) else [contents]
+    tokens = MODEL_OUTPUT_TOKENS_ESTIMATE
+    for part in parts:
+        if isinstance(part, str): tokens += len(part) // 4 + 1
+        else: tokens += IMAGE_TOKENS_ESTIMATE
+    return tokens
+
+class TokenBucket:
+    """Rellena `rate` unidades por segundo hasta `capacity`. acquire() espera hasta tener saldo o hasta el plazo."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate, self.capacity = rate, capacity
+        self._tokens, self._updated = capacity, time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self, amount: float, deadline: float) -> bool:
+        amount = min(amount, self.capacity)  # Una petición más grande que el cubo esperaría para siempre
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                if self._tokens >= amount:
+                    self._tokens -= amount
+                    return True
+                wait_for = (amount - self._tokens) / self.rate
+            if now + wait_for > deadline: return False
+            time.sleep(min(wait_for, 1.0))
+
+class CircuitBreaker:
+    """Se abre tras `threshold` fallos transitorios seguidos y rechaza llamadas durante `cooldown` segundos;
+    después deja pasar una sola llamada de prueba (semiabierto) que lo cierra o lo vuelve a abrir."""
+
+    def __init__(self, threshold: int, cooldown: float):
+        self.threshold, self.cooldown = threshold, cooldown
+        self._failures, self._opened_at, self._probing = 0, None, False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        with self._lock: return self._state(time.monotonic())
+
+    def _state(self, now):
+        if self._opened_at is None: return 'closed'
+        return 'open' if now - self._opened_at < self.cooldown else 'half_open'
+
+    def is_open(self) -> bool:
+        return self.state == 'open'
+
+    def allow(self) -> bool:
+        with self._lock:
+            state = self._state(time.monotonic())
+            if state == 'closed': return True
+            if state == 'half_open' and not self._probing:
+                self._probing = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock: self._failures, self._opened_at, self._probing = 0, None, False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._probing or self._failures >= self.threshold:
+                if self._opened_at is None or self._probing: print(f"⚠️ Circuito del modelo abierto tras {self._failures} fallos seguidos.")
+                self._opened_at, self._probing = time.monotonic(), False
+
+    def retry_after(self) -> float:
+        with self._lock:
+            if self._opened_at is None: return 0.0
+            return max(0.0, self.cooldown - (time.monotonic() - self._opened_at))
+
+class PriorityGate:
+    """Límite de llamadas simultáneas con prioridad: las interactivas pasan antes que las de segundo plano
+    y estas nunca ocupan los últimos `reserve` huecos."""
+
+    def __init__(self, limit: int, reserve: int):
+        self.limit, self.reserve = max(1, limit), max(0, min(reserve, limit - 1))
+        self.active, self._interactive_waiting = 0, 0
+        self._cond = threading.Condition()
+
+    def _can_enter(self, interactive: bool):
+        if interactive: return self.active < self.limit
+        return self._interactive_waiting == 0 and self.active < self.limit - self.reserve
+
+    def acquire(self, interactive: bool, deadline: float) -> bool:
+        with self._cond:
+            if interactive: self._interactive_waiting += 1
+            try:
+                while not self._can_enter(interactive):
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0: return False
+                    self._cond.wait(remaining)
+                self.active += 1
+                return True
+            finally:
+                if interactive: self._interactive_waiting -= 1
+
+    def release(self):
+        with self._cond:
+            self.active -= 1
+            self._cond.notify_all()
+
+class ModelClient:
+    """Envuelve generate_content con límite de concurrencia priorizado, token buckets (peticiones y tokens
+    estimados por minuto), timeout por llamada, reintentos con backoff exponencial y circuit breaker.
+    `model_provider` devuelve el modelo en cada llamada, así que se puede sustituir por un fake en caliente."""
+
+    def __init__(self, model_provider, max_concurrency: int = MODEL_MAX_CONCURRENCY, interactive_reserve: int = MODEL_INTERACTIVE_RESERVE,
+                 requests_per_minute: float = MODEL_REQUESTS_PER_MINUTE, tokens_per_minute: float = MODEL_TOKENS_PER_MINUTE,
+                 max_retries: int = MODEL_MAX_RETRIES, timeout: float = MODEL_TIMEOUT, queue_timeout: float = MODEL_QUEUE_TIMEOUT,
+                 breaker: CircuitBreaker = None, backoff_base: float = MODEL_BACKOFF_BASE, backoff_max: float = MODEL_BACKOFF_MAX):
+        self.model_provider = model_provider
+        self.gate = PriorityGate(max_concurrency, interactive_reserve)
+        self.request_bucket = TokenBucket(requests_per_minute / 60.0, max(1.0, requests_per_minute / 60.0 * 10))
+        self.token_bucket = TokenBucket(tokens_per_minute / 60.0, tokens_per_minute / 6.0)
+        self.breaker = breaker or CircuitBreaker(MODEL_BREAKER_THRESHOLD, MODEL_BREAKER_COOLDOWN)
+        self.max_retries, self.timeout, self.queue_timeout = max_retries, timeout, queue_timeout
+        self.backoff_base, self.backoff_max = backoff_base, backoff_max
+        self._stats_lock = threading.Lock()
+        self._stats = {'calls': 0, 'succeeded': 0, 'retries': 0, 'failed': 0, 'rejected': 0, 'queue_wait_ms': 0.0}
+
+    def _count(self, key: str, amount=1):
+        with self._stats_lock: self._stats[key] += amount
+
+    def stats(self):
+        with self._stats_lock: stats = dict(self._stats)
+        stats.update({'active': self.gate.active, 'breaker': self.breaker.state, 'queue_wait_ms': round(stats['queue_wait_ms'], 1)})
+        return stats
+
+    def _backoff(self, attempt: int) -> float:
+        # Full jitter: los reintentos de varios hilos no vuelven a chocar a la vez contra el proveedor
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+
+    def _unavailable(self):
+        self._count('rejected')
+        return ModelUnavailable(f"Modelo no disponible (circuito abierto, reintentar en {self.breaker.retry_after():.0f}s).")
+
+    def _call_once(self, contents, interactive: bool, timeout: float, tokens: int, call_deadline: float = None):
+        if self.breaker.is_open(): raise self._unavailable()
+        waited_from = time.monotonic()
+        deadline = waited_from + self.queue_timeout
+        # La espera de hueco también cuenta para el plazo del llamante: debe quedar tiempo para la llamada
+        by_deadline = call_deadline is not None and call_deadline - MODEL_MIN_CALL_SECONDS < deadline
+        if by_deadline: deadline = call_deadline - MODEL_MIN_CALL_SECONDS
+        if not self.gate.acquire(interactive, deadline):
+            self._count('rejected')
+            if by_deadline: raise DeadlineExceeded("Sin tiempo en el plazo para esperar hueco en el modelo.")
+            raise ModelUnavailable("Modelo saturado: sin hueco de concurrencia a tiempo.")
+        try:
+            if not (self.request_bucket.acquire(1, deadline) and self.token_bucket.acquire(tokens, deadline)):
+                self._count('rejected')
+                if by_deadline: raise DeadlineExceeded("Sin tiempo en el plazo para el límite de peticiones al modelo.")
+                raise ModelUnavailable("Límite de peticiones al modelo alcanzado.")
+            timeout = min(timeout, call_deadline - time.monotonic()) if call_deadline is not None else timeout
+            # Con el hueco ya conseguido: si el circuito está semiabierto solo pasa una llamada de prueba
+            if not self.breaker.allow(): raise self._unavailable()
+            metrics.observe('app_stage_duration_seconds', time.monotonic() - waited_from, stage='model.queue_wait')
+            self._count('queue_wait_ms', (time.monotonic() - waited_from) * 1000)
+            self._count('calls')
+            with metrics.span('model.generate_content'):
+                return self.model_provider().generate_content(contents, request_options={'timeout': timeout})
+        finally:
+            self.gate.release()
+
+    def generate(self, contents, priority: str = 'background', timeout: float = None, deadline: float = None):
+        """Llama al modelo. Lanza RetryableModelError si el fallo es transitorio y se agotaron los reintentos
+        (o el circuito está abierto) y la excepción original si no es reintentable (p.ej. petición inválida).
+        Con `deadline` (time.monotonic()) el timeout de cada llamada y los reintentos no pasan de ese instante;
+        si no queda tiempo para llamar, o la llamada se corta por el plazo, lanza DeadlineExceeded."""
+        interactive, timeout = priority == 'interactive', timeout or self.timeout
+        tokens = estimate_tokens(contents)
+        # Las peticiones interactivas no esperan backoffs largos: el usuario está delante
+        retries = min(self.max_retries, 1) if interactive else self.max_retries
+        for attempt in range(retries + 1):
+            if deadline is not None and deadline - time.monotonic() < MODEL_MIN_CALL_SECONDS:
+                raise DeadlineExceeded(f"Sin tiempo en el plazo para llamar al modelo (intento {attempt + 1}).")
+            capped = deadline is not None and deadline - time.monotonic() < timeout
+            try:
+                response = self._call_once(contents, interactive, timeout, tokens, deadline)
+            except ModelUnavailable:
+                raise
+            except DeadlineExceeded:
+                raise
+            except Exception as e:
+                if not is_retryable(e):
+                    # El proveedor respondió (p.ej. 400): está disponible aunque la petición sea mala
+                    self.breaker.record_success()
+                    self._count('failed'); raise
+                if capped and (isinstance(e, TimeoutError) or getattr(e, 'code', None) in (408, 504)):
+                    # Cortada por el plazo (timeout recortado), no necesariamente por el proveedor: no cuenta para el circuito
+                    self._count('failed')
+                    raise DeadlineExceeded(f"La llamada al modelo agotó el plazo: {e}") from e
+                self.breaker.record_failure()
+                delay = self._backoff(attempt)
+                # Sin margen para esperar el backoff y repetir dentro del plazo: se acaban los reintentos
+                out_of_time = deadline is not None and time.monotonic() + delay + MODEL_MIN_CALL_SECONDS > deadline
+                if attempt >= retries or self.breaker.is_open() or out_of_time:
+                    self._count('failed')
+                    raise RetryableModelError(f"Error transitorio del modelo tras {attempt + 1} intentos: {e}") from e
+                self._count('retries')
+                print(f"⚠️ Error transitorio del modelo ({e}); reintento {attempt + 1}/{retries} en {delay:.1f}s")
+                time.sleep(delay)
+                continue
+            self.breaker.record_success()
+            self._count('succeeded')
+            return response
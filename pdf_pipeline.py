@@ -0,0 +1,134 @@
+import os
+import io
+import time
+import hashlib
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import image_pipeline
+import metrics
+from pypdf import PdfReader
+
+PDF_PAGE_WORKERS = int(os.environ.get('PDF_PAGE_WORKERS', str(min(4, os.cpu_count() or 1))))
+# Por debajo de este número de páginas el arranque del pool cuesta más que lo que ahorra
+PDF_PARALLEL_MIN_PAGES = int(os.environ.get('PDF_PARALLEL_MIN_PAGES', '6'))
+TEXT_QUALITY_THRESHOLD = float(os.environ.get('PDF_TEXT_QUALITY_THRESHOLD', '0.6'))
+GEMINI_MAX_PAYLOAD_BYTES = int(os.environ.get('GEMINI_MAX_PAYLOAD_BYTES', str(15 * 1024 * 1024)))
+# Los PDF de más páginas se reparten al encolarlos en fragmentos de como mucho estas páginas (0 = nunca)
+PDF_SHARD_PAGES = int(os.environ.get('PDF_SHARD_PAGES', '15'))
+
+_executor = None
+_executor_lock = threading.Lock()
+
+def score_text(text: str) -> float:
+    """Puntúa (0-1) la calidad de la capa de texto de una página: longitud, proporción de
+    caracteres útiles y de palabras reconocibles. Las páginas escaneadas o con fuentes sin
+    mapa Unicode (glifos '(cid:12)', '�') puntúan bajo."""
+    stripped = (text or '').strip()
+    if not stripped: return 0.0
+    garbage = stripped.count('�') + stripped.count('(cid:')
+    useful = sum(1 for ch in stripped if ch.isalnum() or ch in ' .,:;/-€$£%()\n')
+    words = stripped.split()
+    wordlike = sum(1 for w in words if any(ch.isalpha() for ch in w) or any(ch.isdigit() for ch in w))
+    length_factor = min(1.0, len(stripped) / 200)
+    char_ratio = max(0.0, useful - garbage * 4) / len(stripped)
+    word_ratio = wordlike / len(words) if words else 0.0
+    return round(length_factor * (0.5 * char_ratio + 0.5 * word_ratio), 3)
+
+def _extract_pages(data, page_numbers):
+    """Extrae texto (y solo si hace falta, imágenes) de un rango de páginas. Se ejecuta en un proceso hijo."""
+    reader = PdfReader(io.BytesIO(data) if isinstance(data, (bytes, bytearray)) else data)
+    results = []
+    for number in page_numbers:
+        started = time.perf_counter()
+        page = reader.pages[number]
+        text = page.extract_text() or ''
+        score = score_text(text)
+        images = []
+        if score < TEXT_QUALITY_THRESHOLD:
+            for image_obj in page.images:
+                try: images.append((hashlib.sha1(image_obj.data).hexdigest(), image_obj.data))
+                except Exception as e: print(f"⚠️ No se pudo extraer imagen de la página {number + 1}: {e}")
+        results.append({'page': number, 'text': text, 'score': score, 'images': images,
+                        'extract_ms': round((time.perf_counter() - started) * 1000, 1)})
+    return results
+
+def _get_executor():
+    global _executor
+    # Los hilos de run_batch llegan a la vez: sin el lock cada uno podría crear (y perder) su propio pool
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                # forkserver: el worker es multihilo y hacer fork de un proceso con hilos puede heredar locks tomados
+                _executor = ProcessPoolExecutor(max_workers=PDF_PAGE_WORKERS, mp_context=multiprocessing.get_context('forkserver'))
+    return _executor
+
+def count_pages(stream) -> int:
+    return len(PdfReader(stream).pages)
+
+def plan_page_ranges(page_count: int, shard_pages: int = PDF_SHARD_PAGES):
+    """Rangos (primera, última) desde 1 de como mucho `shard_pages` páginas y de tamaño parecido, o None si el
+    documento cabe en uno: 32 páginas en fragmentos de 15 son 11 + 11 + 10, no 15 + 15 + 2."""
+    if shard_pages <= 0 or page_count <= shard_pages: return None
+    size = -(-page_count // -(-page_count // shard_pages))
+    return [(start + 1, min(start + size, page_count)) for start in range(0, page_count, size)]
+
+def extract_pages(payload, page_range=None):
+    """Extrae todas las páginas (o solo las de `page_range`, índices desde 0), en paralelo si son muchas.
+    Devuelve (páginas, paralelo)."""
+    reader = PdfReader(payload.stream())
+    page_count = len(reader.pages)
+    numbers = [n for n in (page_range if page_range is not None else range(page_count)) if n < page_count]
+    if not numbers: return [], False
+    if PDF_PAGE_WORKERS > 1 and len(numbers) >= PDF_PARALLEL_MIN_PAGES:
+        try:
+            data = bytes(payload.view)
+            chunk = -(-len(numbers) // PDF_PAGE_WORKERS)
+            futures = [_get_executor().submit(_extract_pages, data, numbers[start:start + chunk]) for start in range(0, len(numbers), chunk)]
+            return [page for future in futures for page in future.result()], True
+        except (OSError, NotImplementedError, BrokenProcessPool) as e:
+            # Entornos sin /dev/shm (p.ej. algunas funciones serverless): seguimos en serie
+            print(f"⚠️ Pool de procesos no disponible, extracción en serie: {e}")
+    return _extract_pages(payload.stream(), numbers), False
+
+@metrics.timed('pdf.build_content')
+def build_pdf_content(payload, prompt: str, max_payload_bytes: int = GEMINI_MAX_PAYLOAD_BYTES, page_range=None):
+    """Prepara las partes para Gemini: texto de cada página (o de las de `page_range`) y, solo en páginas con
+    texto pobre, sus imágenes (deduplicadas entre páginas) sin pasar de `max_payload_bytes`.
+    Devuelve (content_parts, report) con la decisión y el tiempo de cada página."""
+    started = time.perf_counter()
+    pages, parallel = extract_pages(payload, page_range)
+    extract_ms = round((time.perf_counter() - started) * 1000, 1)
+    content_parts, decisions = [prompt], []
+    used_bytes, seen_images = len(prompt.encode('utf-8')), set()
+    for page in pages:
+        decision = {'page': page['page'] + 1, 'text_score': page['score'], 'text_chars': len(page['text']),
+                    'extract_ms': page['extract_ms'], 'images_included': 0, 'images_duplicated': 0, 'images_over_budget': 0}
+        text = page['text'].strip()
+        text_bytes = len(text.encode('utf-8'))
+        if text and used_bytes + text_bytes <= max_payload_bytes:
+            content_parts.append(text); used_bytes += text_bytes
+        elif text:
+            decision['text_over_budget'] = True
+        for digest, data in page['images']:
+            if digest in seen_images:
+                decision['images_duplicated'] += 1; continue
+            seen_images.add(digest)
+            try:
+                normalized = image_pipeline.normalize_image(io.BytesIO(data), len(data))
+            except Exception as e:
+                print(f"⚠️ No se pudo procesar imagen en PDF: {e}"); continue
+            if used_bytes + len(normalized.data) > max_payload_bytes:
+                decision['images_over_budget'] += 1; continue
+            content_parts.append(image_pipeline.as_model_part(normalized)); used_bytes += len(normalized.data)
+            decision['images_included'] += 1
+            decision['image_bytes_original'] = decision.get('image_bytes_original', 0) + len(data)
+            decision['image_bytes'] = decision.get('image_bytes', 0) + len(normalized.data)
+        if page['score'] >= TEXT_QUALITY_THRESHOLD: decision['mode'] = 'text'
+        elif page['images']: decision['mode'] = 'text+images'
+        else: decision['mode'] = 'poor_text_no_images'
+        decisions.append(decision)
+    report = {'pages': decisions, 'page_count': len(pages), 'parallel': parallel, 'extract_ms': extract_ms,
+              'total_ms': round((time.perf_counter() - started) * 1000, 1), 'payload_bytes': used_bytes}
+    return content_parts, report
@@ -0,0 +1,449 @@
+import os
+import io
+import json
+import hashlib
+import threading
+import time
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+import database as db
+import model_client
+import blobstore
+import metrics
+# google.generativeai, cloudinary, pypdf y PIL se importan al usarse: solo cargarlos cuesta ~1s en cada arranque en frío
+
+GEMINI_MODEL_NAME = 'gemini-3-flash-preview'
+gemini_model = None
+_gemini_lock = threading.Lock()
+
+def get_gemini_model():
+    global gemini_model
+    with _gemini_lock:
+        if gemini_model is None:
+            import google.generativeai as genai
+            try:
+                api_key = os.environ.get("GOOGLE_API_KEY")
+                if not api_key: raise ValueError("No se encontró GOOGLE_API_KEY.")
+                genai.configure(api_key=api_key)
+                print("Google Gemini API configurada.")
+            except Exception as e:
+                print(f"Error CRÍTICO al configurar Gemini: {e}")
+            gemini_model = genai.GenerativeModel(GEMINI_MODEL_NAME)
+    return gemini_model
+
+# Todas las llamadas pasan por el cliente (concurrencia, rate limit, reintentos, circuit breaker);
+# el lambda lee gemini_model en cada llamada para que se pueda sustituir por fakes.FakeModel
+gemini_client = model_client.ModelClient(lambda: gemini_model or get_gemini_model())
+JOB_RETRY_DELAY = float(os.environ.get('JOB_RETRY_DELAY', '60'))
+
+# --- MODIFICADO: Prompt para IA global (Moneda dinámica) ---
+prompt_plantilla_factura = """
+Actúa como un experto contable internacional. Analiza el documento y extrae los datos en formato JSON estricto.
+INSTRUCCIONES CLAVE:
+1. EXTRACCIÓN: Extrae `emisor`, `cif`, `fecha`, `total`, `base_imponible`.
+2. MONEDA (NUEVO): Identifica el símbolo de la divisa utilizada (ej: €, $, £, MXN, COP, etc.) y guárdalo en el campo `"moneda"`. Si no lo encuentras, usa "€".
+3. ESTADO (OBLIGATORIO): Examina evidencias de pago (PAGADO, PAID, PAID IN FULL, balance 0). Si está pagada, pon `"estado": "Pagada"`. Si hay dudas o está pendiente, pon `"estado": "Pendiente"`.
+4. CONCEPTOS (OBLIGATORIO): Extrae CADA concepto con `descripcion`, `cantidad` y `precio_unitario`. NUNCA dejes la lista vacía.
+FORMATO JSON ESTRICTO:
+{ "emisor": "Nombre", "cif": "B123", "fecha": "DD/MM/AAAA", "total": 121.00, "base_imponible": 100.00, "estado": "Pagada", "moneda": "$", "conceptos":[ {"descripcion": "Producto", "cantidad": 2.0, "precio_unitario": 50.0} ] }
+"""
+prompt_multipagina_pdf = prompt_plantilla_factura
+# Se añade al prompt de cada fragmento de un PDF grande; las reglas de unión están en merge_shard_results
+prompt_fragmento_pdf = """
+ATENCIÓN: este contenido son solo las páginas {page_start} a {page_end} de un documento más largo que se procesa por partes.
+- CONCEPTOS: extrae únicamente los que aparecen en ESTAS páginas, sin repetir ni inventar los de otras partes. Si no hay ninguno, devuelve "conceptos": [].
+- IMPORTES: pon en `total` y `base_imponible` los totales del documento solo si aparecen en estas páginas; si no aparecen, usa null.
+- CABECERA: `emisor`, `cif`, `fecha` y `moneda` solo si aparecen en estas páginas; si no, usa null. `estado` es "Pagada" solo si estas páginas muestran evidencia de pago.
+"""
+
+# Cualquier cambio en los prompts o en el modelo cambia la clave y deja obsoleta la caché de extracciones
+PROMPT_VERSION = hashlib.sha256((prompt_plantilla_factura + prompt_multipagina_pdf + prompt_fragmento_pdf).encode('utf-8')).hexdigest()[:16]
+# Diferencia relativa admitida entre un importe del documento y la suma de los conceptos al unir fragmentos
+SHARD_MERGE_TOLERANCE = float(os.environ.get('SHARD_MERGE_TOLERANCE', '0.01'))
+
+_cache_lock = threading.Lock()
+_cache_counters = {'hits': 0, 'misses': 0}
+
+def _count_cache(hit: bool):
+    with _cache_lock: _cache_counters['hits' if hit else 'misses'] += 1
+
+def cache_counters():
+    with _cache_lock: return dict(_cache_counters)
+
+def lookup_cached_extraction(user_id: str, content_hash: str):
+    if not content_hash: return None
+    cached = db.get_cached_extraction(user_id, content_hash, PROMPT_VERSION, GEMINI_MODEL_NAME)
+    _count_cache(cached is not None)
+    return cached
+
+def complete_duplicate_upload(blob_ref, user_id: str, job_type: str, cached: dict):
+    """Completa al instante una subida repetida reutilizando el resultado y el file_info guardados."""
+    invoice_id = db.add_invoice(cached['result_json'], f"{GEMINI_MODEL_NAME} ({job_type}, caché)", user_id, cached.get('file_info'))
+    if not invoice_id: raise ValueError("Falló el guardado en la base de datos.")
+    return db.create_completed_duplicate_job(blob_ref, user_id, job_type, cached['result_json'])
+
+@metrics.timed('pdf.plan_shards')
+def plan_pdf_shards(blob_ref):
+    """Al encolar un PDF: los rangos de páginas de sus fragmentos si es grande (pdf_pipeline.plan_page_ranges), o None.
+    Si no se puede leer se encola entero y el error lo da el worker."""
+    import pdf_pipeline
+    if pdf_pipeline.PDF_SHARD_PAGES <= 0: return None
+    try:
+        with blobstore.get_store().open(blob_ref.key) as payload: page_count = pdf_pipeline.count_pages(payload.stream())
+    except Exception as e:
+        print(f"⚠️ No se pudieron contar las páginas del PDF, se procesará entero: {e}")
+        return None
+    return pdf_pipeline.plan_page_ranges(page_count)
+
+def extract_json_object(raw_text: str):
+    start_idx = raw_text.find('{')
+    end_idx = raw_text.rfind('}')
+    if start_idx != -1 and end_idx != -1 and end_idx > start_idx:
+        json_text = raw_text[start_idx:end_idx + 1]
+        try:
+            return json.loads(json_text)
+        except json.JSONDecodeError as e:
+            raise ValueError(f"El JSON extraído es inválido: {e}")
+    raise ValueError("Gemini no devolvió ningún formato JSON reconocible.")
+
+ARCHIVE_CONCURRENCY = int(os.environ.get('ARCHIVE_CONCURRENCY', '4'))
+ARCHIVE_LEASE_SECONDS = int(os.environ.get('ARCHIVE_LEASE_SECONDS', '300'))
+
+_archive_executor = None
+_archive_lock = threading.Lock()
+_archives_in_flight = set()
+
+def _get_archive_executor():
+    global _archive_executor
+    with _archive_lock:
+        if _archive_executor is None:
+            _archive_executor = ThreadPoolExecutor(max_workers=ARCHIVE_CONCURRENCY, thread_name_prefix='archive')
+        return _archive_executor
+
+@metrics.timed('cloudinary.upload')
+def upload_original(upload_file, job_type: str, user_id: str):
+    """Sube el original a Cloudinary (privado) y devuelve su file_info."""
+    import cloudinary.uploader
+    print(f"☁️ Subiendo archivo original ({job_type}) a Cloudinary (Private)...")
+    upload_params = {"file": upload_file, "type": "private", "folder": f"gestor_facturas/users/{user_id}"}
+    if job_type == 'pdf':
+        upload_params["resource_type"] = "image"
+        upload_params["format"] = "pdf"
+    else:
+        upload_params["resource_type"] = "image"
+    upload_result = cloudinary.uploader.upload(**upload_params)
+    return {
+        "public_id": upload_result.get("public_id"),
+        "resource_type": upload_result.get("resource_type"),
+        "format": upload_result.get("format", job_type)
+    }
+
+def discard_original(file_info: dict):
+    # El original subido ya no pertenece a ninguna factura (el trabajo falló o la factura se borró)
+    import cloudinary.uploader
+    try: cloudinary.uploader.destroy(file_info['public_id'], resource_type=file_info.get('resource_type', 'image'), type='private')
+    except Exception as e: print(f"⚠️ No se pudo borrar de Cloudinary {file_info.get('public_id')}: {e}")
+
+class StageTimer:
+    """Tiempos de pared por etapa (inicio y duración relativos al comienzo del trabajo), para ver el solapamiento."""
+
+    def __init__(self):
+        self.origin, self.stages = time.perf_counter(), {}
+
+    def record(self, name: str, started: float, finished: float):
+        self.stages[name] = {'start_ms': round((started - self.origin) * 1000, 1), 'ms': round((finished - started) * 1000, 1)}
+        metrics.observe('app_job_stage_duration_seconds', finished - started, stage=name)
+        return self.stages[name]
+
+    @contextmanager
+    def stage(self, name: str):
+        started = time.perf_counter()
+        try: yield
+        finally: self.record(name, started, time.perf_counter())
+
+class Archival:
+    """Subida del original lanzada en segundo plano en cuanto sus bytes están listos.
+    Los manejadores registrados con then() se ejecutan al terminar, en el hilo de la subida
+    (o en el acto si ya había terminado)."""
+
+    def __init__(self, upload_file, job_type: str, user_id: str):
+        self.started = self.finished = self.file_info = self.error = None
+        self.settled = threading.Event()
+        self._lock, self._done, self._handlers = threading.Lock(), False, []
+        with _archive_lock: _archives_in_flight.add(self)
+        _get_archive_executor().submit(self._run, upload_file, job_type, user_id)
+
+    def _run(self, upload_file, job_type, user_id):
+        self.started = time.perf_counter()
+        try: self.file_info = upload_original(upload_file, job_type, user_id)
+        except Exception as e: self.error = e
+        self.finished = time.perf_counter()
+        with self._lock:
+            self._done, handlers = True, list(self._handlers)
+        for handler in handlers: self._call(handler)
+        self.settled.set()
+        with _archive_lock: _archives_in_flight.discard(self)
+
+    def _call(self, handler):
+        try: handler(self)
+        except Exception as e: print(f"❌ Error tras el archivado: {e}")
+
+    def done(self):
+        with self._lock: return self._done
+
+    def then(self, handler):
+        with self._lock:
+            if not self._done:
+                self._handlers.append(handler); return
+        self._call(handler)
+
+    def file_info_if_done(self):
+        return self.file_info if self.done() else None
+
+def wait_for_archival(timeout: float):
+    """Espera a las subidas en curso (p.ej. antes de que la función serverless se congele). Devuelve cuántas quedan."""
+    deadline = time.monotonic() + max(0.0, timeout)
+    with _archive_lock: pending = list(_archives_in_flight)
+    for archival in pending: archival.settled.wait(max(0.0, deadline - time.monotonic()))
+    with _archive_lock: return len(_archives_in_flight)
+
+def _delete_blob(blob_key: str):
+    try: blobstore.store_for(blob_key).delete(blob_key)
+    except Exception as e: print(f"⚠️ No se pudo borrar el blob {blob_key}: {e}")
+
+def _finish_archival(archival: Archival, timer: StageTimer, job: dict, invoice_id: int, task_id: int):
+    """Al terminar una subida que siguió en curso tras completar el trabajo."""
+    if archival.error:
+        print(f"❌ Error al subir a Cloudinary, se reintentará: {archival.error}")
+        db.fail_archival_task(task_id, str(archival.error))
+        return
+    if not db.complete_archival_task(task_id, invoice_id, job['user_id'], job.get('content_hash'), archival.file_info):
+        discard_original(archival.file_info)
+    _delete_blob(job['blob_key'])
+    db.update_job_report_stage(job['id'], 'archive', timer.record('archive', archival.started, archival.finished), status='done')
+
+def _attach_late_file_info(archival: Archival, timer: StageTimer, job: dict, invoice_id: int):
+    """La subida terminó bien después de guardar la factura sin file_info: se adjunta ahora."""
+    if not db.attach_file_info(invoice_id, job['user_id'], job.get('content_hash'), archival.file_info):
+        discard_original(archival.file_info)
+    db.update_job_report_stage(job['id'], 'archive', timer.record('archive', archival.started, archival.finished), status='done')
+
+def _settle_without_blob(archival: Archival, timer: StageTimer, job: dict, invoice_id: int):
+    if archival.error: print(f"❌ Error al subir a Cloudinary (se guardarán datos, pero no archivo): {archival.error}")
+    else: _attach_late_file_info(archival, timer, job, invoice_id)
+
+def _hand_off_archival(archival: Archival, timer: StageTimer, job: dict, invoice_id: int, saved_file_info: dict):
+    """Tras completar el trabajo: si la subida sigue en curso (o falló) queda una tarea de archivado
+    que conserva el blob hasta que el original esté en Cloudinary. `saved_file_info` es el que se guardó
+    con la factura. Devuelve True si el blob ya se puede borrar."""
+    if archival is None or saved_file_info: return True
+    if archival.file_info_if_done():
+        # Terminó entre el guardado y ahora: la factura aún no tiene file_info
+        _attach_late_file_info(archival, timer, job, invoice_id)
+        return True
+    if not job.get('blob_key'):
+        # Trabajos antiguos con el contenido en job_queue.file_data: no hay blob desde el que reintentar
+        archival.then(lambda a: _settle_without_blob(a, timer, job, invoice_id))
+        return True
+    if archival.error:
+        print(f"❌ Error al subir a Cloudinary, se reintentará: {archival.error}")
+        db.create_archival_task(job['id'], invoice_id, job['user_id'], job['type'], job['blob_key'], job.get('content_hash'), error=str(archival.error))
+        return False
+    # En curso (o recién terminada con éxito): la tarea nace reclamada y then() la cierra con el file_info de esta subida
+    task_id = db.create_archival_task(job['id'], invoice_id, job['user_id'], job['type'], job['blob_key'], job.get('content_hash'),
+                                      in_flight=True, lease_seconds=ARCHIVE_LEASE_SECONDS)
+    archival.then(lambda a: _finish_archival(a, timer, job, invoice_id, task_id))
+    return False
+
+def _amount(value):
+    try: return round(float(value), 2) if value not in (None, '') else None
+    except (TypeError, ValueError): return None
+
+def merge_shard_results(shards, shards_total: int = None):
+    """Une los resultados de los fragmentos de un PDF (en orden de páginas) en una sola factura:
+    - Cabecera: emisor, cif, fecha y moneda del primer fragmento que los trae; 'Pagada' si algún fragmento lo ve pagado.
+    - Conceptos: concatenados en orden de páginas.
+    - total/base_imponible se concilian con la suma de las líneas (cantidad x precio_unitario). Candidatos: los
+      importes del último fragmento que trae alguno (el resumen suele estar al final) y, si varios traen importes,
+      su suma (subtotales por página). Gana el primero que cuadra con las líneas dentro de SHARD_MERGE_TOLERANCE; si
+      ninguno cuadra se quedan los del documento y el informe lo marca; si ningún fragmento trae importes, las líneas.
+    Con `shards_total` comprueba además que no falte ningún fragmento (los rangos deben ser consecutivos desde la 1).
+    Devuelve (factura, informe de la unión)."""
+    if not shards: raise ValueError("El documento no tiene fragmentos.")
+    unfinished = [f"{s['page_start']}-{s['page_end']}" for s in shards if s['status'] != 'completed']
+    if unfinished: raise ValueError(f"Fragmentos sin completar (páginas {', '.join(unfinished)}).")
+    gaps = [f"{prev_end + 1}-{s['page_start'] - 1}" for prev_end, s in zip([0] + [s['page_end'] for s in shards], shards) if s['page_start'] != prev_end + 1]
+    if gaps or (shards_total and len(shards) != shards_total):
+        raise ValueError(f"Faltan fragmentos del documento ({len(shards)} de {shards_total or len(shards)}" + (f"; páginas {', '.join(gaps)}" if gaps else '') + ").")
+    results = [s['result_json'] or {} for s in shards]
+    merged = {key: next((r.get(key) for r in results if r.get(key)), None) for key in ('emisor', 'cif', 'fecha', 'moneda')}
+    merged['moneda'] = merged['moneda'] or '€'
+    merged['estado'] = 'Pagada' if any(r.get('estado') == 'Pagada' for r in results) else 'Pendiente'
+    merged['conceptos'] = [c for r in results for c in (r.get('conceptos') or []) if isinstance(c, dict)]
+
+    lines = [(_amount(c.get('cantidad')), _amount(c.get('precio_unitario'))) for c in merged['conceptos']]
+    lines = [quantity * price for quantity, price in lines if quantity is not None and price is not None]
+    lines_sum = round(sum(lines), 2) if lines else None
+    amounts = [(_amount(r.get('base_imponible')), _amount(r.get('total'))) for r in results]
+    amounts = [pair for pair in amounts if pair != (None, None)]
+    candidates = [('documento',) + amounts[-1]] if amounts else []
+    if len(amounts) > 1:
+        bases, totals = [b for b, _ in amounts if b is not None], [t for _, t in amounts if t is not None]
+        candidates.append(('suma_fragmentos', round(sum(bases), 2) if bases else None, round(sum(totals), 2) if totals else None))
+
+    def matches(value):
+        return value is not None and lines_sum is not None and abs(value - lines_sum) <= max(0.01, abs(lines_sum) * SHARD_MERGE_TOLERANCE)
+
+    chosen = next((c for c in candidates if matches(c[1]) or matches(c[2])), None)
+    reconciled = chosen is not None
+    source, merged['base_imponible'], merged['total'] = chosen or (candidates[0] if candidates else ('conceptos', lines_sum, lines_sum))
+    report = {'shards': len(shards), 'pages': [[s['page_start'], s['page_end']] for s in shards], 'conceptos': len(merged['conceptos']),
+              'lines_sum': lines_sum, 'source': source, 'reconciled': reconciled,
+              'difference': round(merged['base_imponible'] - lines_sum, 2) if merged['base_imponible'] is not None and lines_sum is not None else None}
+    if not reconciled and candidates and lines_sum is not None:
+        print(f"⚠️ Los importes del documento no cuadran con sus conceptos: base {merged['base_imponible']}, líneas {lines_sum}")
+    return merged, report
+
+def process_shard(job: dict, timer: StageTimer, deadline: float = None):
+    """Un fragmento de un PDF grande: extracción y modelo solo de sus páginas. No guarda la factura ni archiva (lo hace
+    la unión del documento) y no borra el blob, que es el del documento."""
+    import pdf_pipeline
+    page_start, page_end = job['page_start'], job['page_end']
+    with timer.stage('read'):
+        payload = blobstore.open_job_payload(job)
+    with payload:
+        with timer.stage('prepare'):
+            prompt = prompt_multipagina_pdf + prompt_fragmento_pdf.format(page_start=page_start, page_end=page_end)
+            content_parts, pdf_report = pdf_pipeline.build_pdf_content(payload, prompt, page_range=range(page_start - 1, page_end))
+    if len(content_parts) <= 1: raise ValueError(f"No se extrajo contenido de las páginas {page_start}-{page_end}.")
+    with timer.stage('model'):
+        response = gemini_client.generate(content_parts, deadline=deadline)
+    result = extract_json_object(response.text)
+    stages = dict(timer.stages, total={'start_ms': 0.0, 'ms': round((time.perf_counter() - timer.origin) * 1000, 1)})
+    db.complete_shard(job['id'], result, {'pdf': pdf_report, 'stages': stages})
+    return 'completed'
+
+def process_job(job: dict, deadline: float = None):
+    """Procesa un trabajo ya reclamado de la cola. Devuelve 'completed', 'failed', 'retried' o 'deferred'.
+    La subida del original a Cloudinary corre en paralelo con la extracción y Gemini; el trabajo se
+    completa en cuanto la factura está guardada y el file_info se adjunta después si hace falta.
+    Con `deadline` (time.monotonic(), el presupuesto del lote) las llamadas al modelo no pasan de ese instante;
+    si no caben, el trabajo vuelve a la cola sin gastar un intento ('deferred')."""
+    import pdf_pipeline
+    import image_pipeline
+    job_id, user_id, job_type = job['id'], job['user_id'], job['type']
+    payload, archival, timer = None, None, StageTimer()
+    # El blob de un fragmento es el de su documento: lo borra la unión, después de archivar el original
+    delete_blob, invoice_id = not job.get('parent_id'), None
+    try:
+        if job.get('parent_id'): return process_shard(job, timer, deadline)
+        cached = lookup_cached_extraction(user_id, job.get('content_hash'))
+        if cached:
+            # Duplicado encolado antes de que terminase el original
+            invoice_id = db.add_invoice(cached['result_json'], f"{GEMINI_MODEL_NAME} ({job_type}, caché)", user_id, cached.get('file_info'))
+            if not invoice_id: raise ValueError("Falló el guardado en la base de datos.")
+            db.update_job_as_completed(job_id, cached['result_json'], duplicate=True)
+            return 'completed'
+
+        # El payload se lee una sola vez; PdfReader, PIL y Cloudinary lo consumen como streams sobre el mismo buffer
+        with timer.stage('read'):
+            payload = blobstore.open_job_payload(job)
+        content_parts, report, final_invoice_data = [], {}, None
+        if job.get('shards_total'):
+            # Unión de un PDF fragmentado: el modelo ya vio cada rango de páginas, aquí solo se archiva y se unen
+            archival = Archival(payload.stream(), job_type, user_id)
+            with timer.stage('merge'):
+                final_invoice_data, report['merge'] = merge_shard_results(db.get_shard_results(job_id), job['shards_total'])
+        elif job_type == 'pdf':
+            # El PDF se archiva tal cual: la subida empieza antes incluso de extraer el texto
+            archival = Archival(payload.stream(), job_type, user_id)
+            with timer.stage('prepare'):
+                content_parts, pdf_report = pdf_pipeline.build_pdf_content(payload, prompt_multipagina_pdf)
+            if not pdf_report['page_count']: raise ValueError("PDF vacío.")
+            report['pdf'] = pdf_report
+        elif job_type == 'image':
+            with timer.stage('prepare'):
+                normalized = image_pipeline.normalize_image(payload.stream(), len(payload))
+            # Las imágenes se archivan ya normalizadas (orientadas y reducidas)
+            archival = Archival(io.BytesIO(normalized.data), job_type, user_id)
+            content_parts = [prompt_plantilla_factura, image_pipeline.as_model_part(normalized)]
+            report['image'] = normalized.stats
+
+        if final_invoice_data is None:
+            if len(content_parts) <= 1: raise ValueError("No se extrajo contenido del documento.")
+            with timer.stage('model'):
+                response = gemini_client.generate(content_parts, deadline=deadline)
+            final_invoice_data = extract_json_object(response.text)
+
+        # Si la subida ya terminó, el file_info se guarda con la factura; si no, se adjunta al acabar
+        file_info = archival.file_info_if_done() if archival else None
+        with timer.stage('save'):
+            invoice_id = db.add_invoice(final_invoice_data, f"{GEMINI_MODEL_NAME} ({job_type})", user_id, file_info)
+            if not invoice_id: raise ValueError("Falló el guardado en la base de datos.")
+            if job.get('content_hash'):
+                try: db.save_cached_extraction(user_id, job['content_hash'], PROMPT_VERSION, GEMINI_MODEL_NAME, final_invoice_data, file_info)
+                except Exception as e: print(f"⚠️ No se pudo guardar la extracción en caché: {e}")
+
+        if archival and archival.done(): timer.record('archive', archival.started, archival.finished)
+        report['stages'] = dict(timer.stages, total={'start_ms': 0.0, 'ms': round((time.perf_counter() - timer.origin) * 1000, 1)})
+        report['archive'] = 'done' if file_info else ('none' if not archival else 'pending')
+        db.update_job_as_completed(job_id, final_invoice_data, report=report)
+        delete_blob = _hand_off_archival(archival, timer, job, invoice_id, file_info)
+        return 'completed'
+
+    except model_client.DeadlineExceeded as e:
+        # Se acabó el presupuesto del lote: mejor devolverlo a la cola que pasarse del límite de la función
+        print(f"⏳ Job {job_id} devuelto a la cola (sin tiempo en este lote): {e}")
+        if archival: archival.then(lambda a: a.file_info and discard_original(a.file_info))
+        if db.requeue_job(job_id, f"Sin tiempo en el lote, se reanuda en el siguiente: {e}", 0, count_attempt=False):
+            delete_blob = False
+            return 'deferred'
+        return 'failed'
+    except model_client.RetryableModelError as e:
+        # Rate limit o caída del proveedor: el trabajo vuelve a la cola (con su blob) en vez de fallar para siempre
+        delay = max(gemini_client.breaker.retry_after(), JOB_RETRY_DELAY * 2 ** (job.get('attempts', 1) - 1))
+        print(f"⏳ Job {job_id} reencolado en {delay:.0f}s: {e}")
+        if archival: archival.then(lambda a: a.file_info and discard_original(a.file_info))
+        if db.requeue_job(job_id, f"Reintentando tras error transitorio: {e}", delay):
+            delete_blob = False
+            return 'retried'
+        return 'failed'
+    except Exception as e:
+        print(f"❌ Error en job {job_id}: {e}")
+        db.update_job_as_failed(job_id, f"Error procesando documento: {str(e)}")
+        if archival and invoice_id is None:
+            # La factura no llegó a guardarse: el original subido (o en subida) sobra
+            archival.then(lambda a: a.file_info and discard_original(a.file_info))
+        return 'failed'
+    finally:
+        if payload:
+            # El payload no se libera hasta que la subida en segundo plano deja de leerlo
+            if archival: archival.then(lambda a: payload.close())
+            else: payload.close()
+        if delete_blob and job.get('blob_key'): _delete_blob(job['blob_key'])
+
+def retry_archival_tasks(limit: int = 10):
+    """Reintenta tareas de archivado vencidas leyendo el original del almacén de blobs. Devuelve (ok, fallidas)."""
+    import image_pipeline
+    done = failed = 0
+    for task in db.claim_archival_tasks(limit, ARCHIVE_LEASE_SECONDS):
+        try:
+            payload = blobstore.store_for(task['blob_key']).open(task['blob_key'])
+        except Exception as e:
+            db.fail_archival_task(task['id'], f"Blob no disponible: {e}", permanent=True); failed += 1; continue
+        try:
+            with payload:
+                if task['job_type'] == 'image':
+                    upload_file = io.BytesIO(image_pipeline.normalize_image(payload.stream(), len(payload)).data)
+                else:
+                    upload_file = payload.stream()
+                file_info = upload_original(upload_file, task['job_type'], task['user_id'])
+        except Exception as e:
+            print(f"❌ Reintento de archivado {task['id']} fallido: {e}")
+            db.fail_archival_task(task['id'], str(e)); failed += 1; continue
+        if db.complete_archival_task(task['id'], task['invoice_id'], task['user_id'], task.get('content_hash'), file_info):
+            done += 1
+        else:
+            discard_original(file_info)
+        _delete_blob(task['blob_key'])
+    return done, failed
@@ -0,0 +1,272 @@
+import os
+import re
+import json
+import unicodedata
+from collections import namedtuple
+from datetime import date, timedelta
+import database as db
+
+# Presupuesto del contexto que se envía al modelo cuando la pregunta no es un agregado
+AI_CONTEXT_MAX_BYTES = int(os.environ.get('AI_CONTEXT_MAX_BYTES', str(60 * 1024)))
+AI_CONTEXT_MAX_INVOICES = int(os.environ.get('AI_CONTEXT_MAX_INVOICES', '150'))
+AI_SUMMARY_TOP_SUPPLIERS = 10
+AI_SUMMARY_MONTHS = 12
+
+AggregateQuery = namedtuple('AggregateQuery', ['metric', 'group_by', 'filters', 'labels', 'lang', 'show'])
+
+MONTHS = {
+    'enero': 1, 'febrero': 2, 'marzo': 3, 'abril': 4, 'mayo': 5, 'junio': 6, 'julio': 7, 'agosto': 8,
+    'septiembre': 9, 'setiembre': 9, 'octubre': 10, 'noviembre': 11, 'diciembre': 12,
+    'january': 1, 'february': 2, 'march': 3, 'april': 4, 'may': 5, 'june': 6, 'july': 7, 'august': 8,
+    'september': 9, 'october': 10, 'november': 11, 'december': 12,
+}
+# "may" es también un verbo ("how much may I have spent"): solo es mes junto a un año o tras "in"
+AMBIGUOUS_MONTHS = {'may'}
+MONTH_NAMES = {
+    'es': ['enero', 'febrero', 'marzo', 'abril', 'mayo', 'junio', 'julio', 'agosto', 'septiembre', 'octubre', 'noviembre', 'diciembre'],
+    'en': ['January', 'February', 'March', 'April', 'May', 'June', 'July', 'August', 'September', 'October', 'November', 'December'],
+}
+CURRENCY_ALIASES = {
+    '€': '€', 'eur': '€', 'euro': '€', 'euros': '€',
+    '$': '$', 'usd': '$', 'dolar': '$', 'dolares': '$', 'dollar': '$', 'dollars': '$',
+    '£': '£', 'gbp': '£', 'libra': '£', 'libras': '£', 'pound': '£', 'pounds': '£',
+}
+# Palabras que el enrutador entiende; si la pregunta contiene otras (salvo emisores conocidos) va al modelo
+VOCABULARY = set("""
+cuanto cuanta cuantos cuantas he has ha hemos han gastado gaste gasto gastos gastar pagado pague pago pagos pagar
+total totales suma importe importes dinero factura facturas en el la lo los las de del con a al y o por para que
+cual cuales es son fue fueron mi mis me tengo tenia tuve hay este esta estos estas ese esa todo toda todos todas
+mes meses ano anos proveedor proveedores emisor emisores
+media promedio medio mayor menor maxima minima maximo minimo mas menos cara caro barata barato debo deber
+pendiente pendientes pagada pagadas sin numero cantidad dame dime muestra muestrame ver ensena ensename abre abrir
+cada mensual mensuales moneda divisa registrada registradas
+how much many did do does i spend spent spending pay paid total sum in on at with from to for of the a an my me
+all invoice invoices bill bills month months year years supplier suppliers vendor vendors average mean
+biggest largest highest smallest lowest most least expensive cheapest unpaid pending outstanding owe what which
+is was were are per by each show open see monthly currency have has number amount
+""".split())
+ENGLISH_MARKERS = {'how', 'much', 'many', 'did', 'spend', 'spent', 'the', 'what', 'which', 'invoices', 'invoice',
+                   'unpaid', 'paid', 'owe', 'my', 'show', 'biggest', 'average', 'last', 'this', 'with', 'from'}
+# "último", "pasado", "last", "this"... solo tienen sentido en estas expresiones de periodo ("last invoice" no es un periodo)
+THIS_MONTH = r'\beste mes\b|\bmes actual\b|\bthis month\b'
+LAST_MONTH = r'\bmes pasado\b|\bultimo mes\b|\blast month\b'
+THIS_YEAR = r'\beste ano\b|\bano actual\b|\bthis year\b'
+LAST_YEAR = r'\bano pasado\b|\bultimo ano\b|\blast year\b'
+PERIOD_PHRASES = re.compile('|'.join((THIS_MONTH, LAST_MONTH, THIS_YEAR, LAST_YEAR)))
+LEGAL_SUFFIXES = {'sl', 'sa', 'slu', 'sau', 'sll', 'sc', 'cb', 'inc', 'ltd', 'llc', 'corp', 'gmbh', 'co', 'sociedad', 'limitada', 'anonima'}
+
+def _normalize(text: str) -> str:
+    text = unicodedata.normalize('NFKD', text or '').encode('ascii', 'ignore').decode('ascii')
+    return text.lower()
+
+def _tokens(text: str):
+    return re.findall(r'[a-z0-9]+', _normalize(text))
+
+def _is_year(token: str) -> bool:
+    return re.fullmatch(r'(19|20)\d\d', token) is not None
+
+def _month_positions(tokens):
+    """Posiciones de los tokens que nombran un mes."""
+    positions = []
+    for i, token in enumerate(tokens):
+        if token not in MONTHS: continue
+        if token in AMBIGUOUS_MONTHS:
+            neighbours = tokens[max(i - 1, 0):i] + tokens[i + 1:i + 2]
+            if not ((i and tokens[i - 1] == 'in') or any(_is_year(t) for t in neighbours)): continue
+        positions.append(i)
+    return positions
+
+def _detect_lang(tokens):
+    spanish = {'de', 'la', 'el', 'que', 'en', 'con', 'mis', 'he', 'cuanto', 'cuantas'} & set(tokens)
+    return 'en' if len(ENGLISH_MARKERS & set(tokens)) > len(spanish) else 'es'
+
+def _detect_metric(norm: str):
+    if re.search(r'\bcuant[ao]s\b|\bnumero de\b|\bhow many\b|\bnumber of\b', norm): return 'count'
+    if re.search(r'\bmedi[ao]\b|\bpromedio\b|\baverage\b|\bmean\b', norm): return 'avg'
+    if re.search(r'\bmayor\b|\bmas car[ao]\b|\bmaxim[ao]\b|\bbiggest\b|\blargest\b|\bhighest\b|\bmost expensive\b', norm): return 'max'
+    if re.search(r'\bmenor\b|\bmas barat[ao]\b|\bminim[ao]\b|\bsmallest\b|\blowest\b|\bcheapest\b|\bleast expensive\b', norm): return 'min'
+    if re.search(r'\bcuant[ao]\b|\btotal\b|\bsuma\b|\bgast|\bimporte\b|\bdebo\b|\bhow much\b|\bspen[dt]|\bsum\b|\bowe\b', norm): return 'sum'
+    return None
+
+def _detect_period(norm: str, tokens, today: date, lang: str):
+    """Devuelve (date_from, date_to, etiqueta) o None. Un mes sin año es su aparición más reciente."""
+    if re.search(THIS_MONTH, norm):
+        start = today.replace(day=1)
+        return start, today, ('este mes' if lang == 'es' else 'this month')
+    if re.search(LAST_MONTH, norm):
+        end = today.replace(day=1) - timedelta(days=1)
+        return end.replace(day=1), end, ('el mes pasado' if lang == 'es' else 'last month')
+    if re.search(THIS_YEAR, norm):
+        return date(today.year, 1, 1), today, ('este año' if lang == 'es' else 'this year')
+    if re.search(LAST_YEAR, norm):
+        return date(today.year - 1, 1, 1), date(today.year - 1, 12, 31), ('el año pasado' if lang == 'es' else 'last year')
+    years = [int(t) for t in tokens if _is_year(t)]
+    months = [MONTHS[tokens[i]] for i in _month_positions(tokens)]
+    if months:
+        month = months[0]
+        year = years[0] if years else (today.year if month <= today.month else today.year - 1)
+        start = date(year, month, 1)
+        end = (date(year + (month == 12), month % 12 + 1, 1) - timedelta(days=1))
+        name = MONTH_NAMES[lang][month - 1]
+        return start, end, (f"en {name} de {year}" if lang == 'es' else f"in {name} {year}")
+    if years:
+        return date(years[0], 1, 1), date(years[0], 12, 31), (f"en {years[0]}" if lang == 'es' else f"in {years[0]}")
+    return None
+
+def _detect_estado(norm: str):
+    if re.search(r'\bsin pagar\b|\bpor pagar\b|\bpendientes?\b|\bdebo\b|\bunpaid\b|\bpending\b|\boutstanding\b|\bowe\b', norm): return 'Pendiente'
+    if re.search(r'\bpagadas?\b|\bpaid\b', norm): return 'Pagada'
+    return None
+
+def _detect_moneda(question: str, tokens, monedas):
+    for moneda in monedas:
+        if moneda and (moneda in question if not moneda.isalnum() else _normalize(moneda) in tokens): return moneda
+    for token in list(tokens) + [ch for ch in question if ch in CURRENCY_ALIASES]:
+        if token in CURRENCY_ALIASES: return CURRENCY_ALIASES[token]
+    return None
+
+def _match_emisores(tokens, emisores):
+    """Emisores del usuario nombrados en la pregunta. Devuelve (emisores, tokens usados)."""
+    question_tokens = set(tokens) - VOCABULARY - set(MONTHS)
+    matched, used = [], set()
+    for emisor in emisores:
+        significant = {t for t in _tokens(emisor) if len(t) >= 3 and t not in LEGAL_SUFFIXES}
+        hits = significant & question_tokens
+        if hits:
+            matched.append(emisor); used |= hits
+    return matched, used
+
+def parse_question(question: str, emisores, monedas, today: date = None):
+    """Reconoce preguntas agregadas ("¿cuánto gasté con X en marzo?", "unpaid total in $").
+    Devuelve un AggregateQuery o None si la pregunta necesita al modelo."""
+    today = today or date.today()
+    norm, tokens = _normalize(question), _tokens(question)
+    if not tokens: return None
+    lang = _detect_lang(tokens)
+    metric = _detect_metric(norm)
+    if not metric: return None
+    matched_emisores, used = _match_emisores(tokens, emisores)
+    period_words = {word for phrase in PERIOD_PHRASES.findall(norm) for word in phrase.split()}
+    month_positions = set(_month_positions(tokens))
+    leftover = [t for i, t in enumerate(tokens) if t not in VOCABULARY and i not in month_positions and t not in CURRENCY_ALIASES
+                and t not in used and t not in period_words and not t.isdigit() and len(t) > 2 and t not in {_normalize(m) for m in monedas}]
+    # Palabras que no entendemos (un concepto, un matiz...): mejor que responda el modelo
+    if leftover: return None
+    filters, labels = {}, {}
+    if matched_emisores:
+        filters['emisores'] = matched_emisores
+        labels['emisor'] = ', '.join(matched_emisores) if len(matched_emisores) <= 3 else ', '.join(sorted(used)).title()
+    period = _detect_period(norm, tokens, today, lang)
+    if period:
+        filters['date_from'], filters['date_to'] = period[0].isoformat(), period[1].isoformat()
+        labels['periodo'] = period[2]
+    estado = _detect_estado(norm)
+    if estado: filters['estado'] = estado
+    moneda = _detect_moneda(question, tokens, monedas)
+    if moneda: filters['moneda'] = moneda
+    group_by = None
+    if re.search(r'\bpor (proveedor|emisor)|\bcada (proveedor|emisor)|\b(by|per) (supplier|vendor)|\beach (supplier|vendor)', norm): group_by = 'emisor'
+    elif re.search(r'\bpor mes\b|\bcada mes\b|\bmensual|\b(by|per) month\b|\bmonthly\b', norm): group_by = 'mes'
+    show = bool(re.search(r'\b(muestra|muestrame|ensena|ensename|abre|abrir|ver|show|open|see)\b', norm))
+    return AggregateQuery(metric, group_by, filters, labels, lang, show)
+
+def _amount(value, moneda, lang):
+    text = f"{value:,.2f}"
+    if lang == 'es': text = text.replace(',', '_').replace('.', ',').replace('_', '.')
+    return f"{text} {moneda}"
+
+def _describe(query: AggregateQuery):
+    """Describe las facturas filtradas: "facturas pendientes de X en marzo de 2024" / "unpaid invoices from X in March 2024"."""
+    estado = query.filters.get('estado')
+    if query.lang == 'es':
+        parts = ['facturas'] + ([('pendientes' if estado == 'Pendiente' else 'pagadas')] if estado else [])
+        if 'emisor' in query.labels: parts.append(f"de {query.labels['emisor']}")
+        if 'moneda' in query.filters: parts.append(f"en {query.filters['moneda']}")
+    else:
+        parts = ([('unpaid' if estado == 'Pendiente' else 'paid')] if estado else []) + ['invoices']
+        if 'emisor' in query.labels: parts.append(f"from {query.labels['emisor']}")
+        if 'moneda' in query.filters: parts.append(f"in {query.filters['moneda']}")
+    if 'periodo' in query.labels: parts.append(query.labels['periodo'])
+    return ' '.join(parts)
+
+def answer_aggregate(user_id: str, query: AggregateQuery):
+    """Responde con SQL sobre facturas. Devuelve (respuesta, invoice_id)."""
+    es, desc = query.lang == 'es', _describe(query)
+    not_found = f"No he encontrado {desc}." if es else f"I couldn't find any {desc}."
+    if query.metric in ('max', 'min'):
+        rows = db.extreme_invoices(user_id, highest=query.metric == 'max', **query.filters)
+        if not rows: return not_found, None
+        kind = ('mayor' if query.metric == 'max' else 'menor') if es else ('largest' if query.metric == 'max' else 'smallest')
+        found = '; '.join(f"{r['emisor']}, {r['fecha']}, {_amount(r['total'], r['moneda'], query.lang)}" for r in rows)
+        answer = f"La de {kind} importe de tus {desc}: {found}." if es else f"The {kind} of your {desc}: {found}."
+        return answer, (rows[0]['id'] if query.show and len(rows) == 1 else None)
+
+    rows = db.aggregate_invoices(user_id, group_by=query.group_by, limit=AI_SUMMARY_TOP_SUPPLIERS if query.group_by == 'emisor' else None, **query.filters)
+    if not rows: return not_found, None
+    noun = 'facturas' if es else 'invoices'
+
+    def value(row):
+        if query.metric == 'count': return f"{row['facturas']} {noun}"
+        return f"{_amount(row['media' if query.metric == 'avg' else 'total'], row['moneda'], query.lang)} ({row['facturas']} {noun})"
+
+    if query.group_by:
+        header = {'emisor': ('por proveedor', 'by supplier'), 'mes': ('por mes', 'by month')}[query.group_by][0 if es else 1]
+        metric_label = {'count': ('Número de', 'Number of'), 'avg': ('Importe medio de tus', 'Average amount of your'),
+                        'sum': ('Total de tus', 'Total of your')}[query.metric][0 if es else 1]
+        lines = [f"{metric_label} {desc} {header}:"] + [f"- {row['grupo'] or '-'}: {value(row)}" for row in rows]
+        return '\n'.join(lines), None
+
+    if query.metric == 'count':
+        count = sum(row['facturas'] for row in rows)
+        return (f"Tienes {count} {desc}." if es else f"You have {count} {desc}."), None
+    amounts = ' + '.join(value(row) for row in rows)
+    if query.metric == 'avg':
+        return (f"El importe medio de tus {desc} es {amounts}." if es else f"The average amount of your {desc} is {amounts}."), None
+    return (f"El total de tus {desc} es {amounts}." if es else f"The total of your {desc} is {amounts}."), None
+
+def build_summaries(user_id: str):
+    """Resúmenes precalculados sobre TODAS las facturas, para que el modelo no tenga que sumar."""
+    stats = db.get_invoice_stats(user_id, months=AI_SUMMARY_MONTHS, top_suppliers=AI_SUMMARY_TOP_SUPPLIERS)
+    return {
+        'por_moneda_y_estado': stats['totales'],
+        'principales_proveedores': stats['proveedores'],
+        'ultimos_meses': stats['meses'],
+    }
+
+def _compact_invoice(invoice: dict):
+    skip = {'user_id', 'file_info', 'search_text', 'impuestos_json', 'fecha_date'}
+    return {k: v for k, v in invoice.items() if k not in skip and v not in (None, '', [])}
+
+def retrieve_context(user_id: str, question: str, emisores, monedas, max_bytes: int = AI_CONTEXT_MAX_BYTES, max_invoices: int = AI_CONTEXT_MAX_INVOICES):
+    """Subconjunto relevante de facturas para una pregunta abierta, sin pasar de max_bytes:
+    primero las que cumplen los filtros reconocidos, luego las que comparten términos con la pregunta
+    y por último las más recientes. Devuelve (facturas, info)."""
+    tokens = _tokens(question)
+    matched_emisores, _ = _match_emisores(tokens, emisores)
+    period = _detect_period(_normalize(question), tokens, date.today(), _detect_lang(tokens))
+    filters = {'estado': _detect_estado(_normalize(question)), 'moneda': _detect_moneda(question, tokens, monedas)}
+    if period: filters['date_from'], filters['date_to'] = period[0].isoformat(), period[1].isoformat()
+    candidate_ids = []
+    def add(rows):
+        for row in rows:
+            if row['id'] not in candidate_ids: candidate_ids.append(row['id'])
+    if matched_emisores:
+        for emisor in matched_emisores[:5]:
+            add(db.search_invoices(user_id, text_query=emisor, page_size=max_invoices, **filters)[0])
+    if any(filters.values()):
+        add(db.search_invoices(user_id, page_size=max_invoices, **filters)[0])
+    terms = ' '.join(t for t in tokens if t not in VOCABULARY and t not in MONTHS and len(t) > 2)
+    if terms:
+        add(db.search_invoices(user_id, text_query=terms, page_size=max_invoices, match_any=True)[0])
+    if len(candidate_ids) < max_invoices:
+        add(db.list_invoices(user_id, fields=['id'], limit=max_invoices)[0])
+    candidate_ids = candidate_ids[:max_invoices]
+    by_id = {inv['id']: inv for inv in db.get_invoices_with_details_by_ids(user_id, candidate_ids)}
+    selected, used_bytes = [], 0
+    for invoice_id in candidate_ids:
+        if invoice_id not in by_id: continue
+        compact = _compact_invoice(by_id[invoice_id])
+        size = len(json.dumps(compact, ensure_ascii=False, default=str, separators=(',', ':')).encode('utf-8'))
+        if used_bytes + size > max_bytes: break
+        selected.append(compact); used_bytes += size
+    return selected, {'invoices': len(selected), 'candidates': len(candidate_ids), 'bytes': used_bytes}
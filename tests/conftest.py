@@ -0,0 +1,35 @@
+import os
+import sys
+import uuid
+
+import pytest
+
+# Los módulos de la app están en la raíz del repositorio (sin paquete)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+@pytest.fixture(scope='session')
+def test_db():
+    """Base de datos desechable (creada y migrada para la sesión y borrada al final) en el Postgres de
+    TEST_DATABASE_URL. Sin esa variable las pruebas que la usan se saltan."""
+    url = os.environ.get('TEST_DATABASE_URL')
+    if not url: pytest.skip("Necesita TEST_DATABASE_URL (un Postgres en el que se pueda crear una base de datos)")
+    import psycopg2
+    import psycopg2.extensions
+    import database as db
+    name = f"facturas_test_{uuid.uuid4().hex[:12]}"
+    admin = psycopg2.connect(url)
+    admin.autocommit = True
+    admin.cursor().execute(f"CREATE DATABASE {name}")
+    previous_url = os.environ.get('DATABASE_URL')
+    os.environ['DATABASE_URL'] = psycopg2.extensions.make_dsn(url, dbname=name)
+    db._pool = None
+    try:
+        db.migrate()
+        yield db
+    finally:
+        if db._pool is not None: db._pool.closeall()
+        db._pool = None
+        if previous_url is None: os.environ.pop('DATABASE_URL', None)
+        else: os.environ['DATABASE_URL'] = previous_url
+        admin.cursor().execute(f"DROP DATABASE IF EXISTS {name}")
+        admin.close()
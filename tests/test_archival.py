@@ -0,0 +1,78 @@
+import json
+import types
+
+import pytest
+
+import database as db
+import processing
+
+class FakeCursor:
+    """Cursor que registra las consultas; `invoice_exists` decide si el UPDATE de facturas devuelve fila."""
+
+    def __init__(self, invoice_exists: bool):
+        self.invoice_exists, self.queries, self._last = invoice_exists, [], None
+
+    def execute(self, sql, params=None):
+        self.queries.append((' '.join(sql.split()), params))
+        self._last = sql
+
+    def fetchone(self):
+        return (1,) if self.invoice_exists and 'facturas' in self._last else None
+
+    def tables_updated(self):
+        return [sql.split()[1] for sql, _ in self.queries]
+
+FILE_INFO = {'public_id': 'facturas/u1/original', 'resource_type': 'raw'}
+
+def test_attach_updates_invoice_and_cache():
+    cur = FakeCursor(invoice_exists=True)
+    assert db._attach_file_info(cur, 7, 'u1', 'hash', FILE_INFO) is True
+    assert cur.tables_updated() == ['facturas', 'extraction_cache']
+    assert json.loads(cur.queries[1][1][0]) == FILE_INFO
+
+def test_attach_to_deleted_invoice_leaves_the_cache_alone():
+    cur = FakeCursor(invoice_exists=False)
+    assert db._attach_file_info(cur, 7, 'u1', 'hash', FILE_INFO) is False
+    assert cur.tables_updated() == ['facturas']
+
+def test_attach_without_content_hash_skips_the_cache():
+    cur = FakeCursor(invoice_exists=True)
+    assert db._attach_file_info(cur, 7, 'u1', None, FILE_INFO) is True
+    assert cur.tables_updated() == ['facturas']
+
+@pytest.fixture
+def archive_calls(monkeypatch):
+    calls = []
+    monkeypatch.setattr(processing, 'discard_original', lambda file_info: calls.append(('discard', file_info['public_id'])))
+    monkeypatch.setattr(processing, '_delete_blob', lambda key: calls.append(('delete_blob', key)))
+    monkeypatch.setattr(db, 'update_job_report_stage', lambda *args, **kwargs: calls.append(('report', kwargs.get('status'))))
+    return calls
+
+def finished_archival(file_info=FILE_INFO, error=None):
+    return types.SimpleNamespace(file_info=file_info, error=error, started=1.0, finished=2.0)
+
+JOB = {'id': 'job-1', 'user_id': 'u1', 'content_hash': 'hash', 'blob_key': 'blob-1', 'type': 'pdf'}
+
+def test_invoice_deleted_while_archiving_discards_the_upload(monkeypatch, archive_calls):
+    monkeypatch.setattr(db, 'complete_archival_task', lambda *args: False)
+    processing._finish_archival(finished_archival(), processing.StageTimer(), JOB, 7, task_id=3)
+    assert ('discard', FILE_INFO['public_id']) in archive_calls
+    assert ('delete_blob', 'blob-1') in archive_calls
+
+def test_late_upload_for_deleted_invoice_is_discarded(monkeypatch, archive_calls):
+    monkeypatch.setattr(db, 'attach_file_info', lambda *args: False)
+    processing._attach_late_file_info(finished_archival(), processing.StageTimer(), JOB, 7)
+    assert archive_calls[0] == ('discard', FILE_INFO['public_id'])
+
+def test_late_upload_is_attached(monkeypatch, archive_calls):
+    attached = []
+    monkeypatch.setattr(db, 'attach_file_info', lambda *args: attached.append(args) or True)
+    processing._attach_late_file_info(finished_archival(), processing.StageTimer(), JOB, 7)
+    assert attached == [(7, 'u1', 'hash', FILE_INFO)]
+    assert archive_calls == [('report', 'done')]
+
+def test_failed_upload_fails_the_task(monkeypatch, archive_calls):
+    failed = []
+    monkeypatch.setattr(db, 'fail_archival_task', lambda task_id, error: failed.append((task_id, error)))
+    processing._finish_archival(finished_archival(None, RuntimeError('503')), processing.StageTimer(), JOB, 7, task_id=3)
+    assert failed == [(3, '503')] and archive_calls == []
@@ -0,0 +1,86 @@
+import io
+import os
+import zipfile
+
+import pytest
+
+import batch_upload
+import blobstore
+
+PDF = b'%PDF-1.4 factura'
+JPEG = b'\xff\xd8\xff\xe0 foto'
+
+def _zip(entries):
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, 'w') as archive:
+        for name, data in entries:
+            if data is None: archive.writestr(zipfile.ZipInfo(name), b'')  # Directorio
+            else: archive.writestr(name, data)
+    buf.seek(0)
+    return buf
+
+def _entries(sources):
+    return [(name, kind, stream.read() if stream else None, error)
+            for name, kind, stream, error in batch_upload.iter_upload_entries(sources)]
+
+def test_zip_entries_are_sniffed_by_content():
+    archive = _zip([('facturas/', None), ('facturas/enero.dat', PDF), ('foto.jpg', JPEG), ('notas.txt', b'hola'),
+                    ('vacio.pdf', b''), ('otro.zip', _zip([('a.pdf', PDF)]).getvalue()),
+                    ('__MACOSX/._enero.dat', b'x'), ('.DS_Store', b'x')])
+    assert _entries([('lote.zip', archive)]) == [
+        ('facturas/enero.dat', 'pdf', PDF, None),
+        ('foto.jpg', 'image', JPEG, None),
+        ('notas.txt', None, b'hola', None),
+        ('vacio.pdf', None, None, "Fichero vacío."),
+        ('otro.zip', None, None, "No se admiten ZIP dentro de ZIP."),
+    ]
+
+def test_plain_files_and_a_broken_zip():
+    entries = _entries([('a.pdf', io.BytesIO(PDF)), ('b', io.BytesIO(b'')), ('roto.zip', io.BytesIO(b'PK\x03\x04basura'))])
+    assert entries[:2] == [('a.pdf', 'pdf', PDF, None), ('b', None, None, "Fichero vacío.")]
+    assert entries[2][0] == 'roto.zip' and entries[2][3].startswith("ZIP inválido")
+
+def test_oversized_zip_entries_are_rejected_without_reading_them(monkeypatch):
+    monkeypatch.setattr(blobstore, 'MAX_UPLOAD_BYTES', 10)
+    assert _entries([('lote.zip', _zip([('grande.pdf', PDF)]))]) == [('grande.pdf', None, None, "El fichero supera el tamaño máximo permitido.")]
+
+@pytest.fixture
+def batch(monkeypatch, tmp_path):
+    store = blobstore.LocalBlobStore(str(tmp_path))
+    created = []
+    def create_job_batch(user_id, accepted, rejected):
+        created.append((user_id, accepted, rejected))
+        return 'batch-1', [f"job-{i}" for i in range(len(accepted))]
+    monkeypatch.setattr(blobstore, 'get_store', lambda: store)
+    monkeypatch.setattr(batch_upload.processing, 'plan_pdf_shards', lambda blob_ref: None)
+    monkeypatch.setattr(batch_upload.db, 'create_job_batch', create_job_batch)
+    stored = lambda: [f for _, _, files in os.walk(tmp_path) for f in files]
+    return created, stored
+
+def test_enqueue_batch(batch):
+    created, stored = batch
+    batch_id, jobs, rejected = batch_upload.enqueue_batch('u1', [('lote.zip', _zip([('a.pdf', PDF), ('b.jpg', JPEG), ('c.txt', b'x')]))])
+    assert batch_id == 'batch-1'
+    assert [(job['file_name'], job['type']) for job in jobs] == [('a.pdf', 'pdf'), ('b.jpg', 'image')]
+    assert rejected == [{'file_name': 'c.txt', 'error': "Tipo de fichero no soportado (se admiten PDF e imágenes)."}]
+    assert len(stored()) == 2 and created[0][0] == 'u1'
+
+def test_files_over_the_batch_limit_are_rejected(batch, monkeypatch):
+    monkeypatch.setattr(batch_upload, 'BATCH_MAX_FILES', 1)
+    _, jobs, rejected = batch_upload.enqueue_batch('u1', [('a.pdf', io.BytesIO(PDF)), ('b.pdf', io.BytesIO(PDF))])
+    assert [job['file_name'] for job in jobs] == ['a.pdf']
+    assert [r['file_name'] for r in rejected] == ['b.pdf']
+
+def test_batch_without_valid_files(batch):
+    created, _ = batch
+    with pytest.raises(batch_upload.BatchError) as error:
+        batch_upload.enqueue_batch('u1', [('c.txt', io.BytesIO(b'x'))])
+    assert error.value.rejected[0]['file_name'] == 'c.txt' and not created
+
+def test_blobs_are_deleted_when_enqueueing_fails(batch, monkeypatch):
+    _, stored = batch
+    def fail(*args): raise RuntimeError("sin base de datos")
+    monkeypatch.setattr(batch_upload.db, 'create_job_batch', fail)
+    with pytest.raises(RuntimeError):
+        batch_upload.enqueue_batch('u1', [('a.pdf', io.BytesIO(PDF)), ('b.jpg', io.BytesIO(JPEG))])
+    assert not stored()
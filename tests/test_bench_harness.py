@@ -0,0 +1,77 @@
+import json
+
+import pytest
+
+from bench import harness
+
+def test_percentile_uses_nearest_rank():
+    values = [float(v) for v in range(1, 101)]
+    assert harness.percentile(values, 50) == 50.0
+    assert harness.percentile(values, 95) == 95.0
+    assert harness.percentile(values, 99) == 99.0
+    assert harness.percentile(values, 100) == 100.0
+    assert harness.percentile([7.0], 99) == 7.0
+    assert harness.percentile([], 50) == 0.0
+
+def test_percentile_of_small_samples_rounds_up():
+    values = [1.0, 2.0, 3.0, 4.0]
+    assert harness.percentile(values, 50) == 2.0
+    assert harness.percentile(values, 95) == 4.0
+
+def test_summarize():
+    latencies = [0.001 * v for v in range(100, 0, -1)]  # Sin ordenar: summarize ordena
+    result = harness.summarize('escenario', latencies, [2] * 99 + [5], errors=1, elapsed=2.0, concurrency=4)
+    assert result['requests'] == 100 and result['errors'] == 1
+    assert result['throughput_rps'] == 50.0
+    assert (result['p50_ms'], result['p95_ms'], result['p99_ms']) == (50.0, 95.0, 99.0)
+    assert result['mean_ms'] == 50.5
+    assert result['queries_per_request'] == 2.03 and result['max_queries'] == 5
+    assert result['concurrency'] == 4
+
+def test_summarize_without_requests_or_queries():
+    result = harness.summarize('vacío', [], [], errors=0, elapsed=0)
+    assert result['throughput_rps'] == 0.0 and result['p99_ms'] == 0.0
+    assert result['queries_per_request'] is None
+
+@pytest.fixture
+def baseline_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(harness, 'BASELINE_DIR', str(tmp_path))
+    return tmp_path
+
+def result(name, p50=10.0, p95=20.0, p99=30.0, rps=100.0, queries=2.0):
+    return {'name': name, 'p50_ms': p50, 'p95_ms': p95, 'p99_ms': p99, 'throughput_rps': rps, 'queries_per_request': queries}
+
+def test_save_and_compare_without_changes(baseline_dir):
+    harness.save_baseline('base', [result('a'), result('b')], {'requests': 10})
+    saved = json.loads((baseline_dir / 'base.json').read_text(encoding='utf-8'))
+    assert set(saved['results']) == {'a', 'b'} and saved['config'] == {'requests': 10}
+    assert harness.compare_baseline('base', [result('a'), result('b')], tolerance=0.2) == []
+
+def test_compare_flags_only_changes_beyond_the_tolerance(baseline_dir):
+    harness.save_baseline('base', [result('a')], {})
+    # +20% de latencia y -20% de throughput están justo en el límite; +21% y -21% no
+    assert harness.compare_baseline('base', [result('a', p50=12.0, rps=80.0)], tolerance=0.2) == []
+    regressions = harness.compare_baseline('base', [result('a', p95=24.2, rps=79.0)], tolerance=0.2)
+    assert [r.split(':')[0] for r in regressions] == ['a p95_ms', 'a throughput_rps']
+
+def test_compare_ignores_improvements(baseline_dir):
+    harness.save_baseline('base', [result('a')], {})
+    faster = result('a', p50=1.0, p95=2.0, p99=3.0, rps=1000.0, queries=1.0)
+    assert harness.compare_baseline('base', [faster], tolerance=0.2) == []
+
+def test_compare_counts_extra_queries_as_a_regression(baseline_dir):
+    harness.save_baseline('base', [result('a', queries=2.0)], {})
+    assert harness.compare_baseline('base', [result('a', queries=3.0)], tolerance=0.2) == ['a queries_per_request: 2.0 -> 3.0 (+50%)']
+
+def test_compare_skips_scenarios_and_metrics_without_baseline(baseline_dir):
+    harness.save_baseline('base', [result('a', queries=None)], {})
+    assert harness.compare_baseline('base', [result('a', queries=9.0), result('nuevo', p50=1e6)], tolerance=0.2) == []
+
+def test_committed_baseline_is_comparable():
+    import os
+    path = os.path.join(harness.BASELINE_DIR, 'local.json')
+    with open(path, encoding='utf-8') as f: baseline = json.load(f)
+    assert baseline['results'] and baseline['environment'] and baseline['config']
+    for name, metrics in baseline['results'].items():
+        assert metrics['name'] == name
+        assert all(metric in metrics for metric in harness.COMPARED_METRICS)
@@ -0,0 +1,155 @@
+import io
+import os
+import sys
+import hashlib
+import types
+
+import pytest
+
+import blobstore
+
+@pytest.fixture
+def store_env(monkeypatch, tmp_path):
+    """Configura el almacén como lo harían las variables de entorno (se leen al importar el módulo)."""
+    def configure(store='', directory=None, bucket=None, vercel=False):
+        monkeypatch.setattr(blobstore, 'BLOB_STORE', store)
+        monkeypatch.setattr(blobstore, 'BLOB_STORE_DIR', str(tmp_path / directory) if directory else None)
+        monkeypatch.setattr(blobstore, 'BLOB_STORE_BUCKET', bucket)
+        if vercel: monkeypatch.setenv('VERCEL', '1')
+        else: monkeypatch.delenv('VERCEL', raising=False)
+        monkeypatch.setattr(blobstore, '_store', None)
+    monkeypatch.setattr(blobstore.tempfile, 'gettempdir', lambda: str(tmp_path))
+    return configure
+
+class FakeS3Client:
+    def __init__(self):
+        self.objects = {}
+
+    def upload_fileobj(self, fileobj, bucket, key):
+        self.objects[(bucket, key)] = fileobj.read()
+
+    def get_object(self, Bucket, Key):
+        return {'Body': io.BytesIO(self.objects[(Bucket, Key)])}
+
+    def delete_object(self, Bucket, Key):
+        self.objects.pop((Bucket, Key), None)
+
+@pytest.fixture
+def fake_boto3(monkeypatch):
+    client = FakeS3Client()
+    monkeypatch.setitem(sys.modules, 'boto3', types.SimpleNamespace(client=lambda service, endpoint_url=None: client))
+    return client
+
+def test_default_is_the_local_spool(store_env, tmp_path):
+    store_env()
+    store = blobstore._create_store()
+    assert isinstance(store, blobstore.LocalBlobStore) and store.root == str(tmp_path / 'facturas-blobs')
+
+def test_local_spool_in_the_configured_dir(store_env, tmp_path):
+    store_env(directory='spool')
+    assert blobstore._create_store().root == str(tmp_path / 'spool')
+
+def test_vercel_without_configuration_keeps_postgres(store_env):
+    store_env(vercel=True)
+    assert isinstance(blobstore._create_store(), blobstore.PostgresBlobStore)
+
+def test_vercel_with_a_shared_dir_uses_it(store_env):
+    store_env(directory='volumen', vercel=True)
+    assert isinstance(blobstore._create_store(), blobstore.LocalBlobStore)
+
+def test_vercel_explicit_local_without_dir_is_an_error(store_env):
+    store_env(store='local', vercel=True)
+    with pytest.raises(RuntimeError, match='BLOB_STORE_DIR'):
+        blobstore._create_store()
+
+@pytest.mark.parametrize('vercel', [False, True])
+def test_postgres_only_on_request(store_env, vercel):
+    store_env(store='postgres', vercel=vercel)
+    assert isinstance(blobstore._create_store(), blobstore.PostgresBlobStore)
+
+@pytest.mark.parametrize('vercel', [False, True])
+def test_s3_store(store_env, fake_boto3, vercel):
+    store_env(store='s3', bucket='facturas', vercel=vercel)
+    store = blobstore._create_store()
+    assert isinstance(store, blobstore.S3BlobStore) and store.bucket == 'facturas'
+
+def test_s3_without_bucket_is_an_error(store_env, fake_boto3):
+    store_env(store='s3')
+    with pytest.raises(RuntimeError, match='BLOB_STORE_BUCKET'):
+        blobstore._create_store()
+
+def test_unknown_store_is_an_error(store_env):
+    store_env(store='ftp')
+    with pytest.raises(RuntimeError, match='ftp'):
+        blobstore._create_store()
+
+def test_numeric_keys_are_read_from_postgres(store_env):
+    store_env(directory='spool')
+    assert isinstance(blobstore.store_for('16895'), blobstore.PostgresBlobStore)
+    assert isinstance(blobstore.store_for('1ecd978cce8e495a9b844480a6c819c1'), blobstore.LocalBlobStore)
+
+def test_s3_round_trip(fake_boto3):
+    store = blobstore.S3BlobStore('facturas', 'blobs/')
+    ref = store.put_stream(io.BytesIO(b'%PDF-1.4 contenido'))
+    assert ref.size == 18 and ('facturas', f'blobs/{ref.key}') in fake_boto3.objects
+    with store.open(ref.key) as payload: assert bytes(payload.view) == b'%PDF-1.4 contenido'
+    store.delete(ref.key)
+    assert not fake_boto3.objects
+
+def test_s3_rejects_oversized_uploads_before_sending(fake_boto3):
+    store = blobstore.S3BlobStore('facturas')
+    with pytest.raises(blobstore.BlobTooLarge):
+        store.put_stream(io.BytesIO(b'x' * 100), max_bytes=10)
+    assert not fake_boto3.objects
+
+def test_local_round_trip(tmp_path):
+    store = blobstore.LocalBlobStore(str(tmp_path))
+    ref = store.put_stream(io.BytesIO(b'hola'))
+    with store.open(ref.key) as payload: assert bytes(payload.view) == b'hola'
+    store.delete(ref.key)
+    store.delete(ref.key)  # Borrar dos veces no falla
+    with pytest.raises(FileNotFoundError): store.open(ref.key)
+
+def test_local_rejects_oversized_uploads_without_leaving_files(tmp_path):
+    store = blobstore.LocalBlobStore(str(tmp_path))
+    with pytest.raises(blobstore.BlobTooLarge):
+        store.put_stream(io.BytesIO(b'x' * 100), max_bytes=10)
+    assert not [f for _, _, files in os.walk(tmp_path) for f in files]
+
+def test_content_hash_is_the_sha256_of_the_stream(tmp_path):
+    data = b'\x89PNG\r\n\x1a\n' + b'\x00' * (blobstore.UPLOAD_CHUNK_SIZE * 2 + 7)
+    ref = blobstore.LocalBlobStore(str(tmp_path)).put_stream(io.BytesIO(data))
+    assert ref.content_hash == hashlib.sha256(data).hexdigest() and ref.size == len(data)
+
+@pytest.mark.parametrize('head, kind', [
+    (b'%PDF-1.7\n', 'pdf'),
+    (b'\r\n\xef\xbb\xbf%PDF-1.4', 'pdf'),
+    (b'PK\x03\x04\x14\x00', 'zip'),
+    (b'\xff\xd8\xff\xe0\x00\x10JFIF', 'image'),
+    (b'\x89PNG\r\n\x1a\n\x00', 'image'),
+    (b'GIF89a', 'image'),
+    (b'II*\x00', 'image'),
+    (b'RIFF\x24\x00\x00\x00WEBPVP8 ', 'image'),
+    (b'RIFF\x24\x00\x00\x00WAVEfmt ', None),
+    (b'<html><body>', None),
+    (b'', None),
+])
+def test_detect_content_type(head, kind):
+    assert blobstore.detect_content_type(head) == kind
+
+def test_prefixed_stream_replays_the_sniffed_head():
+    stream = blobstore.PrefixedStream(b'%PDF', io.BytesIO(b'-1.4 resto'))
+    assert stream.read(2) == b'%P'
+    assert stream.read() == b'DF-1.4 resto'
+
+def test_payload_streams_have_independent_positions():
+    payload = blobstore.Payload(memoryview(b'abcdef'))
+    first, second = payload.stream(), payload.stream()
+    assert first.read(3) == b'abc' and second.read() == b'abcdef' and first.read() == b'def'
+
+def test_postgres_round_trip(test_db):
+    store = blobstore.PostgresBlobStore()
+    ref = store.put_stream(io.BytesIO(b'%PDF-1.4 en postgres'))
+    assert ref.key.isdigit()
+    with store.open(ref.key) as payload: assert bytes(payload.view) == b'%PDF-1.4 en postgres'
+    store.delete(ref.key)
@@ -0,0 +1,118 @@
+import threading
+import time
+
+import psycopg2.extensions
+import pytest
+
+import database as db
+
+class FakeConnection:
+    """Conexión mínima: `broken` hace fallar el SELECT 1 de validación."""
+
+    def __init__(self):
+        self.closed, self.broken, self.in_transaction, self.rollbacks = 0, False, False, 0
+
+    def cursor(self):
+        conn = self
+        class Cursor:
+            def execute(self, sql):
+                if conn.broken: raise psycopg2.OperationalError("server closed the connection")
+            def close(self): pass
+        return Cursor()
+
+    def rollback(self):
+        self.rollbacks += 1; self.in_transaction = False
+
+    def close(self):
+        self.closed = 1
+
+    def get_transaction_status(self):
+        return psycopg2.extensions.TRANSACTION_STATUS_INTRANS if self.in_transaction else psycopg2.extensions.TRANSACTION_STATUS_IDLE
+
+@pytest.fixture
+def created():
+    return []
+
+@pytest.fixture
+def make_pool(created):
+    def factory():
+        conn = FakeConnection(); created.append(conn); return conn
+    def make(**kwargs):
+        kwargs.setdefault('validate_idle', 60.0)
+        return db.ConnectionPool(factory, **kwargs)
+    return make
+
+def test_connections_are_reused(make_pool, created):
+    pool = make_pool(maxconn=2)
+    conn = pool.getconn(); pool.putconn(conn)
+    assert pool.getconn() is conn
+    assert len(created) == 1
+    assert pool.snapshot()['in_use'] == 1
+
+def test_minconn_opens_connections_up_front(make_pool, created):
+    pool = make_pool(minconn=2, maxconn=4)
+    assert len(created) == 2 and pool.snapshot()['idle'] == 2
+
+def test_checkout_waits_for_a_returned_connection(make_pool):
+    pool = make_pool(maxconn=1, timeout=2.0)
+    conn = pool.getconn()
+    threading.Timer(0.1, pool.putconn, args=(conn,)).start()
+    assert pool.getconn() is conn
+    assert pool.snapshot()['waits'] == 1
+
+def test_checkout_times_out_when_exhausted(make_pool):
+    pool = make_pool(maxconn=1, timeout=0.05)
+    pool.getconn()
+    with pytest.raises(db.PoolTimeout):
+        pool.getconn()
+    assert pool.snapshot()['wait_timeouts'] == 1
+
+def test_idle_connection_failing_validation_is_replaced(make_pool, created):
+    pool = make_pool(maxconn=1, validate_idle=0.0)
+    conn = pool.getconn(); pool.putconn(conn)
+    conn.broken = True
+    fresh = pool.getconn()
+    assert fresh is not conn and conn.closed
+    assert pool.snapshot()['failed_validations'] == 1 and pool.snapshot()['size'] == 1
+
+def test_closed_connection_is_not_handed_out(make_pool):
+    pool = make_pool(maxconn=1)
+    conn = pool.getconn(); pool.putconn(conn)
+    conn.closed = 1
+    assert pool.getconn() is not conn
+
+def test_connections_are_recycled_by_uses_and_age(make_pool):
+    pool = make_pool(maxconn=1, max_uses=2)
+    conn = pool.getconn(); pool.putconn(conn)
+    assert pool.getconn() is conn; pool.putconn(conn)
+    assert pool.getconn() is not conn and pool.snapshot()['recycled'] == 1
+    pool = make_pool(maxconn=1, max_age=0.01)
+    conn = pool.getconn(); pool.putconn(conn)
+    time.sleep(0.02)
+    assert pool.getconn() is not conn
+
+def test_open_transaction_is_rolled_back_on_return(make_pool):
+    pool = make_pool(maxconn=1)
+    conn = pool.getconn()
+    conn.in_transaction = True
+    pool.putconn(conn)
+    assert conn.rollbacks == 1 and not conn.in_transaction
+
+def test_failed_connect_frees_the_slot():
+    attempts = []
+    def factory():
+        attempts.append(1)
+        if len(attempts) == 1: raise psycopg2.OperationalError("could not connect")
+        return FakeConnection()
+    pool = db.ConnectionPool(factory, maxconn=1, timeout=0.05)
+    with pytest.raises(psycopg2.OperationalError):
+        pool.getconn()
+    assert pool.getconn() is not None and pool.snapshot()['size'] == 1
+
+def test_closeall_rejects_new_checkouts(make_pool):
+    pool = make_pool(maxconn=2)
+    conn = pool.getconn(); pool.putconn(conn)
+    pool.closeall()
+    assert conn.closed
+    with pytest.raises(db.PoolError):
+        pool.getconn()
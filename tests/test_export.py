@@ -0,0 +1,80 @@
+import csv
+import io
+import json
+import time
+import uuid
+from datetime import date
+
+import pytest
+
+import app as app_module
+import identity
+
+def _invoice(invoice_id, **fields):
+    invoice = {f: None for f in app_module.EXPORT_CSV_INVOICE_FIELDS}
+    invoice.update(id=invoice_id, fecha_date=date(2025, 3, invoice_id), emisor=f"Emisor {invoice_id}", total=10.5, moneda='€', **fields)
+    return invoice
+
+def _concepto(descripcion, cantidad=1, precio=1.0):
+    return {'descripcion': descripcion, 'cantidad': cantidad, 'precio_unitario': precio}
+
+def _rows():
+    first, second = _invoice(1, impuestos={'IVA 21%': 2.1}), _invoice(2, notas='=HYPERLINK("http://x")')
+    return [(first, _concepto('Tornillos', 10, 0.1)), (first, _concepto('-Descuento', 1, -1.0)), (second, None)]
+
+def _csv(chunks):
+    text = ''.join(chunks)
+    assert text.startswith('\ufeff')
+    return list(csv.DictReader(io.StringIO(text[1:])))
+
+def test_csv_has_one_line_per_concepto():
+    rows = _csv(app_module.iter_csv_export(_rows()))
+    assert [(r['factura_id'], r['concepto_descripcion']) for r in rows] == [('1', 'Tornillos'), ('1', "'-Descuento"), ('2', '')]
+    assert rows[0]['fecha_date'] == '2025-03-01' and rows[0]['emisor'] == rows[1]['emisor'] == 'Emisor 1'
+    assert json.loads(rows[0]['impuestos']) == {'IVA 21%': 2.1} and rows[2]['impuestos'] == ''
+
+def test_csv_neutralizes_formulas():
+    assert _csv(app_module.iter_csv_export(_rows()))[2]['notas'] == '\'=HYPERLINK("http://x")'
+    assert app_module._export_value('@SUM(A1)') == "'@SUM(A1)"
+    assert app_module._export_value(-1.0) == -1.0
+
+def test_csv_is_streamed_in_chunks(monkeypatch):
+    monkeypatch.setattr(app_module, 'EXPORT_CHUNK_BYTES', 10)
+    chunks = list(app_module.iter_csv_export(_rows()))
+    assert len(chunks) > 2
+    assert ''.join(chunks) == ''.join(app_module.iter_csv_export(_rows()))
+
+def test_ndjson_has_one_object_per_invoice():
+    lines = ''.join(app_module.iter_ndjson_export(_rows())).splitlines()
+    invoices = [json.loads(line) for line in lines]
+    assert [(inv['id'], [c['descripcion'] for c in inv['conceptos']]) for inv in invoices] == [(1, ['Tornillos', '-Descuento']), (2, [])]
+    assert invoices[0]['fecha_date'] == '2025-03-01'
+
+def test_empty_export():
+    assert ''.join(app_module.iter_ndjson_export([])) == ''
+    assert _csv(app_module.iter_csv_export([])) == []
+
+@pytest.fixture
+def api(test_db):
+    identity.set_token_verifier(lambda token: {'uid': token, 'exp': time.time() + 3600})
+    user = f"export-{uuid.uuid4().hex[:8]}"
+    test_db.add_invoice({'emisor': 'Acme', 'fecha': '01/02/2025', 'total': 12, 'estado': 'Pagada',
+                         'conceptos': [{'descripcion': 'Papel', 'cantidad': 2, 'precio_unitario': 6}]}, 'test', user)
+    test_db.add_invoice({'emisor': 'Beta', 'fecha': '01/03/2025', 'total': 5}, 'test', user)
+    yield app_module.app.test_client(), {'Authorization': f"Bearer {user}"}
+    identity.set_token_verifier(None); identity.invalidate_user(user)
+
+def test_export_endpoint(api):
+    client, headers = api
+    response = client.get('/api/invoices/export', headers=headers, query_string={'format': 'csv', 'date_from': '2025-02-01'})
+    assert response.status_code == 200 and response.mimetype == 'text/csv'
+    assert 'facturas_2025-02-01.csv' in response.headers['Content-Disposition']
+    rows = _csv([response.get_data(as_text=True)])
+    assert [(r['emisor'], r['concepto_descripcion']) for r in rows] == [('Acme', 'Papel'), ('Beta', '')]
+    response = client.get('/api/invoices/export', headers=headers, query_string={'format': 'ndjson', 'estado': 'Pagada'})
+    assert [json.loads(line)['emisor'] for line in response.get_data(as_text=True).splitlines()] == ['Acme']
+
+def test_export_rejects_bad_parameters(api):
+    client, headers = api
+    assert client.get('/api/invoices/export', headers=headers, query_string={'format': 'xlsx'}).status_code == 400
+    assert client.get('/api/invoices/export', headers=headers, query_string={'date_from': '01/02/2025'}).status_code == 400
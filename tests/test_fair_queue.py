@@ -0,0 +1,63 @@
+import uuid
+
+import pytest
+
+import blobstore
+
+def blob(i):
+    return blobstore.BlobRef(f"blob-{uuid.uuid4().hex}", f"hash-{uuid.uuid4().hex}", 100 + i)
+
+@pytest.fixture
+def queue(test_db):
+    db = test_db
+    with db.db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute("TRUNCATE job_queue, job_batches, job_queue_users")
+        conn.commit(); cur.close()
+    return db
+
+def finish(db, jobs):
+    with db.db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute("UPDATE job_queue SET status = 'completed', lease_expires_at = NULL WHERE id = ANY(%s::uuid[])", ([str(j['id']) for j in jobs],))
+        conn.commit(); cur.close()
+
+def test_small_user_is_not_stuck_behind_a_big_batch(queue):
+    db = queue
+    db.create_job_batch('heavy', [(blob(i), 'pdf', f"f{i}.pdf", None) for i in range(800)])
+    light_job = db.create_job(blob(0), 'light', 'pdf')
+    order = []
+    for _ in range(6):
+        claimed = db.claim_pending_jobs(1, 60)
+        order += [job['user_id'] for job in claimed]
+        finish(db, claimed)
+    # El único trabajo del usuario ligero sale entre los primeros, no después de 800
+    assert 'light' in order[:2], order
+    assert order.count('light') == 1 and order.count('heavy') == 5
+    assert db.get_job_status(light_job, 'light')['status'] == 'completed'
+
+def test_per_user_cap_leaves_room_for_others(queue):
+    db = queue
+    db.create_job_batch('heavy', [(blob(i), 'pdf', f"f{i}.pdf", None) for i in range(800)])
+    db.create_job(blob(0), 'light', 'pdf')
+    claimed = db.claim_pending_jobs(10, 60)
+    users = [job['user_id'] for job in claimed]
+    assert users.count('heavy') == db.JOB_USER_MAX_IN_FLIGHT and users.count('light') == 1
+    # Con sus huecos ocupados, el usuario pesado no reclama más hasta que termine alguno
+    assert db.claim_pending_jobs(10, 60) == []
+    finish(db, claimed[:1] if claimed[0]['user_id'] == 'heavy' else claimed[1:2])
+    assert [job['user_id'] for job in db.claim_pending_jobs(10, 60)] == ['heavy']
+
+def test_in_flight_count_uses_its_index(queue):
+    db = queue
+    db.create_job_batch('heavy', [(blob(i), 'pdf', f"f{i}.pdf", None) for i in range(800)])
+    with db.db_connection() as conn:
+        cur = conn.cursor()
+        # Muchos trabajos en curso de muchos usuarios: el recuento por usuario no debe recorrerlos todos
+        cur.execute("""UPDATE job_queue SET status = 'processing', lease_expires_at = NOW() + interval '5 minutes',
+                       user_id = 'u' || (random() * 400)::int WHERE id IN (SELECT id FROM job_queue LIMIT 700)""")
+        cur.execute("ANALYZE job_queue")
+        cur.execute("EXPLAIN SELECT user_id, COUNT(*) FROM job_queue WHERE status = 'processing' AND user_id IN ('heavy', 'u7') GROUP BY user_id")
+        plan = '\n'.join(row[0] for row in cur.fetchall())
+        conn.rollback(); cur.close()
+    assert 'idx_job_queue_user_processing' in plan, plan
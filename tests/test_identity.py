@@ -0,0 +1,78 @@
+import types
+from datetime import datetime, timezone
+
+import pytest
+
+import identity
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1_000_000.0]
+    monkeypatch.setattr(identity, 'time', types.SimpleNamespace(time=lambda: now[0]))
+    return now
+
+@pytest.fixture
+def caches():
+    identity._claims_cache.clear(); identity._user_cache.clear()
+    yield
+    identity.set_token_verifier(None); identity._user_cache.clear()
+
+def test_ttl_cache_expires_and_evicts_least_recently_used(clock):
+    cache = identity.TTLCache(2, ttl=10)
+    cache.set('a', 1); cache.set('b', 2)
+    assert cache.get('a') == 1
+    cache.set('c', 3)
+    assert cache.get('b') is None and cache.get('a') == 1
+    clock[0] += 10
+    assert cache.get('a') is None and cache.get('c') is None
+    assert cache.stats()['size'] == 0
+
+def test_ttl_cache_needs_an_expiry():
+    with pytest.raises(ValueError):
+        identity.TTLCache(2).set('a', 1)
+
+def test_token_claims_are_cached_until_exp(clock, caches):
+    calls = []
+    identity.set_token_verifier(lambda token: calls.append(token) or {'uid': 'u1', 'exp': clock[0] + 60})
+    assert identity.verify_token('tok')['uid'] == 'u1'
+    assert identity.verify_token('tok')['uid'] == 'u1'
+    assert calls == ['tok']
+    clock[0] += 60
+    identity.verify_token('tok')
+    assert calls == ['tok', 'tok']
+
+def test_token_cache_key_is_not_the_raw_token(clock, caches):
+    identity.set_token_verifier(lambda token: {'uid': 'u1', 'exp': clock[0] + 60})
+    identity.verify_token('secret-token')
+    assert 'secret-token' not in identity._claims_cache._data
+
+@pytest.fixture
+def users(monkeypatch, clock):
+    lookups, statuses = [], {}
+    trial_end = datetime.fromtimestamp(clock[0] + 5, tz=timezone.utc)
+    def get_or_create_user(uid, email=None):
+        lookups.append(uid); return {'firebase_uid': uid, 'trial_end_date': trial_end}
+    monkeypatch.setattr(identity.db, 'get_or_create_user', get_or_create_user)
+    monkeypatch.setattr(identity.db, 'compute_user_status', lambda user: {'status': statuses.get(user['firebase_uid'], 'active')})
+    return lookups, statuses
+
+def test_resolve_user_is_cached_for_the_ttl(clock, caches, users):
+    lookups, _ = users
+    identity.resolve_user('u1'); identity.resolve_user('u1')
+    assert lookups == ['u1']
+    clock[0] += identity.USER_CACHE_TTL
+    identity.resolve_user('u1')
+    assert lookups == ['u1', 'u1']
+
+def test_trial_status_does_not_outlive_the_trial(clock, caches, users):
+    lookups, statuses = users
+    statuses['u1'] = 'trial_active'
+    identity.resolve_user('u1')
+    clock[0] += 5
+    identity.resolve_user('u1')
+    assert lookups == ['u1', 'u1']
+
+def test_invalidate_user(clock, caches, users):
+    lookups, _ = users
+    identity.resolve_user('u1'); identity.invalidate_user('u1'); identity.resolve_user('u1')
+    assert lookups == ['u1', 'u1']
@@ -0,0 +1,47 @@
+import io
+import os
+
+from PIL import Image
+
+import image_pipeline
+
+def _encode(img, fmt='JPEG', **kwargs):
+    buf = io.BytesIO(); img.save(buf, fmt, **kwargs); buf.seek(0)
+    return buf
+
+def _normalize(buf, **kwargs):
+    return image_pipeline.normalize_image(buf, len(buf.getvalue()), **kwargs)
+
+def _open(result):
+    return Image.open(io.BytesIO(result.data))
+
+def test_exif_orientation_is_applied():
+    exif = Image.Exif(); exif[0x0112] = 6  # Girada 90°: la foto se hizo en vertical
+    result = _normalize(_encode(Image.new('RGB', (400, 300), 'white'), exif=exif))
+    assert _open(result).size == (300, 400)
+    assert result.stats['size'] == [300, 400]
+
+def test_large_images_are_scaled_to_the_max_edge():
+    result = _normalize(_encode(Image.new('RGB', (3000, 1500), 'white')), max_edge=1000)
+    assert _open(result).size == (1000, 500)
+    assert result.stats['draft'] and result.stats['pixel_reduction'] > 0.8
+
+def test_output_fits_the_byte_budget():
+    noise = Image.frombytes('RGB', (800, 800), os.urandom(800 * 800 * 3))
+    buf = _encode(noise, 'PNG')
+    result = _normalize(buf, target_bytes=100 * 1024)
+    assert len(result.data) <= 100 * 1024
+    assert result.mime_type == 'image/jpeg' and _open(result).format == 'JPEG'
+
+def test_compliant_jpeg_is_passed_through_untouched():
+    buf = _encode(Image.new('RGB', (200, 100), 'white'))
+    assert _normalize(buf).data == buf.getvalue()
+
+def test_transparency_is_flattened_on_white():
+    result = _normalize(_encode(Image.new('RGBA', (50, 50), (255, 0, 0, 0)), 'PNG'))
+    img = _open(result)
+    assert img.mode == 'RGB' and min(img.getpixel((25, 25))) > 245
+
+def test_grayscale():
+    result = _normalize(_encode(Image.new('RGB', (50, 50), 'red')), grayscale=True)
+    assert _open(result).mode == 'L'
@@ -0,0 +1,63 @@
+import time
+import uuid
+
+import pytest
+
+import app as app_module
+import identity
+
+@pytest.mark.parametrize('after', [('2025-03-01', 42), (None, 7)])
+def test_cursor_round_trip(after):
+    token = app_module.encode_cursor(after)
+    assert '=' not in token
+    assert app_module.decode_cursor(token) == after
+
+@pytest.mark.parametrize('token', ['no-es-un-cursor', app_module.encode_cursor([1, 2, 3])])
+def test_invalid_cursor(token):
+    with pytest.raises(ValueError):
+        app_module.decode_cursor(token)
+
+@pytest.fixture
+def api(test_db):
+    identity.set_token_verifier(lambda token: {'uid': token, 'exp': time.time() + 3600})
+    user = f"list-{uuid.uuid4().hex[:8]}"
+    client = app_module.app.test_client()
+    headers = {'Authorization': f"Bearer {user}"}
+    for i, fecha in enumerate(['01/01/2025', '15/03/2025', None, '15/03/2025', '2024-12-31']):
+        test_db.add_invoice({'emisor': f"Emisor {i}", 'fecha': fecha, 'total': i}, 'test', user)
+    yield client, headers
+    identity.set_token_verifier(None); identity.invalidate_user(user)
+
+def test_keyset_pages_cover_every_invoice_once(api):
+    client, headers = api
+    fields = 'fecha_date,emisor'
+    full = client.get('/api/invoices', headers=headers, query_string={'fields': fields}).get_json()['invoices']
+    seen, cursor = [], None
+    while True:
+        body = client.get('/api/invoices', headers=headers, query_string={'fields': fields, 'limit': 2, 'cursor': cursor or ''}).get_json()
+        assert len(body['invoices']) <= 2
+        seen += body['invoices']; cursor = body['next_cursor']
+        if not cursor: break
+    assert [inv['id'] for inv in seen] == [inv['id'] for inv in full] and len(seen) == 5
+    # Más recientes primero; la factura sin fecha va al final
+    assert [inv['fecha_date'] for inv in seen] == ['2025-03-15', '2025-03-15', '2025-01-01', '2024-12-31', None]
+
+def test_field_projection(api):
+    client, headers = api
+    invoices = client.get('/api/invoices', headers=headers, query_string={'fields': 'emisor,total'}).get_json()['invoices']
+    assert set(invoices[0]) == {'id', 'emisor', 'total'}
+    response = client.get('/api/invoices', headers=headers, query_string={'fields': 'emisor,file_info'})
+    assert response.status_code == 400
+
+def test_conditional_get(api):
+    client, headers = api
+    first = client.get('/api/invoices', headers=headers)
+    etag = first.headers['ETag']
+    again = client.get('/api/invoices', headers=dict(headers, **{'If-None-Match': etag}))
+    assert again.status_code == 304 and not again.data
+    # Otra página es otra representación
+    other = client.get('/api/invoices', headers=dict(headers, **{'If-None-Match': etag}), query_string={'limit': 1})
+    assert other.status_code == 200
+    assert client.post('/api/invoices', headers=headers, json={'emisor': 'Nueva', 'total': 1}).status_code == 201
+    changed = client.get('/api/invoices', headers=dict(headers, **{'If-None-Match': etag}))
+    assert changed.status_code == 200 and changed.headers['ETag'] != etag
@@ -0,0 +1,45 @@
+import uuid
+
+def _user():
+    return f"mig-{uuid.uuid4().hex[:8]}"
+
+def test_schema_is_at_the_latest_version(test_db):
+    assert test_db.get_schema_version() == test_db.SCHEMA_VERSION
+
+def test_base_schema_does_not_touch_existing_rows(test_db):
+    user = _user()
+    invoice_id = test_db.add_invoice({'emisor': 'Acme', 'fecha': '05/03/2025', 'total': 10}, 'test', user)
+    with test_db.db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute("UPDATE facturas SET fecha_date = NULL, search_text = NULL WHERE id = %s", (invoice_id,))
+        # Reaplicar la migración 001 (idempotente) no rellena nada: eso es cosa de los backfills
+        test_db._migration_001_base_schema(cur)
+        cur.execute("SELECT fecha_date, search_text FROM facturas WHERE id = %s", (invoice_id,))
+        assert cur.fetchone() == (None, None)
+        conn.commit(); cur.close()
+    assert {'backfill-dates', 'backfill-search'} <= set(test_db.pending_backfills())
+    assert test_db.backfill_fecha_date(batch_size=2) >= 1
+    assert test_db.backfill_search_text(batch_size=2) >= 1
+    assert not {'backfill-dates', 'backfill-search'} & set(test_db.pending_backfills())
+    with test_db.db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT fecha_date::text, search_text IS NOT NULL FROM facturas WHERE id = %s", (invoice_id,))
+        assert cur.fetchone() == ('2025-03-05', True); cur.close()
+
+def test_legacy_queue_migration(test_db):
+    job_id, user = str(uuid.uuid4()), _user()
+    with test_db.db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute("""
+            CREATE TABLE pdf_processing_queue (
+                id UUID PRIMARY KEY, status TEXT, created_at TIMESTAMPTZ DEFAULT NOW(), user_id TEXT,
+                pdf_data BYTEA, result_json JSONB, error_message TEXT
+            )
+        """)
+        cur.execute("INSERT INTO pdf_processing_queue (id, status, user_id, pdf_data) VALUES (%s, 'processing', %s, 'x')", (job_id, user))
+        test_db._migration_005_legacy_queues(cur)
+        cur.execute("SELECT type, status FROM job_queue WHERE id = %s", (job_id,))
+        assert cur.fetchone() == ('pdf', 'pending')
+        cur.execute("SELECT to_regclass('pdf_processing_queue')")
+        assert cur.fetchone()[0] is None
+        conn.rollback(); cur.close()
@@ -0,0 +1,206 @@
+import time
+import threading
+
+import pytest
+
+import fakes
+import model_client
+from model_client import CircuitBreaker, ModelClient, PriorityGate, RetryableModelError, ModelUnavailable
+
+def make_client(model, **kwargs):
+    # Sin backoff ni rate limit: las pruebas no esperan
+    options = dict(max_concurrency=2, interactive_reserve=0, requests_per_minute=60000, tokens_per_minute=1e9,
+                   max_retries=3, timeout=5, queue_timeout=1, backoff_base=0, backoff_max=0,
+                   breaker=CircuitBreaker(threshold=100, cooldown=60))
+    options.update(kwargs)
+    return ModelClient(lambda: model, **options)
+
+def test_transient_errors_are_retried_until_success():
+    model = fakes.FakeModel(errors=[429, 503])
+    client = make_client(model)
+    assert client.generate(['prompt']).text
+    assert model.calls == 3
+    assert client.stats()['retries'] == 2 and client.stats()['succeeded'] == 1
+
+def test_retries_stop_at_the_limit():
+    model = fakes.FakeModel(errors=[503] * 10)
+    client = make_client(model, max_retries=2)
+    with pytest.raises(RetryableModelError):
+        client.generate(['prompt'])
+    assert model.calls == 3
+    assert client.stats()['failed'] == 1
+
+def test_interactive_calls_retry_at_most_once():
+    model = fakes.FakeModel(errors=[503] * 10)
+    with pytest.raises(RetryableModelError):
+        make_client(model, max_retries=5).generate('pregunta', priority='interactive')
+    assert model.calls == 2
+
+@pytest.mark.parametrize('code', [400, 403, 404])
+def test_client_errors_are_not_retried(code):
+    model = fakes.FakeModel(errors=[code])
+    client = make_client(model)
+    with pytest.raises(fakes.FakeProviderError) as raised:
+        client.generate(['prompt'])
+    assert raised.value.code == code
+    assert not isinstance(raised.value, RetryableModelError)
+    assert model.calls == 1 and client.stats()['retries'] == 0
+    # Un 4xx demuestra que el proveedor responde: no cuenta para el circuito
+    assert client.breaker.state == 'closed'
+
+def test_timeout_is_retryable():
+    model = fakes.FakeModel(latency=0.05)
+    client = make_client(model, max_retries=1)
+    with pytest.raises(RetryableModelError):
+        client.generate(['prompt'], timeout=0.01)
+    assert model.calls == 2
+
+def test_breaker_opens_rejects_and_half_opens():
+    model = fakes.FakeModel(errors=[503, 503])
+    client = make_client(model, max_retries=0, breaker=CircuitBreaker(threshold=2, cooldown=0.1))
+    for _ in range(2):
+        with pytest.raises(RetryableModelError): client.generate(['prompt'])
+    assert client.breaker.state == 'open'
+    # Abierto: se rechaza sin llamar al modelo
+    with pytest.raises(ModelUnavailable): client.generate(['prompt'])
+    assert model.calls == 2 and client.breaker.retry_after() > 0
+    time.sleep(0.12)
+    assert client.breaker.state == 'half_open'
+    assert client.generate(['prompt']).text
+    assert model.calls == 3 and client.breaker.state == 'closed'
+
+def test_failed_probe_reopens_the_breaker():
+    model = fakes.FakeModel(errors=[503, 503, 503])
+    client = make_client(model, max_retries=0, breaker=CircuitBreaker(threshold=2, cooldown=0.1))
+    for _ in range(2):
+        with pytest.raises(RetryableModelError): client.generate(['prompt'])
+    time.sleep(0.12)
+    with pytest.raises(RetryableModelError): client.generate(['prompt'])
+    assert client.breaker.state == 'open' and model.calls == 3
+
+def test_half_open_lets_a_single_probe_through():
+    breaker = CircuitBreaker(threshold=1, cooldown=0.05)
+    breaker.record_failure()
+    assert not breaker.allow()
+    time.sleep(0.06)
+    assert breaker.allow()
+    assert not breaker.allow()
+    breaker.record_success()
+    assert breaker.state == 'closed' and breaker.allow()
+
+def test_opening_the_breaker_stops_the_retry_loop():
+    model = fakes.FakeModel(errors=[503] * 10)
+    client = make_client(model, max_retries=5, breaker=CircuitBreaker(threshold=2, cooldown=60))
+    with pytest.raises(RetryableModelError): client.generate(['prompt'])
+    assert model.calls == 2
+
+def _enter_in_thread(gate, interactive, entered, name):
+    def run():
+        assert gate.acquire(interactive, time.monotonic() + 5)
+        entered.append(name)
+    thread = threading.Thread(target=run)
+    thread.start()
+    return thread
+
+def _wait_until(condition, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline: raise AssertionError("La condición no se cumplió a tiempo")
+        time.sleep(0.005)
+
+def test_gate_lets_interactive_calls_in_first():
+    gate = PriorityGate(limit=1, reserve=0)
+    assert gate.acquire(False, time.monotonic() + 1)
+    entered = []
+    background = _enter_in_thread(gate, False, entered, 'background')
+    time.sleep(0.02)
+    interactive = _enter_in_thread(gate, True, entered, 'interactive')
+    _wait_until(lambda: gate._interactive_waiting == 1)
+    gate.release()
+    interactive.join(2)
+    assert entered == ['interactive']
+    gate.release()
+    background.join(2)
+    assert entered == ['interactive', 'background']
+
+def test_gate_keeps_the_reserve_for_interactive_calls():
+    gate = PriorityGate(limit=2, reserve=1)
+    assert gate.acquire(False, time.monotonic() + 1)
+    # El segundo hueco es la reserva: una llamada en segundo plano no entra...
+    assert not gate.acquire(False, time.monotonic() + 0.05)
+    # ...pero una interactiva sí
+    assert gate.acquire(True, time.monotonic() + 0.05)
+    assert gate.active == 2
+
+def test_background_calls_never_use_the_reserve():
+    model = fakes.FakeModel(latency=0.03)
+    client = make_client(model, max_concurrency=3, interactive_reserve=1)
+    threads = [threading.Thread(target=client.generate, args=(['prompt'],)) for _ in range(6)]
+    for thread in threads: thread.start()
+    for thread in threads: thread.join(5)
+    assert model.calls == 6 and model.max_active == 2
+
+def test_gate_timeout_raises_model_unavailable():
+    model = fakes.FakeModel(latency=0.2)
+    client = make_client(model, max_concurrency=1, queue_timeout=0.02)
+    worker = threading.Thread(target=client.generate, args=(['prompt'],))
+    worker.start()
+    _wait_until(lambda: client.gate.active == 1)
+    with pytest.raises(ModelUnavailable): client.generate(['prompt'])
+    worker.join(2)
+    assert client.stats()['rejected'] == 1
+
+def test_estimate_tokens_counts_text_and_images():
+    text_only = model_client.estimate_tokens('x' * 400)
+    assert text_only == model_client.MODEL_OUTPUT_TOKENS_ESTIMATE + 101
+    with_image = model_client.estimate_tokens(['x' * 400, object()])
+    assert with_image == text_only + model_client.IMAGE_TOKENS_ESTIMATE
+
+@pytest.fixture
+def short_min_call(monkeypatch):
+    monkeypatch.setattr(model_client, 'MODEL_MIN_CALL_SECONDS', 0.05)
+
+def test_deadline_caps_the_call_timeout(short_min_call):
+    model = fakes.FakeModel(latency=1.0)
+    client = make_client(model, timeout=60)
+    started = time.monotonic()
+    with pytest.raises(model_client.DeadlineExceeded):
+        client.generate(['prompt'], deadline=started + 0.2)
+    assert time.monotonic() - started < 0.5
+    assert model.calls == 1
+    # El corte es nuestro, no del proveedor: no abre el circuito
+    assert client.breaker.state == 'closed'
+
+def test_no_call_without_time_left(short_min_call):
+    model = fakes.FakeModel()
+    with pytest.raises(model_client.DeadlineExceeded):
+        make_client(model).generate(['prompt'], deadline=time.monotonic() + 0.01)
+    assert model.calls == 0
+
+def test_deadline_limits_the_retries(short_min_call):
+    model = fakes.FakeModel(errors=[503] * 10)
+    client = make_client(model, max_retries=5, backoff_base=0.2, backoff_max=0.2)
+    client._backoff = lambda attempt: 0.2
+    started = time.monotonic()
+    with pytest.raises(RetryableModelError) as raised:
+        client.generate(['prompt'], deadline=started + 0.55)
+    # Un fallo real del proveedor sigue siendo un reintento normal (no DeadlineExceeded) aunque se corten los reintentos
+    assert not isinstance(raised.value, model_client.DeadlineExceeded)
+    assert model.calls == 3 and time.monotonic() - started < 0.55
+
+def test_deadline_bounds_the_wait_for_a_slot(short_min_call):
+    model = fakes.FakeModel(latency=0.5)
+    client = make_client(model, max_concurrency=1, queue_timeout=10)
+    worker = threading.Thread(target=client.generate, args=(['prompt'],))
+    worker.start()
+    _wait_until(lambda: client.gate.active == 1)
+    started = time.monotonic()
+    with pytest.raises(model_client.DeadlineExceeded):
+        client.generate(['prompt'], deadline=started + 0.15)
+    assert time.monotonic() - started < 0.3
+    worker.join(2)
+
+def test_success_within_the_deadline(short_min_call):
+    model = fakes.FakeModel(latency=0.01, errors=[503])
+    assert make_client(model).generate(['prompt'], deadline=time.monotonic() + 5).text
+    assert model.calls == 2
@@ -0,0 +1,107 @@
+import pytest
+
+import pdf_pipeline
+from processing import merge_shard_results
+
+@pytest.mark.parametrize('page_count, shard_pages, expected', [
+    (15, 15, None),
+    (10, 15, None),
+    (16, 15, [(1, 8), (9, 16)]),
+    (32, 15, [(1, 11), (12, 22), (23, 32)]),
+    (40, 15, [(1, 14), (15, 28), (29, 40)]),
+    (31, 10, [(1, 8), (9, 16), (17, 24), (25, 31)]),
+    (5, 0, None),
+])
+def test_plan_page_ranges(page_count, shard_pages, expected):
+    assert pdf_pipeline.plan_page_ranges(page_count, shard_pages) == expected
+
+@pytest.mark.parametrize('page_count', range(16, 120))
+def test_page_ranges_cover_every_page_once(page_count):
+    ranges = pdf_pipeline.plan_page_ranges(page_count, 15)
+    pages = [page for start, end in ranges for page in range(start, end + 1)]
+    assert pages == list(range(1, page_count + 1))
+    sizes = [end - start + 1 for start, end in ranges]
+    assert max(sizes) <= 15 and max(sizes) - min(sizes) <= max(1, len(ranges) - 1)
+    # El último fragmento nunca es un resto de pocas páginas
+    assert sizes[-1] >= min(sizes)
+
+def shard(page_start, page_end, result=None, status='completed'):
+    return {'page_start': page_start, 'page_end': page_end, 'status': status, 'result_json': result, 'processing_report': None}
+
+def concepto(descripcion, cantidad, precio):
+    return {'descripcion': descripcion, 'cantidad': cantidad, 'precio_unitario': precio}
+
+def test_header_and_conceptos_are_concatenated_in_page_order():
+    merged, report = merge_shard_results([
+        shard(1, 10, {'emisor': 'Proveedor SL', 'cif': 'B123', 'fecha': '01/02/2024', 'moneda': '', 'estado': 'Pendiente',
+                      'conceptos': [concepto('A', 1, 10), concepto('B', 2, 5)]}),
+        shard(11, 20, {'emisor': '', 'moneda': '$', 'estado': 'Pagada', 'conceptos': [concepto('C', 1, 30), 'basura']}),
+        shard(21, 25, {'conceptos': []}),
+    ], 3)
+    assert (merged['emisor'], merged['cif'], merged['fecha'], merged['moneda']) == ('Proveedor SL', 'B123', '01/02/2024', '$')
+    assert merged['estado'] == 'Pagada'
+    assert [c['descripcion'] for c in merged['conceptos']] == ['A', 'B', 'C']
+    assert report['pages'] == [[1, 10], [11, 20], [21, 25]] and report['conceptos'] == 3
+
+def test_document_summary_on_the_last_page_wins_when_it_matches_the_lines():
+    merged, report = merge_shard_results([
+        shard(1, 10, {'conceptos': [concepto('A', 2, 50)]}),
+        shard(11, 20, {'conceptos': [concepto('B', 1, 100)], 'base_imponible': 200, 'total': 242}),
+    ])
+    assert (merged['base_imponible'], merged['total']) == (200, 242)
+    assert report['source'] == 'documento' and report['reconciled'] and report['difference'] == 0
+
+def test_per_shard_subtotals_are_summed_when_they_match_the_lines():
+    merged, report = merge_shard_results([
+        shard(1, 10, {'conceptos': [concepto('A', 1, 100)], 'base_imponible': 100, 'total': 121}),
+        shard(11, 20, {'conceptos': [concepto('B', 1, 150)], 'base_imponible': 150, 'total': '181.5'}),
+        shard(21, 30, {'conceptos': [concepto('C', 3, '40')], 'base_imponible': 120, 'total': 145.2}),
+    ])
+    assert (merged['base_imponible'], merged['total']) == (370, 447.7)
+    assert report['source'] == 'suma_fragmentos' and report['reconciled'] and report['lines_sum'] == 370
+
+def test_unreconciled_amounts_keep_the_document_summary_and_flag_it():
+    merged, report = merge_shard_results([
+        shard(1, 10, {'conceptos': [concepto('A', 1, 100)], 'base_imponible': 10, 'total': 12.1}),
+        shard(11, 20, {'conceptos': [concepto('B', 1, 100)], 'base_imponible': 500, 'total': 605}),
+    ])
+    assert (merged['base_imponible'], merged['total']) == (500, 605)
+    assert report['source'] == 'documento' and not report['reconciled'] and report['difference'] == 300
+
+def test_lines_are_used_when_no_shard_has_amounts():
+    merged, report = merge_shard_results([
+        shard(1, 10, {'conceptos': [concepto('A', 1.5, 10), concepto('Sin precio', 1, None)]}),
+        shard(11, 20, {'conceptos': [concepto('B', 'x', 3), concepto('C', 2, 2.25)]}),
+    ])
+    assert (merged['base_imponible'], merged['total']) == (19.5, 19.5)
+    assert report['source'] == 'conceptos' and not report['reconciled']
+
+def test_reconciliation_tolerates_rounding():
+    merged, report = merge_shard_results([
+        shard(1, 10, {'conceptos': [concepto('A', 3, 33.33)]}),
+        shard(11, 20, {'conceptos': [concepto('B', 1, 0.02)], 'base_imponible': 100.0, 'total': 121.0}),
+    ])
+    assert report['reconciled'] and merged['base_imponible'] == 100.0
+
+def test_shard_without_result_counts_as_empty():
+    merged, report = merge_shard_results([
+        shard(1, 10, None),
+        shard(11, 20, {'emisor': 'Proveedor SL', 'conceptos': [concepto('A', 1, 10)], 'total': 10}),
+    ], 2)
+    assert merged['emisor'] == 'Proveedor SL' and merged['total'] == 10 and report['reconciled']
+
+def test_failed_shard_is_not_merged():
+    with pytest.raises(ValueError, match='11-20'):
+        merge_shard_results([shard(1, 10, {'conceptos': []}), shard(11, 20, status='failed'), shard(21, 30, {'conceptos': []})], 3)
+
+def test_missing_shard_in_the_middle_is_not_merged():
+    with pytest.raises(ValueError, match='11-20'):
+        merge_shard_results([shard(1, 10, {'conceptos': []}), shard(21, 30, {'conceptos': []})], 3)
+
+def test_missing_last_shard_is_not_merged():
+    with pytest.raises(ValueError, match='2 de 3'):
+        merge_shard_results([shard(1, 10, {'conceptos': []}), shard(11, 20, {'conceptos': []})], 3)
+
+def test_no_shards_is_an_error():
+    with pytest.raises(ValueError):
+        merge_shard_results([])
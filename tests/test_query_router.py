@@ -0,0 +1,90 @@
+from datetime import date
+
+import pytest
+
+import query_router
+
+TODAY = date(2026, 10, 17)
+
+def parse(question, emisores=(), monedas=()):
+    return query_router.parse_question(question, list(emisores), list(monedas), today=TODAY)
+
+@pytest.mark.parametrize('question', [
+    "How much was my last invoice?",
+    "¿Cuánto fue mi última factura?",
+    "¿Cuál fue el último gasto?",
+    "What was the last amount I paid?",
+    "¿Cuánto gasté en los últimos 3 meses?",
+    "How much did I spend this week?",
+])
+def test_last_and_this_outside_a_period_go_to_the_model(question):
+    assert parse(question) is None
+
+@pytest.mark.parametrize('question, date_from, date_to', [
+    ("¿Cuánto gasté el mes pasado?", '2026-09-01', '2026-09-30'),
+    ("¿Cuánto he gastado el último mes?", '2026-09-01', '2026-09-30'),
+    ("How much did I spend last month?", '2026-09-01', '2026-09-30'),
+    ("how much did I spend this month", '2026-10-01', '2026-10-17'),
+    ("¿Cuánto he gastado el mes actual?", '2026-10-01', '2026-10-17'),
+    ("cuánto he gastado este año", '2026-01-01', '2026-10-17'),
+    ("total spent last year", '2025-01-01', '2025-12-31'),
+    ("¿Cuánto gasté el año pasado?", '2025-01-01', '2025-12-31'),
+])
+def test_period_phrases(question, date_from, date_to):
+    query = parse(question)
+    assert query.metric == 'sum'
+    assert (query.filters['date_from'], query.filters['date_to']) == (date_from, date_to)
+
+@pytest.mark.parametrize('question, date_from, date_to, label', [
+    ("¿Cuánto gasté en marzo?", '2026-03-01', '2026-03-31', 'en marzo de 2026'),
+    ("¿Cuánto gasté en diciembre?", '2025-12-01', '2025-12-31', 'en diciembre de 2025'),
+    ("¿Cuánto gasté en setiembre de 2024?", '2024-09-01', '2024-09-30', 'en septiembre de 2024'),
+    ("How much did I spend in February 2024?", '2024-02-01', '2024-02-29', 'in February 2024'),
+    ("How much did I spend in October?", '2026-10-01', '2026-10-31', 'in October 2026'),
+    ("How much did I spend in 2023?", '2023-01-01', '2023-12-31', 'in 2023'),
+])
+def test_month_names_and_years(question, date_from, date_to, label):
+    query = parse(question)
+    assert (query.filters['date_from'], query.filters['date_to']) == (date_from, date_to)
+    assert query.labels['periodo'] == label
+
+@pytest.mark.parametrize('question, date_from', [
+    ("How much did I spend in May?", '2026-05-01'),
+    ("Total spent May 2025", '2025-05-01'),
+    ("How much did I spend in 2024 may", '2024-05-01'),
+    ("¿Cuánto gasté en mayo?", '2026-05-01'),
+])
+def test_may_as_a_month(question, date_from):
+    assert parse(question).filters['date_from'] == date_from
+
+@pytest.mark.parametrize('question', [
+    "How much may I have spent on invoices?",
+    "How much may I owe?",
+])
+def test_may_as_a_verb_is_not_a_period(question):
+    query = parse(question)
+    assert query is None or 'date_from' not in query.filters
+
+def test_lifetime_total_without_period():
+    query = parse("¿Cuánto he gastado en total?")
+    assert query.metric == 'sum' and query.filters == {} and query.lang == 'es'
+
+def test_emisor_estado_and_moneda_filters():
+    query = parse("¿Cuánto debo a Iberdrola en euros?", emisores=['Iberdrola Clientes SAU', 'Endesa'], monedas=['€'])
+    assert query.metric == 'sum'
+    assert query.filters == {'emisores': ['Iberdrola Clientes SAU'], 'estado': 'Pendiente', 'moneda': '€'}
+
+@pytest.mark.parametrize('question, metric, group_by', [
+    ("¿Cuántas facturas tengo?", 'count', None),
+    ("What is my average invoice?", 'avg', None),
+    ("¿Cuál es la factura más cara?", 'max', None),
+    ("How much did I spend per supplier?", 'sum', 'emisor'),
+    ("¿Cuánto gasto cada mes?", 'sum', 'mes'),
+])
+def test_metrics_and_grouping(question, metric, group_by):
+    query = parse(question)
+    assert (query.metric, query.group_by) == (metric, group_by)
+
+def test_unknown_words_go_to_the_model():
+    assert parse("¿Cuánto gasté en gasolina?") is None
+    assert parse("Resume mis facturas") is None
@@ -0,0 +1,41 @@
+import uuid
+
+import pytest
+
+import database as db
+
+@pytest.fixture
+def trigram(monkeypatch):
+    monkeypatch.setattr(db, 'search_supports_trigram', lambda: True)
+
+def _like_param(sql, params):
+    assert "ILIKE %s ESCAPE '\\'" in sql
+    # Sin filtros, el patrón es el último parámetro antes de LIMIT/OFFSET
+    return params[-3]
+
+@pytest.mark.parametrize('text, pattern', [
+    ('%', '%\\%%'),
+    ('50%', '%50\\%%'),
+    ('a_b', '%a\\_b%'),
+    ('c:\\x', '%c:\\\\x%'),
+    ('Acme', '%Acme%'),
+])
+def test_wildcards_in_the_query_are_literal(trigram, text, pattern):
+    sql, params = db._build_search_query('u1', text)
+    assert _like_param(sql, params) == pattern
+    # La similitud trabaja sobre el texto tal cual
+    assert text in params
+
+def test_escape_like_handles_backslash_first():
+    assert db._escape_like('\\%') == '\\\\\\%'
+
+def test_percent_does_not_match_every_invoice(test_db):
+    if not test_db.search_supports_trigram(): pytest.skip("pg_trgm no disponible")
+    user = f"search-{uuid.uuid4().hex[:8]}"
+    test_db.add_invoice({'emisor': 'Descuento 50% S.L.', 'cif': 'B11111111', 'fecha': '01/02/2025', 'total': 10}, 'test', user)
+    test_db.add_invoice({'emisor': 'Ferretería Pérez', 'cif': 'B22222222', 'fecha': '02/02/2025', 'total': 20}, 'test', user)
+    test_db.add_invoice({'emisor': 'Taller_Norte', 'cif': 'B33333333', 'fecha': '03/02/2025', 'total': 30}, 'test', user)
+    found = lambda q: sorted(r['emisor'] for r in test_db.search_invoices(user, q)[0])
+    assert found('%') == ['Descuento 50% S.L.']
+    assert found('r_N') == ['Taller_Norte']
+    assert found('Ferret') == ['Ferretería Pérez']
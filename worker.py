@@ -0,0 +1,77 @@
+import os
+import time
+import argparse
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+import database as db
+import processing
+import blobstore
+import metrics
+
+WORKER_BATCH_SIZE = int(os.environ.get('WORKER_BATCH_SIZE', '8'))
+WORKER_CONCURRENCY = int(os.environ.get('WORKER_CONCURRENCY', '4'))
+# Presupuesto por invocación del cron: debe quedar por debajo del límite de la función serverless
+WORKER_TIME_BUDGET = float(os.environ.get('WORKER_TIME_BUDGET', '50'))
+# No se reclaman trabajos nuevos si queda menos de esto (duración típica de un trabajo)
+WORKER_JOB_ESTIMATE = float(os.environ.get('WORKER_JOB_ESTIMATE', '20'))
+# Parte del presupuesto que se reserva tras la llamada al modelo para guardar la factura y cerrar el trabajo
+WORKER_FINISH_MARGIN = float(os.environ.get('WORKER_FINISH_MARGIN', '3'))
+JOB_LEASE_SECONDS = int(os.environ.get('JOB_LEASE_SECONDS', '300'))
+ARCHIVE_RETRY_BATCH = int(os.environ.get('ARCHIVE_RETRY_BATCH', '10'))
+
+def run_batch(batch_size: int = WORKER_BATCH_SIZE, concurrency: int = WORKER_CONCURRENCY, time_budget: float = WORKER_TIME_BUDGET):
+    """Reclama y procesa hasta `batch_size` trabajos en un pool de `concurrency` hilos sin pasarse del presupuesto."""
+    started = time.monotonic()
+    deadline = started + time_budget
+    requeued, abandoned = db.requeue_expired_jobs()
+    # También los blobs de PDFs fragmentados que fallaron y nadie reintentó en SHARD_RETRY_HOURS
+    for blob_key in filter(None, abandoned + db.release_failed_shard_blobs()):
+        # La base de datos ya no los referencia: un fallo no debe dejar sin borrar el resto ni cortar el lote
+        try: blobstore.store_for(blob_key).delete(blob_key)
+        except Exception as e: print(f"⚠️ No se pudo borrar el blob {blob_key}: {e}")
+    summary = {'claimed': 0, 'completed': 0, 'failed': 0, 'retried': 0, 'deferred': 0, 'requeued': requeued, 'abandoned': len(abandoned), 'paused': False}
+    with ThreadPoolExecutor(max_workers=max(1, concurrency), thread_name_prefix='job') as pool:
+        running = set()
+        while True:
+            free_slots = min(concurrency - len(running), batch_size - summary['claimed'])
+            if free_slots > 0 and processing.gemini_client.breaker.is_open():
+                # Proveedor caído: no reclamamos más trabajos hasta que el circuito deje pasar una prueba
+                summary['paused'], batch_size = True, summary['claimed']
+            elif free_slots > 0 and (not summary['claimed'] or deadline - time.monotonic() > WORKER_JOB_ESTIMATE):
+                jobs = db.claim_pending_jobs(free_slots, JOB_LEASE_SECONDS)
+                for job in jobs: metrics.observe('app_job_wait_seconds', float(job['waited']), type=job['type'])
+                summary['claimed'] += len(jobs)
+                # Cada trabajo recibe el plazo del lote: sus llamadas al modelo no pasan de él (si no caben, vuelve a la cola)
+                running.update(pool.submit(processing.process_job, job, deadline - WORKER_FINISH_MARGIN) for job in jobs)
+                if not jobs: batch_size = summary['claimed']  # Cola vacía: dejamos de reclamar
+            if not running: break
+            done, running = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                summary[future.result()] += 1
+    # Con el tiempo sobrante: reintentos de archivado y espera a las subidas que siguen en curso
+    if deadline - time.monotonic() > WORKER_JOB_ESTIMATE:
+        summary['archived'], summary['archive_failed'] = processing.retry_archival_tasks(ARCHIVE_RETRY_BATCH)
+    summary['archiving'] = processing.wait_for_archival(deadline - time.monotonic())
+    summary['elapsed'] = round(time.monotonic() - started, 3)
+    return summary
+
+def run_forever(poll_interval: float, batch_size: int, concurrency: int, time_budget: float):
+    print(f"👷 Worker iniciado (lote={batch_size}, concurrencia={concurrency}, presupuesto={time_budget}s)")
+    while True:
+        try:
+            summary = run_batch(batch_size, concurrency, time_budget)
+        except Exception as e:
+            print(f"❌ Error en el worker: {e}")
+            summary = {'claimed': 0}
+        if summary['claimed']: print(f"✅ Lote procesado: {summary}")
+        else: time.sleep(poll_interval)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Worker de la cola de facturas (uso fuera de Vercel).")
+    parser.add_argument('--once', action='store_true', help="Procesa un único lote y termina.")
+    parser.add_argument('--batch-size', type=int, default=WORKER_BATCH_SIZE)
+    parser.add_argument('--concurrency', type=int, default=WORKER_CONCURRENCY)
+    parser.add_argument('--time-budget', type=float, default=WORKER_TIME_BUDGET)
+    parser.add_argument('--poll-interval', type=float, default=5.0)
+    args = parser.parse_args()
+    if args.once: print(run_batch(args.batch_size, args.concurrency, args.time_budget))
+    else: run_forever(args.poll_interval, args.batch_size, args.concurrency, args.time_budget)